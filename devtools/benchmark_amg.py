@@ -0,0 +1,67 @@
+import argparse, importlib.util, time, tempfile, unittest.mock, numpy
+from pathlib import Path
+from . import log
+
+parser = argparse.ArgumentParser(description='compare the setup time, number of applications and solution time of linear preconditioners on the examples')
+parser.add_argument('--backend', default='scipy', help='the matrix backend; default: scipy')
+parser.add_argument('--solver', default='cg', help='the iterative solver; default: cg')
+parser.add_argument('--rtol', type=float, default=1e-8, help='the relative tolerance of the linear solver; default: 1e-8')
+parser.add_argument('--precons', default='diag,spilu,amg', help='comma separated list of preconditioners; default: diag,spilu,amg')
+parser.add_argument('examples', nargs='*', default=['laplace:nelems=256', 'elasticity:nelems=128'], help='the names of the examples to run, optionally followed by a colon and comma separated arguments, e.g. `laplace:nelems=64,degree=2`')
+args = parser.parse_args()
+
+from nutils import cli, matrix, solver
+
+examples = Path(__file__).parent.parent/'examples'
+nodesizes = dict(elasticity=2) # number of dofs per node of vector valued bases, for amg
+
+class Solved(Exception):
+  'raised after the first linear solve to skip the postprocessing of an example'
+
+class Timings:
+
+  def __init__(self, precon, nodesize):
+    self.precon = precon
+    self.nodesize = nodesize
+    self.setup = self.solve = 0.
+    self.napply = 0
+
+  def getprecon(self, getprecon):
+    def wrapped(*fargs, **fkwargs):
+      t0 = time.perf_counter()
+      precon = getprecon(*fargs, **fkwargs)
+      self.setup += time.perf_counter() - t0
+      def counted(rhs):
+        self.napply += 1
+        return precon(rhs)
+      return counted
+    return wrapped
+
+  def solve_linear(self, solve_linear):
+    def wrapped(*fargs, constrain, **fkwargs):
+      preconargs = {}
+      if self.precon == 'amg':
+        preconargs['nodes'] = (numpy.arange(len(constrain)) // self.nodesize)[numpy.isnan(constrain)]
+      t0 = time.perf_counter()
+      solve_linear(*fargs, constrain=constrain, **fkwargs, linsolver=args.solver, linprecon=self.precon, linpreconargs=preconargs, linrtol=args.rtol)
+      self.solve = time.perf_counter() - t0
+      raise Solved('skipping postprocessing')
+    return wrapped
+
+with tempfile.TemporaryDirectory() as outrootdir:
+  for example in args.examples:
+    name, sep, exampleargs = example.partition(':')
+    spec = importlib.util.spec_from_file_location(name, str(examples/(name+'.py')))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    for precon in args.precons.split(','):
+      timings = Timings(precon, nodesizes.get(name, 1))
+      with matrix.backend(args.backend), \
+          unittest.mock.patch.object(solver, 'solve_linear', timings.solve_linear(solver.solve_linear)), \
+          unittest.mock.patch.object(matrix.Matrix, 'getprecon', timings.getprecon(matrix.Matrix.getprecon)):
+        try:
+          cli.run(module.main, args=[name, *filter(None, exampleargs.split(',')), 'outrootdir='+outrootdir, 'richoutput=no', 'verbose=1', 'gracefulexit=no'], loaduserconfig=False)
+        except Solved:
+          log.info('{} {}: setup {:.2f}s, {} applications, solve {:.2f}s'.format(example, precon, timings.setup, timings.napply, timings.solve))
+        except Exception as e:
+          log.error('{} {}: {}'.format(example, precon, e))
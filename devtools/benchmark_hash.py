@@ -0,0 +1,37 @@
+import argparse, time, unittest.mock, numpy
+from . import log
+
+parser = argparse.ArgumentParser(description='compare the hashing throughput of the nutils_hash digests for typical solver arguments')
+parser.add_argument('--size', type=int, default=1000000, help='the number of entries of the coefficient vectors; default: 1000000')
+parser.add_argument('--repeat', type=int, default=5, help='the number of repetitions, of which the fastest is reported; default: 5')
+args = parser.parse_args()
+
+from nutils import types
+
+# Every case is a function that constructs a fresh object, such that the first
+# hash is computed rather than retrieved from the memoized value.
+cases = dict(
+  lhs0=lambda: types.frozenarray(numpy.linspace(0, 1, args.size)),
+  arguments=lambda: types.frozendict({name: types.frozenarray(numpy.linspace(0, 1, args.size//4)) for name in 'uvpT'}),
+  transposed=lambda: types.frozenarray(numpy.linspace(0, 1, args.size).reshape(-1, 4).T),
+  connectivity=lambda: tuple(tuple(range(i, i+4)) for i in range(args.size//100)),
+  names=lambda: tuple('argument{}'.format(i) for i in range(args.size//1000)))
+
+for name, construct in cases.items():
+  timings = {}
+  for digest in types._digests:
+    fresh = memoized = float('inf')
+    for irepeat in range(args.repeat):
+      obj = construct()
+      with unittest.mock.patch.object(types, '_digest', types._digests[digest]):
+        t0 = time.perf_counter()
+        types.nutils_hash(obj)
+        t1 = time.perf_counter()
+        types.nutils_hash(obj)
+        t2 = time.perf_counter()
+      fresh = min(fresh, t1 - t0)
+      memoized = min(memoized, t2 - t1)
+    timings[digest] = fresh
+    log.info('{} {}: {:.2f}ms, memoized {:.3f}ms'.format(name, digest, fresh*1e3, memoized*1e3))
+  if 'blake2b' in timings:
+    log.info('{}: blake2b {:+.0f}% relative to sha1'.format(name, 100*(timings['blake2b']/timings['sha1']-1)))
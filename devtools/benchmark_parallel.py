@@ -0,0 +1,24 @@
+import argparse, sys, time, tempfile
+from pathlib import Path
+from . import log, run
+
+parser = argparse.ArgumentParser(description='compare the fork and threads parallelization methods on the examples')
+parser.add_argument('--nprocs', type=int, default=4, help='the number of processes or threads; default: 4')
+parser.add_argument('--repeat', type=int, default=3, help='the number of runs per example and method, of which the fastest is reported; default: 3')
+parser.add_argument('examples', nargs='*', default=['laplace', 'elasticity', 'finitestrain', 'drivencavity'], help='the names of the examples to run, optionally followed by a colon and comma separated arguments, e.g. `laplace:nelems=64,degree=2`')
+args = parser.parse_args()
+
+examples = Path(__file__).parent.parent/'examples'
+
+with tempfile.TemporaryDirectory() as outrootdir:
+  for example in args.examples:
+    name, sep, exampleargs = example.partition(':')
+    timings = {}
+    for method in 'fork', 'threads':
+      timings[method] = []
+      for irepeat in range(args.repeat):
+        t0 = time.perf_counter()
+        run(sys.executable, str(examples/(name+'.py')), *filter(None, exampleargs.split(',')), 'nprocs={}'.format(args.nprocs), 'parallel='+method, 'outrootdir='+outrootdir, 'richoutput=no', 'verbose=1', print_cmdline=irepeat==0)
+        timings[method].append(time.perf_counter() - t0)
+    fork, threads = min(timings['fork']), min(timings['threads'])
+    log.info('{}: fork {:.2f}s, threads {:.2f}s ({:+.0f}%)'.format(example, fork, threads, 100*(threads/fork-1)))
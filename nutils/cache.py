@@ -23,7 +23,12 @@ The cache module.
 """
 
 from . import types, util
-import os, numpy, functools, inspect, builtins, pathlib, pickle, itertools, hashlib, abc, contextlib, treelog as log
+import os, numpy, functools, inspect, builtins, pathlib, pickle, itertools, abc, contextlib, collections, time, zlib, shutil, struct, treelog as log
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
 
 class Wrapper:
   'function decorator that caches results by arguments'
@@ -76,17 +81,56 @@ class WrapperCache:
 
   @property
   def __nutils_hash__(self):
-    return hashlib.sha1(b'nutils.cache.WrapperCache\0').digest()
+    return types.newhash(b'nutils.cache.WrapperCache\0').digest()
 
 _cache = util.settable()
 
-def enable(cachedir: str):
+@contextlib.contextmanager
+def enable(cachedir: str, *, maxsize: int = None, compress: str = None, memory: int = 0, checkpoint: int = None, mmap: int = None):
   '''
   Enable cacheing and set the cache directory to ``cachedir``.  Affects
   functions decorated with :func:`function` and subclasses of
   :class:`Recursion`.
+
+  Parameters
+  ----------
+  cachedir : :class:`str`
+      The cache directory.
+  maxsize : :class:`int`
+      Optional upper bound in bytes for the total size of the entries of
+      :func:`function`.  If given, an index of entry sizes and access times is
+      maintained in the cache directory and the least recently used entries
+      are evicted if the bound is exceeded.
+  compress : :class:`str`
+      Optional compression of newly stored entries: ``'zlib'``, or ``'zstd'``
+      if the ``zstandard`` module is installed.  Compressed and uncompressed
+      entries can be read regardless of this setting.
+  memory : :class:`int`
+      Size in bytes of an in-process memory tier that holds the stored form
+      of recently used entries of :func:`function` in front of the disk.
+      Default: 0.
+  checkpoint : :class:`int`
+      Optional interval at which the iterations of :class:`Recursion` are
+      checkpointed.  If given, the log of a recursion retains only the last
+      ``length`` iterations of every ``checkpoint`` iterations, plus the most
+      recent ``length`` iterations.  Dropped iterations are recomputed from
+      the preceding checkpoint when the recursion is iterated anew.
+  mmap : :class:`int`
+      Optional minimum size in bytes of array data that is stored out-of-band
+      in separate ``.npy`` segment files, using pickle protocol 5 buffers.
+      When the entry is loaded the segments are memory mapped rather than
+      read, such that the array is shared between processes and paged in on
+      demand.  Such arrays are returned read-only; a
+      :class:`nutils.types.frozenarray` remains a frozen array.  Requires
+      Python 3.8 or higher.
   '''
-  return _cache.sets(pathlib.Path(cachedir))
+
+  store = _Store(pathlib.Path(cachedir), maxsize=maxsize, compress=compress, memory=memory, checkpoint=checkpoint, mmap=mmap)
+  try:
+    with _cache.sets(store):
+      yield
+  finally:
+    store.flush()
 
 def disable():
   '''
@@ -95,8 +139,9 @@ def disable():
   '''
   return _cache.sets(None)
 
-# Define platform-dependent `_lock_file` function.
+# Define platform-dependent `_lock_file` and `_unlock_file` functions.
 def _lock_file_fallback(f): pass
+def _unlock_file_fallback(f): pass
 
 try:
   import fcntl
@@ -109,11 +154,13 @@ else:
   # descriptor is closed.
   def _lock_file_fcntl(f):
     fcntl.flock(f, fcntl.LOCK_EX)
+  def _unlock_file_fcntl(f):
+    fcntl.flock(f, fcntl.LOCK_UN)
 
 try:
   import msvcrt
 except ImportError:
-  _lock_file_msvcrt = None
+  _lock_file_msvcrt = _unlock_file_msvcrt = None
 else:
   # On Windows we use `msvcrt.locking`.  We lock the first byte at the current
   # position of the file.  Like `fcntl.flock` the lock is exclusive, tied to
@@ -129,8 +176,260 @@ else:
         pass
       else:
         return
+  def _unlock_file_msvcrt(f):
+    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
 
 _lock_file = next(filter(None, [_lock_file_fcntl, _lock_file_msvcrt, _lock_file_fallback]))
+_unlock_file = next(filter(None, [_unlock_file_fcntl, _unlock_file_msvcrt, _unlock_file_fallback]))
+
+def _open_locked(path):
+  # Open `path` for reading and writing, creating it if it does not exist,
+  # which costs a single system call rather than the two of `touch` and
+  # `open`.  The caller is responsible for locking the file.
+  return os.fdopen(os.open(str(path), os.O_RDWR | os.O_CREAT, 0o666), 'r+b')
+
+def _segment(path, i):
+  return path.parent/'{}-{}.npy'.format(path.name, i)
+
+class _Store:
+  '''
+  Storage engine of the cache directory.  Entries are stored in files that are
+  named after the hash of the arguments (content addressing), optionally
+  compressed with zlib or zstd.  The compression format is recognized by the
+  leading bytes of an entry: a pickle starts with ``0x80``, a zlib stream
+  with ``0x78`` and a zstd frame with ``28 b5 2f fd``.  If ``maxsize`` is
+  given, the sizes and access times of the entries of :func:`function` are
+  tracked in a single index file, which is replaced atomically on every
+  update, and the least recently used entries are evicted until the total
+  size is within bounds.  Access times of cache hits are collected in memory
+  and written to the index with the next update.
+
+  If ``mmap`` is given, the buffers of arrays of at least ``mmap`` bytes are
+  stored out-of-band in segment files ``<name>-<i>.npy`` next to the entry,
+  which are memory mapped on load.  Such entries are prefixed by a zero byte
+  and the number of segments as a four byte little endian integer.
+  '''
+
+  def __init__(self, path, *, maxsize=None, compress=None, memory=0, checkpoint=None, mmap=None):
+    if compress not in (None, 'zlib', 'zstd'):
+      raise ValueError('invalid compression {!r}; choose from zlib, zstd'.format(compress))
+    if compress == 'zstd' and zstandard is None:
+      raise ValueError('zstd compression requires the zstandard module')
+    if maxsize is not None and maxsize < 0:
+      raise ValueError('maxsize should be a nonnegative integer')
+    if checkpoint is not None and checkpoint < 1:
+      raise ValueError('checkpoint should be a positive integer')
+    if mmap is not None and pickle.HIGHEST_PROTOCOL < 5:
+      raise ValueError('memory mapped cache entries require pickle protocol 5 (Python 3.8 or higher)')
+    self.path = path
+    self.maxsize = maxsize
+    self.compress = compress
+    self.memory = memory
+    self.checkpoint = checkpoint
+    self.mmap = mmap
+    self._memory = collections.OrderedDict()
+    self._memorysize = 0
+    self._pending = {}
+    # Create the directory once rather than on every call.
+    path.mkdir(parents=True, exist_ok=True)
+
+  def dumps(self, data, path):
+    'return the stored form of ``data`` as entry ``path``, writing segments if applicable'
+
+    if self.mmap is None:
+      raw = pickle.dumps(data)
+    else:
+      buffers = []
+      def buffer_callback(buf):
+        # A false return value marks `buf` for out-of-band serialization.
+        if buf.raw().nbytes < self.mmap:
+          return True
+        buffers.append(buf)
+      raw = pickle.dumps(data, protocol=5, buffer_callback=buffer_callback)
+      for i, buf in enumerate(buffers):
+        # Segments are replaced rather than overwritten, as truncating a file
+        # that is memory mapped elsewhere invalidates the mapping.
+        tmp = path.parent/'{}-{}.{}.tmp'.format(path.name, i, os.getpid())
+        with tmp.open('wb') as f:
+          numpy.save(f, numpy.frombuffer(buf.raw(), dtype=numpy.uint8))
+        os.replace(str(tmp), str(_segment(path, i)))
+    if self.compress == 'zlib':
+      raw = zlib.compress(raw)
+    elif self.compress == 'zstd':
+      raw = zstandard.ZstdCompressor().compress(raw)
+    if self.mmap is not None and buffers:
+      raw = b'\x00' + len(buffers).to_bytes(4, 'little') + raw
+    return raw
+
+  @staticmethod
+  def loads(raw, path):
+    'return the data of entry ``path`` from its stored form'
+
+    nbuffers = 0
+    if raw[:1] == b'\x00':
+      nbuffers = int.from_bytes(raw[1:5], 'little')
+      raw = raw[5:]
+    try:
+      if raw[:1] == b'\x78':
+        raw = zlib.decompress(raw)
+      elif raw[:4] == b'\x28\xb5\x2f\xfd':
+        if zstandard is None:
+          raise pickle.UnpicklingError('zstd compressed entry requires the zstandard module')
+        raw = zstandard.ZstdDecompressor().decompress(raw)
+    except pickle.UnpicklingError:
+      raise
+    except Exception as e:
+      raise pickle.UnpicklingError('failed to decompress entry: {}'.format(e)) from e
+    if not nbuffers:
+      return pickle.loads(raw)
+    try:
+      buffers = [numpy.load(str(_segment(path, i)), mmap_mode='r') for i in range(nbuffers)]
+    except (OSError, ValueError) as e:
+      raise pickle.UnpicklingError('failed to map segment: {}'.format(e)) from e
+    return pickle.loads(raw, buffers=buffers)
+
+  def recall(self, hkey):
+    'return the stored form of entry ``hkey`` if held in memory, else None'
+
+    raw = self._memory.get(hkey)
+    if raw is not None:
+      self._memory.move_to_end(hkey)
+      self._accessed(hkey)
+    return raw
+
+  def loaded(self, hkey, raw):
+    'register a cache hit of entry ``hkey`` on disk'
+
+    self._remember(hkey, raw)
+    self._accessed(hkey)
+
+  def stored(self, hkey, raw):
+    'register a newly stored entry ``hkey``'
+
+    self._remember(hkey, raw)
+    if self.maxsize is not None:
+      size = len(raw)
+      if raw[:1] == b'\x00':
+        size += sum(_segment(self.path/hkey, i).stat().st_size for i in range(int.from_bytes(raw[1:5], 'little')))
+      self._update_index({hkey: (size, time.time())})
+
+  def flush(self):
+    'write pending access times to the index'
+
+    if self._pending:
+      self._update_index({})
+
+  def _remember(self, hkey, raw):
+    if len(raw) > self.memory:
+      return
+    if hkey in self._memory:
+      self._memorysize -= len(self._memory.pop(hkey))
+    self._memory[hkey] = raw
+    self._memorysize += len(raw)
+    while self._memorysize > self.memory:
+      self._memorysize -= len(self._memory.popitem(last=False)[1])
+
+  def _accessed(self, hkey):
+    if self.maxsize is not None:
+      self._pending[hkey] = time.time()
+
+  @contextlib.contextmanager
+  def _index(self):
+    # Lock the index via a separate lock file: as the index itself is replaced
+    # on every update, a lock on its file descriptor would refer to a stale
+    # file for all but the first waiting process.
+    with _open_locked(self.path/'index.lock') as lock:
+      _lock_file(lock)
+      index = self._readindex()
+      existed = bool(index)
+      yield index
+      if index or existed:
+        tmp = self.path/'index.{}.tmp'.format(os.getpid())
+        with tmp.open('wb') as f:
+          pickle.dump(index, f)
+        os.replace(str(tmp), str(self.path/'index'))
+
+  def _readindex(self):
+    try:
+      with (self.path/'index').open('rb') as f:
+        return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, IndexError):
+      return {}
+
+  def _update_index(self, added):
+    pending, self._pending = self._pending, {}
+    with self._index() as index:
+      for hkey, atime in pending.items():
+        if hkey in index:
+          index[hkey] = index[hkey][0], max(index[hkey][1], atime)
+      index.update(added)
+      if self.maxsize is not None:
+        self._evict(index, self.maxsize)
+
+  def _evict(self, index, maxsize, before=None):
+    total = sum(size for size, atime in index.values())
+    for hkey, (size, atime) in sorted(index.items(), key=lambda item: item[1][1]):
+      if total <= maxsize and (before is None or atime >= before):
+        break
+      path = self.path/hkey
+      if path.is_dir():
+        shutil.rmtree(str(path), ignore_errors=True)
+      else:
+        for segment in itertools.chain([path], self.path.glob(_segment(path, '*').name)):
+          try:
+            segment.unlink()
+          except FileNotFoundError:
+            pass
+      log.debug('[cache] evicted {}'.format(hkey))
+      del index[hkey]
+      self._memorysize -= len(self._memory.pop(hkey, b''))
+      total -= size
+
+  def entries(self):
+    '''
+    Return a dictionary of all entries in the cache directory, mapping the
+    entry name to a tuple of its size in bytes and its last access time. The
+    access times of entries of :func:`function` are taken from the index if
+    available, otherwise from the modification time of the file; entries of
+    :class:`Recursion` are directories, for which the most recently modified
+    file determines the access time.
+    '''
+
+    index = self._readindex()
+    entries = {}
+    segments = collections.defaultdict(int)
+    for path in self.path.iterdir():
+      if path.suffix == '.npy':
+        segments[path.name.split('-')[0]] += path.stat().st_size
+      elif len(path.name) != 40:
+        continue
+      elif path.is_dir():
+        stats = [child.stat() for child in path.iterdir()]
+        entries[path.name] = sum(stat.st_size for stat in stats), max((stat.st_mtime for stat in stats), default=path.stat().st_mtime)
+      else:
+        stat = path.stat()
+        entries[path.name] = index.get(path.name, (stat.st_size, stat.st_mtime))
+    for name, size in segments.items():
+      if name in entries and name not in index:
+        entries[name] = entries[name][0] + size, entries[name][1]
+    return entries
+
+  def prune(self, maxsize=None, maxage=None):
+    '''
+    Remove the entries that were last accessed more than ``maxage`` seconds
+    ago, followed by the least recently used entries until the total size is
+    at most ``maxsize`` bytes.  Return the number of removed entries and
+    bytes.
+    '''
+
+    entries = self.entries()
+    before = None if maxage is None else time.time() - maxage
+    with self._index() as index:
+      remaining = dict(entries)
+      self._evict(remaining, float('inf') if maxsize is None else maxsize, before)
+      for name in entries.keys() - remaining.keys():
+        index.pop(name, None)
+    return len(entries) - len(remaining), sum(entries[name][0] for name in entries.keys() - remaining.keys())
 
 
 def function(func=None, *, version=0):
@@ -175,23 +474,29 @@ def function(func=None, *, version=0):
 
   # Hash of the full function name (closest thing to a unique representation of
   # `func`).
-  func_key = hashlib.sha1('{}.{}:{}'.format(func.__module__, func.__qualname__, version).encode()).digest()
+  func_key = types.newhash('{}.{}:{}'.format(func.__module__, func.__qualname__, version).encode()).digest()
   canonicalize = types.argument_canonicalizer(inspect.signature(func))
 
   @functools.wraps(func)
   def wrapper(*args, **kwargs):
-    if _cache.value is None:
+    store = _cache.value
+    if store is None:
       return func(*args, **kwargs)
     args, kwargs = canonicalize(*args, **kwargs)
     # Hash the function key and the canonicalized arguments and compute the
     # hexdigest.  This is used to identify cache file `cachefile`.
-    h = hashlib.sha1(func_key)
+    h = types.newhash(func_key)
     for arg in args:
       h.update(types.nutils_hash(arg))
-    for hkv in sorted(hashlib.sha1(k.encode()).digest()+types.nutils_hash(v) for k, v in kwargs.items()):
+    for hkv in sorted(types.newhash(k.encode()).digest()+types.nutils_hash(v) for k, v in kwargs.items()):
       h.update(hkv)
     hkey = h.hexdigest()
-    cachefile = _cache.value/hkey
+    # Entries that were recently used by this process are held in memory and
+    # unpickled anew on every hit, such that every call returns a fresh copy.
+    raw = store.recall(hkey)
+    if raw is not None:
+      log.debug('[cache.function {}] load from memory'.format(hkey))
+      return _unpack(store.loads(raw, store.path/hkey))
     # Open and lock `cachefile`.  Try to read it and, if successful, unlock
     # the file (implicitly by closing the file) and return the value.  If
     # reading fails, e.g. because the file did not exist, call `func`, store
@@ -199,31 +504,20 @@ def function(func=None, *, version=0):
     # file immediately to avoid checking twice if there is a cached value: once
     # before locking the file, and once after locking, at which point another
     # party may have written something to the cache already.
-    cachefile.parent.mkdir(parents=True, exist_ok=True)
-    cachefile.touch()
-    with cachefile.open('r+b') as f:
+    with _open_locked(store.path/hkey) as f:
       log.debug('[cache.function {}] acquiring lock'.format(hkey))
       _lock_file(f)
       log.debug('[cache.function {}] lock acquired'.format(hkey))
+      raw = f.read()
       try:
-        data = pickle.load(f)
-        if len(data) == 2: # For old caches.
-          value, log_ = data
-          fail = False
-        else:
-          log_, fail, value = data
+        data = store.loads(raw, store.path/hkey)
       except (EOFError, pickle.UnpicklingError, IndexError):
         log.debug('[cache.function {}] failed to load, cache will be rewritten'.format(hkey))
         pass
       else:
         log.debug('[cache.function {}] load'.format(hkey))
-        log_.replay()
-        if fail:
-          raise value
-        else:
-          return value
-      # Seek back to the beginning, because pickle might have read garbage.
-      f.seek(0)
+        store.loaded(hkey, raw)
+        return _unpack(data)
       # Disable the cache temporarily to prevent caching subresults *in* `func`.
       log_ = log.RecordLog()
       with disable(), log.add(log_):
@@ -234,15 +528,180 @@ def function(func=None, *, version=0):
           fail = True
         else:
           fail = False
-      pickle.dump((log_, fail, value), f)
+      raw = store.dumps((log_, fail, value), store.path/hkey)
+      # Seek back to the beginning, because we might have read garbage.
+      f.seek(0)
+      f.write(raw)
+      f.truncate()
       log.debug('[cache.function {}] store'.format(hkey))
-      if fail:
-        raise value
-      else:
-        return value
+    store.stored(hkey, raw)
+    if fail:
+      raise value
+    else:
+      return value
 
   return wrapper
 
+def _unpack(data):
+  if len(data) == 2: # For old caches.
+    value, log_ = data
+    fail = False
+  else:
+    log_, fail, value = data
+  log_.replay()
+  if fail:
+    raise value
+  else:
+    return value
+
+class _RecursionLog:
+  '''
+  Append-only log of the iterations of a :class:`Recursion`.  The file starts
+  with a header of a magic string and a generation number, followed by
+  records that consist of the iteration number, the payload length and a
+  CRC32 checksum of both and the payload, followed by the payload.  The records are read sequentially
+  from a single open file and the offset of the next record is tracked in
+  memory, such that replaying a history requires no seeks beyond the lock
+  that is taken for every record.  A record that is incomplete or fails the
+  checksum, which is the result of an interrupted write, is truncated along
+  with everything that follows.
+
+  The log is compacted in place by :meth:`compact`, which increments the
+  generation such that concurrent readers know to locate their next record
+  anew.  Since a record with a given iteration number always holds the same
+  value, any complete record with an increasing iteration number is valid,
+  which makes an interrupted compaction safe as well.
+  '''
+
+  _header = struct.Struct('<8sQ')
+  _record = struct.Struct('<QQI')
+  _magic = b'NUTILSRL'
+
+  def __init__(self, f):
+    self.f = f
+    self.generation = None
+    self.offset = None
+
+  @contextlib.contextmanager
+  def locked(self, iteration):
+    '''
+    Lock the log and position it at the first record of at least
+    ``iteration``.
+    '''
+
+    # `msvcrt.locking` locks the byte at the current position, hence the seek.
+    self.f.seek(0)
+    _lock_file(self.f)
+    try:
+      header = self.f.read(self._header.size)
+      magic, generation = self._header.unpack(header) if len(header) == self._header.size else (None, None)
+      if magic != self._magic:
+        self._truncate(0)
+        self.f.write(self._header.pack(self._magic, 0))
+        generation = 0
+      if generation != self.generation:
+        self.generation = generation
+        self.offset = self._locate(iteration)
+      yield
+    finally:
+      self.f.flush()
+      self.f.seek(0)
+      _unlock_file(self.f)
+
+  def _locate(self, iteration):
+    end = self._header.size
+    for offset, i, length in self._headers():
+      if i >= iteration:
+        return offset
+      end = offset + self._record.size + length
+    return end
+
+  def _headers(self):
+    # Iterate over (offset, iteration, length) of all complete records without
+    # reading the payloads.
+    offset = self.f.seek(self._header.size)
+    end = self.f.seek(0, os.SEEK_END)
+    while offset + self._record.size <= end:
+      self.f.seek(offset)
+      i, length, crc = self._record.unpack(self.f.read(self._record.size))
+      if offset + self._record.size + length > end:
+        break
+      yield offset, i, length
+      offset += self._record.size + length
+
+  @staticmethod
+  def _checksum(iteration, payload):
+    # The checksum covers the iteration number and length as well, such that
+    # a corrupt header cannot pass for a record of another iteration.
+    return zlib.crc32(payload, zlib.crc32(struct.pack('<QQ', iteration, len(payload))))
+
+  def _truncate(self, offset):
+    self.f.seek(offset)
+    self.f.truncate()
+
+  def read(self, iteration):
+    '''
+    Return the iteration number and payload of the next record and advance
+    if the iteration number equals ``iteration``.  Return the iteration number
+    of a later record without advancing if ``iteration`` was dropped by
+    compaction, or ``None`` if the log is exhausted.
+    '''
+
+    self.f.seek(self.offset)
+    header = self.f.read(self._record.size)
+    if not header:
+      return None
+    if len(header) == self._record.size:
+      i, length, crc = self._record.unpack(header)
+      payload = self.f.read(length) if i >= iteration else b''
+      if len(payload) == length and self._checksum(i, payload) == crc:
+        if i > iteration:
+          return i, None
+        self.offset += self._record.size + length
+        return i, payload
+    log.debug('[cache.Recursion] truncating log at iteration {}'.format(iteration))
+    self._truncate(self.offset)
+    return None
+
+  def discard(self, payload):
+    'truncate the log at the start of the last read record with ``payload``'
+
+    self.offset -= self._record.size + len(payload)
+    self._truncate(self.offset)
+
+  def append(self, iteration, payload):
+    'append a record at the end of the log, which should be the current position'
+
+    self.f.seek(self.offset)
+    self.f.write(self._record.pack(iteration, len(payload), self._checksum(iteration, payload)) + payload)
+    self.f.truncate()
+    self.offset = self.f.tell()
+
+  def compact(self, keep):
+    '''
+    Remove the records for which ``keep(iteration)`` is false, and return
+    the removed iteration numbers.
+    '''
+
+    headers = list(self._headers())
+    removed = [i for offset, i, length in headers if not keep(i)]
+    if not removed:
+      return removed
+    self.generation += 1
+    self.f.seek(0)
+    self.f.write(self._header.pack(self._magic, self.generation))
+    offset = self._header.size
+    for oldoffset, i, length in headers:
+      if keep(i):
+        self.f.seek(oldoffset)
+        record = self.f.read(self._record.size + length)
+        self.f.seek(offset)
+        self.f.write(record)
+        offset += len(record)
+    self._truncate(offset)
+    self.offset = offset
+    return removed
+
 class _RecursionMeta(types.ImmutableMeta):
 
   def __new__(mcls, name, bases, namespace, *, length=None, **kwargs):
@@ -338,55 +797,50 @@ class Recursion(types.Immutable, metaclass=_RecursionMeta):
 
   def __iter__(self):
     length = type(self).length
-    if _cache.value is None:
+    store = _cache.value
+    if store is None:
       yield from self.resume_index([], 0)
-    else:
-      # The hash of `types.Immutable` uniquely defines this `Recursion`, so use
-      # this to identify the cache directory.  All iterations are stored as
-      # separate files, numbered '0000', '0001', ..., in this directory.
-      hkey = self.__nutils_hash__.hex()
-      cachepath = _cache.value / hkey
-      cachepath.mkdir(exist_ok=True, parents=True)
-      log.debug('[cache.Recursion {}] start iterating'.format(hkey))
-      # The `history` variable is updated while reading from the cache and
-      # truncated to the required length.
-      history = []
-      # The `exhausted` variable controls if we are reading items from the
-      # cache (`False`) or we are computing values and writing to the cache.
-      # Once `exhausted` is `True` we keep it there, even if at some point
-      # there are cached items available.
-      exhausted = False
-      # The `stop` variable indicates if an exception is raised in `resume`.
-      stop = False
+      return
+    # The hash of `types.Immutable` uniquely defines this `Recursion`, so use
+    # this to identify the cache directory.  All iterations are stored as
+    # records of a single append-only log in this directory, alongside the
+    # segments of out-of-band array data if enabled.
+    hkey = self.__nutils_hash__.hex()
+    cachepath = store.path / hkey
+    cachepath.mkdir(exist_ok=True)
+    log.debug('[cache.Recursion {}] start iterating'.format(hkey))
+    # The `history` variable holds the last `length` items.  The `resume`
+    # variable holds the generator that computes items that are missing from
+    # the log, either because the log is exhausted or because they were
+    # dropped by compaction, in which case `resume` is discarded as soon as
+    # the log continues.
+    history = []
+    resume = None
+    with _open_locked(cachepath/'log') as f:
+      reclog = _RecursionLog(f)
       for i in itertools.count():
-        cachefile = cachepath/'{:04d}'.format(i)
-        cachefile.touch()
-        with cachefile.open('r+b') as f:
-          log.debug('[cache.Recursion {}.{:04d}] acquiring lock'.format(hkey, i))
-          _lock_file(f)
+        entry = cachepath/'{:04d}'.format(i)
+        # The log is locked while an item is computed, such that concurrent
+        # processes wait for it rather than computing it as well.
+        with reclog.locked(i):
           log.debug('[cache.Recursion {}.{:04d}] lock acquired'.format(hkey, i))
-          if not exhausted:
+          record = reclog.read(i)
+          if record and record[1] is not None:
             try:
-              log_, stop, value = pickle.load(f)
-            except (pickle.UnpicklingError, IndexError):
+              log_, stop, value = store.loads(record[1], entry)
+            except (EOFError, pickle.UnpicklingError, IndexError):
               log.debug('[cache.Recursion {}.{:04d}] failed to load, cache will be rewritten from this point'.format(hkey, i))
-              exhausted = True
-            except EOFError:
-              log.debug('[cache.Recursion {}.{:04d}] cache exhausted'.format(hkey, i))
-              exhausted = True
+              reclog.discard(record[1])
+              record = None
             else:
               log.debug('[cache.Recursion {}.{:04d}] load'.format(hkey, i))
               log_.replay()
               if stop and value is None:
                 value = StopIteration
-              history.append(value)
-              if len(history) > length:
-                history = history[1:]
-            if exhausted:
-              resume = self.resume_index(history, i)
-              f.seek(0)
-              del history
-          if exhausted:
+              resume = None
+          if not record or record[1] is None:
+            if resume is None:
+              resume = self.resume_index(list(history), i)
             # Disable the cache temporarily to prevent caching subresults *in* `func`.
             log_ = log.RecordLog()
             with disable(), log.add(log_):
@@ -395,14 +849,25 @@ class Recursion(types.Immutable, metaclass=_RecursionMeta):
               except Exception as e:
                 stop = True
                 value = e
-            log.debug('[cache.Recursion {}.{}] store'.format(hkey, i))
-            pickle.dump((log_, stop, value), f)
+              else:
+                stop = False
+            if not record: # append to the log unless the item was dropped by compaction
+              log.debug('[cache.Recursion {}.{:04d}] store'.format(hkey, i))
+              reclog.append(i, store.dumps((log_, stop, value), entry))
+              if store.checkpoint and i and i % store.checkpoint == 0:
+                n = i
+                for dropped in reclog.compact(lambda j: j % store.checkpoint >= store.checkpoint - length or j > n - length):
+                  for segment in cachepath.glob(_segment(cachepath/'{:04d}'.format(dropped), '*').name):
+                    segment.unlink()
         if not stop:
           yield value
         elif isinstance(value, StopIteration):
           return
         else:
           raise value
+        history.append(value)
+        if len(history) > length:
+          history = history[1:]
 
   def resume_index(self, history, index):
     '''
@@ -418,4 +883,54 @@ class Recursion(types.Immutable, metaclass=_RecursionMeta):
     '''
     raise NotImplementedError
 
+def _parsesize(value):
+  # parse a size in bytes with optional suffix k, M, G or T (powers of 1024)
+  value = value.strip()
+  scale = 1024**('kMGT'.index(value[-1])+1) if value[-1:] in tuple('kMGT') else 1
+  return int(float(value[:-1] if scale > 1 else value) * scale)
+
+def _formatsize(size):
+  for suffix in '', 'k', 'M', 'G':
+    if size < 1024:
+      break
+    size /= 1024
+  else:
+    suffix = 'T'
+  return '{:.1f}{}B'.format(size, suffix) if suffix else '{}B'.format(size)
+
+def _main(*args):
+  '''
+  Maintenance of a cache directory: print statistics, or remove entries that
+  have not been used for a given number of days and least recently used
+  entries that exceed a given total size.
+  '''
+
+  import argparse
+  parser = argparse.ArgumentParser(prog='python -m nutils.cache', description=_main.__doc__.strip())
+  commands = parser.add_subparsers(dest='command')
+  commands.required = True
+  commands.add_parser('stats', help='print the number, size and age of the cache entries').add_argument('cachedir')
+  prune = commands.add_parser('prune', help='remove old or least recently used cache entries')
+  prune.add_argument('cachedir')
+  prune.add_argument('--maxsize', type=_parsesize, help='upper bound of the total size, e.g. 10G')
+  prune.add_argument('--maxage', type=float, help='remove entries not used for this many days')
+  ns = parser.parse_args(args or None)
+  path = pathlib.Path(ns.cachedir)
+  if not path.is_dir():
+    parser.error('no such directory: {}'.format(path))
+  store = _Store(path)
+  if ns.command == 'stats':
+    entries = store.entries()
+    nrecursion = sum((path/name).is_dir() for name in entries)
+    print('{} entries ({} function, {} recursion), {} in total'.format(len(entries), len(entries)-nrecursion, nrecursion, _formatsize(sum(size for size, atime in entries.values()))))
+    if entries:
+      atimes = [atime for size, atime in entries.values()]
+      print('last used between {:.1f} and {:.1f} days ago'.format((time.time()-max(atimes))/86400, (time.time()-min(atimes))/86400))
+  else:
+    n, size = store.prune(maxsize=ns.maxsize, maxage=None if ns.maxage is None else ns.maxage * 86400)
+    print('removed {} entries, {}'.format(n, _formatsize(size)))
+
+if __name__ == '__main__':
+  _main()
+
 # vim:sw=2:sts=2:et
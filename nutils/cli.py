@@ -250,6 +250,7 @@ def run(func, *, args=None, loaduserconfig=True):
         setupargs.update(_load_rcfile(path))
     for key, typ in (('matrix', str),
                      ('nprocs', int),
+                     ('parallel', str),
                      ('cachedir', str),
                      ('cache', bool),
                      ('outrootdir', str),
@@ -306,6 +307,7 @@ def setup(scriptname: str,
           cachedir: str = 'cache',
           cache: bool = False,
           nprocs: int = 1,
+          parallel: str = 'fork',
           matrix: str = 'auto',
           richoutput: typing.Optional[bool] = None,
           outrooturi: typing.Optional[str] = None,
@@ -347,6 +349,7 @@ def setup(scriptname: str,
        warnings.via(treelog.warning), \
        _cache.enable(os.path.join(outdir, cachedir)) if cache else _cache.disable(), \
        _parallel.maxprocs(nprocs), \
+       _parallel.method(parallel), \
        _matrix.backend(matrix), \
        _signal_handler(signal.SIGINT, functools.partial(_breakpoint, richoutput)):
 
@@ -214,7 +214,7 @@ class Evaluable(types.Singleton):
   'Base class'
 
   __slots__ = '__args',
-  __cache__ = 'dependencies', 'ordereddeps', 'dependencytree'
+  __cache__ = 'dependencies', 'ordereddeps', 'dependencytree', 'liveness', 'evalargkeys', 'compile'
 
   @types.apply_annotations
   def __init__(self, args:types.tuple[strictevaluable]):
@@ -238,6 +238,20 @@ class Evaluable(types.Singleton):
   def isconstant(self):
     return EVALARGS not in self.dependencies
 
+  _evalargkey = None # name of the evaluation argument that is accessed directly, None if unknown
+
+  @property
+  def evalargkeys(self):
+    '''set of names of the evaluation arguments that this function depends
+    on, or None if this cannot be determined'''
+    keys = set()
+    for func in self.__args:
+      funckeys = {self._evalargkey} if func is EVALARGS else func.evalargkeys
+      if funckeys is None or None in funckeys:
+        return None
+      keys.update(funckeys)
+    return frozenset(keys)
+
   @property
   def ordereddeps(self):
     '''collection of all function arguments such that the arguments to
@@ -258,6 +272,21 @@ class Evaluable(types.Singleton):
   def serialized(self):
     return zip(self.ordereddeps[1:]+(self,), self.dependencytree[1:])
 
+  @property
+  def liveness(self):
+    '''lookup table of intermediate values that are no longer needed, such
+    that after evaluation of ordereddeps[i] all values ordereddeps[j] for j in
+    liveness[i] can be released; entries refer to the same indices as
+    dependencytree, excluding the evaluation arguments and the final value'''
+    lastuse = {}
+    for i, indices in enumerate(self.dependencytree[1:], start=1):
+      lastuse.update(dict.fromkeys(indices, i))
+    lastuse.pop(0, None) # evalargs are owned by the caller
+    dead = [[] for i in range(len(self.dependencytree))]
+    for j, i in lastuse.items():
+      dead[i].append(j)
+    return tuple(map(tuple, dead))
+
   def asciitree(self, richoutput=False):
     'string representation'
 
@@ -304,37 +333,90 @@ class Evaluable(types.Singleton):
     else:
       return values[-1]
 
+  def compile(self):
+    '''Compile function into a straight-line Python function.
+
+    The returned callable is equivalent to :meth:`eval` but avoids the
+    bookkeeping of the serialized interpreter loop by generating Python source
+    with one local variable per node and a direct ``evalf`` call per line.
+    Intermediate values are deleted directly after their last use, as
+    determined by :attr:`liveness`, to limit peak memory.
+    '''
+
+    names = ['evalargs']
+    lines = ['def compiled(**evalargs):', '  try:']
+    globals_ = dict(fallback=self.eval)
+    for i, ((op, indices), dead) in enumerate(zip(self.serialized, self.liveness[1:]), start=1):
+      f = 'f{}'.format(i)
+      globals_[f] = op.evalf
+      names.append('v{}'.format(i))
+      lines.append('    {} = {}({})'.format(names[-1], f, ', '.join(names[j] for j in indices)))
+      if dead: # release intermediate values directly after their last use
+        lines.append('    del {}'.format(', '.join(names[j] for j in dead)))
+    lines.append('  except KeyboardInterrupt:')
+    lines.append('    raise')
+    lines.append('  except Exception:')
+    lines.append('    fallback(**evalargs) # reevaluate to raise EvaluationError with full stack')
+    lines.append('    raise')
+    lines.append('  return {}'.format(names[-1]))
+    exec('\n'.join(lines), globals_)
+    compiled = globals_['compiled']
+    compiled.__reduce__ = lambda: (operator.methodcaller('compile'), (self,)) # pickle as graph, see parallel.pool
+    return compiled
+
   def eval_withtimes(self, **evalargs):
     '''Evaluate function on a specified element, point set while measure time of each step.'''
 
+    retval, times, memory = self.eval_withstats(**evalargs)
+    return retval, times
+
+  def eval_withstats(self, **evalargs):
+    '''Evaluate function on a specified element, point set while measuring
+    the time of each step, as well as the peak number of bytes held in
+    intermediate arrays with and without releasing values after their last
+    use.'''
+
     serialized = self.serialized # prepare lazy attribute to exclude evaluation time
+    liveness = self.liveness
     values = [(evalargs, time.perf_counter())]
+    nbytes = [0]
+    live = peak = total = 0
     try:
-      values.extend((op.evalf(*[values[i][0] for i in indices]), time.perf_counter()) for op, indices in serialized)
+      for (op, indices), dead in zip(serialized, liveness[1:]):
+        value = op.evalf(*[values[i][0] for i in indices])
+        values.append((value, time.perf_counter()))
+        nbytes.append(value.size * value.dtype.itemsize if numeric.isarray(value) else 0)
+        live += nbytes[-1]
+        total += nbytes[-1]
+        peak = max(peak, live)
+        live -= builtins.sum(nbytes[i] for i in dead)
     except KeyboardInterrupt:
       raise
     except Exception as e:
       raise EvaluationError(self, [v for v, t in values]) from e
     else:
-      return values[-1][0], numpy.diff([t for v, t in values])
+      return values[-1][0], numpy.diff([t for v, t in values]), (peak, total)
 
   @contextlib.contextmanager
   def session(self, graphviz):
     if graphviz is None:
-      yield self.eval
+      yield self.compile()
       return
     lock = parallel.multiprocessing.Lock()
     times = parallel.shzeros(len(self.dependencies))
+    memory = parallel.shzeros(2, dtype=int)
     def eval(**args):
-      retval, _times = self.eval_withtimes(**args)
+      retval, _times, _memory = self.eval_withstats(**args)
       with lock:
         times[:] += _times
+        numpy.maximum(memory, _memory, out=memory)
       return retval
     with log.context('eval'):
       yield eval
       log.info('total time: {:.0f}ms\n'.format(builtins.sum(times)*1000) + '\n'.join('{:4.0f} {} ({})'.format(builtins.sum(dts)*1000, op.__name__,
         '1 call' if len(dts) == 1 else '{} calls, {:.0f}..{:.0f} per call'.format(len(dts), min(dts)*1000, max(dts)*1000))
           for op, dts in sorted(util.gather(zip(map(type, self.ordereddeps[1:]+(self,)), times)), reverse=True, key=lambda row: builtins.sum(row[1]))))
+      log.info('peak memory of intermediates: {:,d}k, {:,d}k without release after last use'.format(*(memory+1023)//1024))
       self.graphviz(graphviz, times=times)
 
   def graphviz(self, dotpath='dot', *, imgtype='png', times=None):
@@ -470,6 +552,8 @@ class SelectChain(TransformChain):
     self.n = n
     super().__init__(args=[EVALARGS])
 
+  _evalargkey = '_transforms'
+
   def evalf(self, evalargs):
     trans = evalargs['_transforms'][self.n]
     assert isinstance(trans, tuple)
@@ -814,6 +898,8 @@ class NPoints(Array):
   def __init__(self):
     super().__init__(args=[EVALARGS], shape=(), dtype=int)
 
+  _evalargkey = '_points'
+
   def evalf(self, evalargs):
     points = evalargs['_points'].coords
     return types.frozenarray(points.shape[0])
@@ -825,6 +911,8 @@ class Points(Array):
   def __init__(self, npoints, ndim):
     super().__init__(args=[EVALARGS], shape=(npoints, ndim), dtype=float)
 
+  _evalargkey = '_points'
+
   def evalf(self, evalargs):
     points = evalargs['_points'].coords
     assert numeric.isarray(points) and points.ndim == 2
@@ -837,6 +925,8 @@ class Weights(Array):
   def __init__(self, npoints):
     super().__init__(args=[EVALARGS], shape=(npoints,), dtype=float)
 
+  _evalargkey = '_points'
+
   def evalf(self, evalargs):
     weights = evalargs['_points'].weights
     assert numeric.isarray(weights) and weights.ndim == 1
@@ -2265,8 +2355,8 @@ class Inflate(Array):
     assert axis1 < axis2
     if axis2 == self.ndim-1:
       func = _take(self.func, self.dofmap, axis1)
-      for i in range(self.dofmap.ndim):
-        func = _takediag(func, axis1, axis2-i)
+      for i in range(self.dofmap.ndim): # pair the taken dofmap axes with the trailing dofmap axes of func
+        func = _takediag(func, axis1, axis2+self.dofmap.ndim-1-i)
       return Inflate(func, self.dofmap, self.length)
     else:
       return _inflate(_takediag(self.func, axis1, axis2), self.dofmap, self.length, self.ndim-3)
@@ -2507,6 +2597,10 @@ class Argument(DerivativeTargetBase):
     self._name = name
     super().__init__(args=[EVALARGS], shape=shape, dtype=dtype)
 
+  @property
+  def _evalargkey(self):
+    return self._name
+
   def evalf(self, evalargs):
     try:
       value = evalargs[self._name]
@@ -2804,6 +2898,40 @@ class AssertEqual(Array):
     if len(set(self._args)) == 1:
       return self._args[0]
 
+class Isolated(Array):
+  '''Placeholder for a separately evaluated subgraph.
+
+  The :class:`Isolated` array evaluates to the evaluation argument ``name``,
+  which is expected to hold the value of the subgraph that it replaces. Unlike
+  :class:`Argument` it is intended for evaluation only; see :func:`isolate`.
+
+  Args
+  ----
+  name : :class:`str`
+      The name of the evaluation argument.
+  shape : :class:`tuple`
+      The shape of the replaced subgraph.
+  dtype : :class:`type`
+      The dtype of the replaced subgraph.
+  '''
+
+  __slots__ = '_name'
+
+  @types.apply_annotations
+  def __init__(self, name:types.strictstr, shape:asshape, dtype:asdtype):
+    self._name = name
+    super().__init__(args=[EVALARGS], shape=shape, dtype=dtype)
+
+  @property
+  def _evalargkey(self):
+    return self._name
+
+  def evalf(self, evalargs):
+    return evalargs[self._name]
+
+  def __str__(self):
+    return '{} {!r} <{}>'.format(self.__class__.__name__, self._name, ','.join(map(str, self.shape)))
+
 class RevolutionAngle(Array):
   '''
   Pseudo coordinates of a :class:`nutils.topology.RevolutionTopology`.
@@ -3233,6 +3361,53 @@ def replace_arguments(value, arguments):
     assert value.shape == v.shape
     return v
 
+@replace
+def _replace_nodes(value, nodes):
+  if isinstance(value, Evaluable):
+    return nodes.get(value)
+
+def _islength(value):
+  return isinstance(value, Array) and value.ndim == 0 and value.dtype == int
+
+def isolate(func, exclude, prefix):
+  '''Isolate subgraphs that are independent of evaluation arguments.
+
+  Replace every maximal subgraph of ``func`` that does not depend on any of
+  the evaluation arguments ``exclude`` by an :class:`Isolated` placeholder.
+  Since the replaced subgraphs evaluate to the same value regardless of
+  ``exclude``, they can be evaluated once and supplied as evaluation
+  arguments to repeated evaluations of the edited function. Only non-constant
+  arrays are isolated, and only if all evaluation arguments that they depend
+  on can be determined. Integer scalars are left in place, as these may
+  serve as lengths in the shapes of other arrays.
+
+  Args
+  ----
+  func : :class:`Evaluable`
+      Function to be edited.
+  exclude : :class:`tuple` of :class:`str`
+      Names of evaluation arguments, such as ``'_transforms'`` or
+      ``'_points'``, that isolated subgraphs should not depend on.
+  prefix : :class:`str`
+      Prefix of the names of the :class:`Isolated` replacements.
+
+  Returns
+  -------
+  :class:`Evaluable`
+      The edited function.
+  :class:`dict`
+      Mapping of :class:`Isolated` names to isolated subgraphs.
+  '''
+
+  nodes = func.ordereddeps + (func,)
+  keys = [node.evalargkeys if isinstance(node, Array) and not isinstance(node, (Argument, Isolated)) and not node.isconstant and not _islength(node) else None for node in nodes]
+  isolated = [k is not None and k.isdisjoint(exclude) for k in keys]
+  roots = set(j for i, indices in enumerate(func.dependencytree) if not isolated[i] for j in indices if isolated[j])
+  if isolated[-1]:
+    roots.add(len(nodes)-1)
+  replacements = {nodes[i]: Isolated('{}{}'.format(prefix, n), nodes[i].shape, nodes[i].dtype) for n, i in enumerate(sorted(roots))}
+  return _replace_nodes(func, replacements) if replacements else func, {iso._name: node for node, iso in replacements.items()}
+
 if __name__ == '__main__':
   # Diagnostics for the development for simplify operations.
   simplify_priority = (
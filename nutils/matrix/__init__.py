@@ -30,7 +30,9 @@ from  .. import util, sparse, warnings
 import numpy, importlib, os
 
 from ._base import Matrix, MatrixError, BackendNotAvailable, ToleranceNotReached
-for cls in Matrix, MatrixError, BackendNotAvailable, ToleranceNotReached:
+from ._operator import Operator
+from ._block import BlockMatrix
+for cls in Matrix, MatrixError, BackendNotAvailable, ToleranceNotReached, Operator, BlockMatrix:
   cls.__module__ = __name__ # make it appear as if cls was defined here
 del cls # clean up for sphinx
 
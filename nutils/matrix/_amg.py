@@ -0,0 +1,227 @@
+# Copyright (c) 2014 Evalf
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+'''
+Smoothed aggregation algebraic multigrid, see :meth:`nutils.matrix.Matrix.getprecon`.
+
+The hierarchy is constructed from csr data only, using :class:`NumpyMatrix`
+as container for the prolongation and coarse grid operators, such that the
+preconditioner is available for all matrix backends.
+'''
+
+from ._base import MatrixError
+from ._numpy import NumpyMatrix, _matmat, _scalerows
+import numpy, treelog
+
+def _rowmax(A, values):
+  'maximum of ``values`` over the column indices of every row, zero for empty rows'
+
+  result = numpy.zeros(A.shape[0], dtype=values.dtype)
+  nonempty = A.rowptr[1:] > A.rowptr[:-1]
+  if nonempty.any():
+    result[nonempty] = numpy.maximum.reduceat(values[A.colidx], A.rowptr[:-1][nonempty])
+  return result
+
+def _strength(A, nodes, nnodes, theta):
+  '''symmetric strength of connection graph between nodes
+
+  The absolute values of the entries of ``A`` are summed per pair of nodes,
+  after which off-diagonal entry ``c_ij`` is considered strong if ``c_ij >
+  theta sqrt(c_ii c_jj)``.'''
+
+  C = NumpyMatrix._fromcoo(abs(A.data), nodes[A._rowidx], nodes[A.colidx], (nnodes, nnodes))
+  rowidx = C._rowidx
+  diag = C.diagonal()
+  strong = (rowidx != C.colidx) & (C.data > theta * numpy.sqrt(diag[rowidx] * diag[C.colidx]))
+  row = rowidx[strong]
+  col = C.colidx[strong]
+  return NumpyMatrix._fromcoo(numpy.ones(2*len(row), dtype=numpy.int8), numpy.concatenate([row, col]), numpy.concatenate([col, row]), C.shape)
+
+def _aggregate(S):
+  '''aggregate graph nodes around a distance-2 maximal independent set
+
+  Roots are selected in parallel rounds (Luby's algorithm on the squared
+  graph, with fixed pseudo-random weights): an undecided node becomes a root
+  if its weight is maximal among all undecided nodes within distance two,
+  after which these neighbourhoods are removed from the undecided set.
+  Every remaining node is subsequently joined with a neighbouring aggregate.
+  Returns the aggregate index per node and the number of aggregates.'''
+
+  n = S.shape[0]
+  weight = numpy.random.RandomState(0).permutation(n) + 1
+  undecided = numpy.ones(n, dtype=bool)
+  isroot = numpy.zeros(n, dtype=bool)
+  while undecided.any():
+    w = numpy.where(undecided, weight, 0)
+    m = numpy.maximum(w, _rowmax(S, w))
+    m = numpy.maximum(m, _rowmax(S, m))
+    newroots = undecided & (w == m)
+    isroot |= newroots
+    near = newroots | _rowmax(S, newroots)
+    undecided &= ~(near | _rowmax(S, near))
+  nagg = isroot.sum()
+  agg = numpy.full(n, -1)
+  agg[isroot] = numpy.arange(nagg)
+  for distance in 1, 2:
+    join = _rowmax(S, agg+1) - 1 # agg+1 is zero for unassigned nodes
+    unassigned = agg < 0
+    agg[unassigned] = join[unassigned]
+  assert (agg >= 0).all()
+  return agg, nagg
+
+def _tentative(agg, nagg, B):
+  '''tentative prolongator that interpolates near-nullspace vectors ``B``
+
+  The restriction of ``B`` to every aggregate is orthonormalized by modified
+  Gram-Schmidt, such that ``B = P R`` with ``P`` having orthonormal columns;
+  the factor ``R`` forms the near-nullspace of the coarse level. Columns that
+  vanish for lack of aggregate size are dropped. Returns ``P``, the coarse
+  ``B`` and the aggregate of every coarse dof, which forms its node.'''
+
+  n, k = B.shape
+  Q = numpy.array(B, dtype=float)
+  R = numpy.zeros((nagg, k, k))
+  for j in range(k):
+    for l in range(j):
+      r = numpy.bincount(agg, Q[:,l] * Q[:,j], minlength=nagg)
+      Q[:,j] -= Q[:,l] * r[agg]
+      R[:,l,j] = r
+    norm = numpy.sqrt(numpy.bincount(agg, Q[:,j]**2, minlength=nagg))
+    keep = norm > 1e-10 * numpy.sqrt(numpy.bincount(agg, B[:,j]**2, minlength=nagg))
+    Q[:,j] /= numpy.where(keep, norm, numpy.inf)[agg]
+    R[:,j,j] = numpy.where(keep, norm, 0)
+  keep = R[:,range(k),range(k)].ravel() != 0
+  P = NumpyMatrix(Q.ravel(), numpy.arange(n+1) * k, (agg[:,numpy.newaxis] * k + numpy.arange(k)).ravel(), nagg * k)
+  P = P.submatrix(numpy.ones(n, dtype=bool), keep)
+  return P, R.reshape(nagg * k, k)[keep], numpy.arange(nagg).repeat(k)[keep]
+
+def _spectralradius(A, scale, niter=15):
+  'power iteration estimate of the spectral radius of ``diag(scale) A``'
+
+  x = numpy.random.RandomState(0).uniform(.5, 1, size=A.shape[0])
+  rho = 0
+  for i in range(niter):
+    y = scale * (A @ x)
+    norm = numpy.linalg.norm(y)
+    if norm == 0:
+      break
+    rho = norm / numpy.linalg.norm(x)
+    x = y / norm
+  return rho
+
+def _jacobiweight(A):
+  'row weights of the damped jacobi smoother'
+
+  diag = A.diagonal()
+  if not diag.all():
+    raise MatrixError("building 'amg' preconditioner: diagonal has zero entries")
+  dinv = numpy.reciprocal(diag)
+  return 4 / 3 / _spectralradius(A, dinv) * dinv
+
+def amg(data, colidx, rowptr, *, nullspace=None, nodes=None, theta=0., maxcoarse=500, maxlevels=10, coarsesweeps=10):
+  '''smoothed aggregation multigrid V-cycle
+
+  Args
+  ----
+  data, colidx, rowptr : :class:`numpy.ndarray`
+      Matrix in compressed sparse row format.
+  nullspace : :class:`numpy.ndarray` or :any:`None`
+      Near-nullspace vectors of the operator as columns of an array, e.g. the
+      rigid body modes of an elasticity problem, restricted to the
+      unconstrained dofs. Defaults to the constant vector for every component
+      of the nodes.
+  nodes : :class:`numpy.ndarray` or :any:`None`
+      Node index of every dof. Dofs of the same node, such as the components
+      of a vector valued basis, are kept together in the aggregates. Defaults
+      to a separate node per dof.
+  theta : :class:`float`
+      Strength of connection threshold.
+  maxcoarse : :class:`int`
+      Size below which the operator is no longer coarsened but inverted.
+  maxlevels : :class:`int`
+      Maximum number of levels in the hierarchy.
+  coarsesweeps : :class:`int`
+      Number of damped jacobi sweeps that replace the inversion of the
+      coarsest operator if it is larger than ``maxcoarse``, which happens if
+      coarsening stalls or ``maxlevels`` is reached.
+
+  Returns
+  -------
+  :any:`callable`
+      Function that applies one V-cycle to a right hand side.
+  '''
+
+  A = NumpyMatrix(data, rowptr, colidx, len(rowptr)-1)
+  n = A.shape[0]
+  nodes = numpy.arange(n) if nodes is None else numpy.unique(nodes, return_inverse=True)[1]
+  nnodes = nodes.max() + 1 if n else 0
+  if nullspace is None: # constant vector per component
+    order = numpy.argsort(nodes, kind='stable')
+    component = numpy.empty(n, dtype=int)
+    component[order] = numpy.arange(n) - numpy.searchsorted(nodes[order], nodes[order])
+    B = numpy.zeros((n, component.max()+1 if n else 1))
+    B[numpy.arange(n), component] = 1
+  else:
+    B = numpy.asarray(nullspace, dtype=float).reshape(n, -1)
+  levels = []
+  while A.shape[0] > maxcoarse and len(levels) < maxlevels - 1:
+    agg, nagg = _aggregate(_strength(A, nodes, nnodes, theta))
+    if nagg > nnodes // 2: # insufficient coarsening
+      break
+    Ptent, B, nodes = _tentative(agg[nodes], nagg, B)
+    nnodes = nagg
+    weight = _jacobiweight(A)
+    P = Ptent - _scalerows(_matmat(A, Ptent), weight)
+    R = P.T
+    levels.append((A, weight, P, R))
+    A = _matmat(R, _matmat(A, P))
+  if A.shape[0] <= maxcoarse:
+    coarse = numpy.linalg.pinv(A.export('dense')).__matmul__
+  else: # densifying a large operator would exhaust memory
+    treelog.warning('amg coarsening stopped at {} dofs, using {} jacobi sweeps as coarse solver'.format(A.shape[0], coarsesweeps))
+    coarse = _smoother(A, _jacobiweight(A), coarsesweeps)
+  sizes = [level[0].shape[0] for level in levels] + [A.shape[0]]
+  complexity = (sum(len(level[0].data) for level in levels) + len(A.data)) / max(len(data), 1) # guard against a matrix without entries
+  treelog.info('amg hierarchy: {} dofs, operator complexity {:.2f}'.format(' > '.join(map(str, sizes)), complexity))
+
+  def cycle(rhs, ilevel=0):
+    if ilevel == len(levels):
+      return coarse(rhs)
+    A, weight, P, R = levels[ilevel]
+    weight = weight.reshape(weight.shape+(1,)*(rhs.ndim-1))
+    lhs = weight * rhs # pre-smoothing from zero initial guess
+    lhs += P @ cycle(R @ (rhs - A @ lhs), ilevel+1)
+    lhs += weight * (rhs - A @ lhs) # post-smoothing
+    return lhs
+
+  return cycle
+
+def _smoother(A, weight, nsweeps):
+  'damped jacobi iterations from zero initial guess'
+
+  def smooth(rhs):
+    w = weight.reshape(weight.shape+(1,)*(rhs.ndim-1))
+    lhs = w * rhs
+    for isweep in range(nsweeps-1):
+      lhs += w * (rhs - A @ lhs)
+    return lhs
+  return smooth
+
+# vim:sw=2:sts=2:et
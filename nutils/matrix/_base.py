@@ -19,7 +19,7 @@
 # THE SOFTWARE.
 
 from .. import numeric
-import abc, treelog, functools, numpy, collections
+import abc, treelog, functools, numpy, collections, hashlib
 
 class MatrixError(Exception):
   '''
@@ -41,6 +41,48 @@ class ToleranceNotReached(MatrixError):
     super().__init__('solver failed to reach tolerance')
     self.best = best
 
+class _PatternCache:
+  '''least recently used cache for data that depends on a sparsity pattern
+
+  Backends use this cache to reuse the symbolic stage of direct solvers for
+  matrices that share a sparsity pattern, such as the Jacobians of subsequent
+  Newton iterations. Keys are formed by :meth:`key` from the index arrays of
+  the pattern and any options that affect the cached data.
+  '''
+
+  def __init__(self, maxsize):
+    self.maxsize = maxsize
+    self._items = collections.OrderedDict()
+
+  @staticmethod
+  def key(*args):
+    h = hashlib.sha1()
+    for arg in args:
+      if isinstance(arg, numpy.ndarray):
+        h.update(repr((arg.shape, arg.dtype.str)).encode())
+        h.update(numpy.ascontiguousarray(arg).tobytes())
+      else:
+        h.update(repr(arg).encode())
+    return h.digest()
+
+  def get(self, key):
+    value = self._items.get(key)
+    if value is not None:
+      self._items.move_to_end(key)
+    return value
+
+  def __setitem__(self, key, value):
+    self._items[key] = value
+    self._items.move_to_end(key)
+    while len(self._items) > self.maxsize:
+      self._items.popitem(last=False)
+
+  def __len__(self):
+    return len(self._items)
+
+  def clear(self):
+    self._items.clear()
+
 class Matrix:
   'matrix base class'
 
@@ -181,6 +223,31 @@ class Matrix:
     lhs[J] += self.submatrix(I, J)._solver((rhs - self @ lhs)[I], solver, atol=atol, rtol=rtol, **solverargs)
     return lhs
 
+  def solve_many(self, rhs, *, lhs0=None, **kwargs):
+    '''Solve system for a sequence of right hand side vectors.
+
+    Identical to :func:`nutils.matrix.Matrix.solve`, except that ``rhs`` and
+    ``lhs0`` are sequences of vectors. All systems are solved in a single
+    call, such that direct solvers factorize the matrix once and perform the
+    back substitutions for all right hand sides together.
+
+    Returns
+    -------
+    :class:`list` of :class:`numpy.ndarray`
+        Left hand side vectors, one for every right hand side vector.
+    '''
+
+    rhs = [numpy.asarray(v, dtype=float) for v in rhs]
+    if not rhs:
+      return []
+    if any(v.shape != (self.shape[0],) for v in rhs):
+      raise MatrixError('right-hand side vectors do not match matrix shape')
+    if lhs0 is not None:
+      lhs0 = numpy.stack(lhs0, axis=1)
+      if lhs0.shape != (self.shape[1], len(rhs)):
+        raise MatrixError('expected one initial value vector per right-hand side vector')
+    return list(self.solve(numpy.stack(rhs, axis=1), lhs0=lhs0, **kwargs).T)
+
   def solve_leniently(self, *args, **kwargs):
     '''
     Identical to :func:`nutils.matrix.Matrix.solve`, but emit a warning in case
@@ -232,12 +299,40 @@ class Matrix:
     solve = self.getprecon(precon, **args, **preconargs)
     return solve(rhs)
 
-  def _solver_arnoldi(self, rhs, atol, precon='direct', truncate=None, preconargs={}, **args):
+  def _solver_arnoldi(self, rhs, atol, precon='direct', truncate=None, recycle=None, preconargs={}, **args):
     solve = self.getprecon(precon, **args, **preconargs)
     lhs = numpy.zeros_like(rhs)
     res = rhs
     resnorm = numpy.linalg.norm(res, axis=0).max()
     krylov = collections.deque(maxlen=truncate) # unlimited if truncate is None
+    if recycle and resnorm > atol: # augment the first search direction with those of earlier solves
+      for k in [solve(res), *recycle]:
+        if k.shape != rhs.shape:
+          continue
+        k = numpy.array(k, dtype=float)
+        v = self @ k
+        v2 = numpy.square(v, order='F').sum(0)
+        for k_, v_, v2_ in krylov:
+          c = numpy.multiply(v, v_, order='F').sum(0) / v2_
+          k -= k_ * c
+          v -= v_ * c
+        v2, v2in = numpy.square(v, order='F').sum(0), v2
+        if not (v2 > 1e-12 * v2in).all(): # (nearly) linearly dependent
+          continue
+        krylov.append((k, v, v2))
+        c = numpy.multiply(v, res, order='F').sum(0) / v2
+        lhs = lhs + k * c
+        res = res - v * c
+      if krylov:
+        res = rhs - self @ lhs
+        newresnorm = numpy.linalg.norm(res, axis=0).max()
+        if numpy.isfinite(newresnorm) and newresnorm < resnorm:
+          treelog.debug('residual decreased by {:.1f} orders using {} recycled vectors'.format(numpy.log10(resnorm/newresnorm), len(krylov)))
+          resnorm = newresnorm
+        else:
+          lhs = numpy.zeros_like(rhs)
+          res = rhs
+          krylov.clear()
     while resnorm > atol:
       k = solve(res)
       v = self @ k
@@ -247,7 +342,7 @@ class Matrix:
         c = numpy.multiply(v, v_, order='F').sum(0) / v2_
         k -= k_ * c
         v -= v_ * c
-      v2 = numpy.square(v, order='F').sum(0)
+      v2 = numpy.maximum(numpy.square(v, order='F').sum(0), numpy.finfo(float).tiny) # tiny guards columns with zero residual
       c = numpy.multiply(v, res, order='F').sum(0) / v2 # min_c |res - c v| => c = res.v / v.v
       newlhs = lhs + k * c
       res = rhs - self @ newlhs # recompute rather than update to avoid drift
@@ -258,6 +353,96 @@ class Matrix:
       lhs = newlhs
       resnorm = newresnorm
       krylov.append((k, v, v2))
+    if recycle is not None and krylov and rhs.ndim == 1:
+      # retain the harmonic ritz vectors that approximate the eigenvectors with
+      # the smallest eigenvalues, which dominate the iteration count: solve
+      # (A K y - theta K y) . A K = 0 or V^T K y = 1/theta V^T V y with V = A K
+      K, V, V2 = map(numpy.array, zip(*krylov))
+      mu, Y = numpy.linalg.eig((V @ K.T) / V2[:,numpy.newaxis])
+      recycle.clear()
+      recycle.append(lhs)
+      for i in numpy.argsort(-abs(mu))[:recycle.maxlen and recycle.maxlen-1]:
+        recycle.append((Y[:,i].real if mu[i].imag >= 0 else Y[:,i].imag) @ K)
+    return lhs
+
+  def _solver_cg(self, rhs, atol, precon=None, maxiter=None, preconargs={}, **args):
+    '''preconditioned conjugate gradient method for symmetric positive definite matrices'''
+
+    if rhs.ndim > 1:
+      return numpy.stack([self._solver_cg(rhs_, atol, precon, maxiter, preconargs, **args) for rhs_ in rhs.reshape(len(rhs), -1).T], axis=1).reshape(rhs.shape)
+    solve = self.getprecon(precon, **args, **preconargs) if precon is not None else numpy.array
+    if maxiter is None:
+      maxiter = 10 * len(rhs)
+    lhs = numpy.zeros(rhs.shape)
+    res = numpy.array(rhs, dtype=float)
+    z = solve(res)
+    p = z.copy()
+    rz = res.dot(z)
+    resnorm = rhsnorm = numpy.linalg.norm(res)
+    niter = 0
+    with treelog.context('cg {:.0f}%', 0) as format:
+      while resnorm > atol and niter < maxiter:
+        niter += 1
+        q = self @ p
+        alpha = rz / p.dot(q)
+        lhs += alpha * p
+        res -= alpha * q
+        resnorm = numpy.linalg.norm(res)
+        if not numpy.isfinite(resnorm):
+          raise MatrixError('cg diverged; matrix is possibly not positive definite')
+        if atol:
+          format(100 * numpy.log(rhsnorm/max(resnorm, atol)) / numpy.log(rhsnorm/atol))
+        z = solve(res)
+        rz, rzprev = res.dot(z), rz
+        p *= rz / rzprev
+        p += z
+    treelog.debug('performed {} cg iterations'.format(niter))
+    return lhs
+
+  def _solver_gmres(self, rhs, atol, precon=None, restart=50, maxiter=None, preconargs={}, **args):
+    '''right-preconditioned generalized minimal residual method with restarts'''
+
+    if rhs.ndim > 1:
+      return numpy.stack([self._solver_gmres(rhs_, atol, precon, restart, maxiter, preconargs, **args) for rhs_ in rhs.reshape(len(rhs), -1).T], axis=1).reshape(rhs.shape)
+    solve = self.getprecon(precon, **args, **preconargs) if precon is not None else numpy.array
+    if maxiter is None:
+      maxiter = 10 * len(rhs)
+    restart = min(restart, len(rhs))
+    lhs = numpy.zeros(rhs.shape)
+    res = numpy.array(rhs, dtype=float)
+    resnorm = rhsnorm = numpy.linalg.norm(res)
+    niter = 0
+    with treelog.context('gmres {:.0f}%', 0) as format:
+      while resnorm > atol and niter < maxiter:
+        V = numpy.empty((restart+1, len(rhs))) # orthonormal krylov basis
+        Z = numpy.empty((restart, len(rhs))) # preconditioned krylov basis
+        H = numpy.zeros((restart+1, restart)) # hessenberg matrix
+        V[0] = res / resnorm
+        for j in range(restart):
+          Z[j] = solve(V[j])
+          w = self @ Z[j]
+          for i in range(j+1): # orthogonalize w (modified Gram-Schmidt)
+            H[i,j] = w.dot(V[i])
+            w -= H[i,j] * V[i]
+          H[j+1,j] = numpy.linalg.norm(w)
+          e = numpy.zeros(j+2)
+          e[0] = resnorm
+          y = numpy.linalg.lstsq(H[:j+2,:j+1], e, rcond=None)[0]
+          estimate = numpy.linalg.norm(H[:j+2,:j+1] @ y - e)
+          niter += 1
+          if atol:
+            format(100 * numpy.log(rhsnorm/max(estimate, atol)) / numpy.log(rhsnorm/atol))
+          if estimate <= atol or H[j+1,j] <= estimate * 1e-14 or niter == maxiter:
+            break
+          V[j+1] = w / H[j+1,j]
+        newlhs = lhs + y @ Z[:j+1]
+        res = rhs - self @ newlhs # recompute rather than update to avoid drift
+        newresnorm = numpy.linalg.norm(res)
+        if not numpy.isfinite(newresnorm) or newresnorm >= resnorm:
+          break
+        lhs = newlhs
+        resnorm = newresnorm
+    treelog.debug('performed {} gmres iterations, {} restarts'.format(niter, (niter-1)//restart))
     return lhs
 
   def submatrix(self, rows, cols):
@@ -331,7 +516,27 @@ class Matrix:
     diag = self.diagonal()
     if not diag.all():
       raise MatrixError("building 'diag' preconditioner: diagonal has zero entries")
-    return numpy.reciprocal(diag).__mul__
+    scale = numpy.reciprocal(diag)
+    return lambda rhs: numpy.multiply(scale.reshape(scale.shape+(1,)*(rhs.ndim-1)), rhs) # a bound __mul__ is prone to numpy's in-place temporary elision
+
+  def _precon_blockjacobi(self, blocksize=16):
+    data, (row, col) = self.export('coo')
+    n = self.shape[0]
+    nblocks = -(-n // blocksize)
+    inblock = row // blocksize == col // blocksize
+    blocks = numpy.zeros((nblocks*blocksize, blocksize))
+    blocks[row[inblock], col[inblock] % blocksize] = data[inblock]
+    blocks[numpy.arange(n, nblocks*blocksize), numpy.arange(n, nblocks*blocksize) % blocksize] = 1 # pad last block with identity
+    inverse = numpy.linalg.inv(blocks.reshape(nblocks, blocksize, blocksize))
+    def precon(rhs):
+      padded = numpy.zeros((nblocks*blocksize,)+rhs.shape[1:])
+      padded[:n] = rhs
+      return numpy.einsum('bij,bj...->bi...', inverse, padded.reshape(nblocks, blocksize, *rhs.shape[1:])).reshape(padded.shape)[:n]
+    return precon
+
+  def _precon_amg(self, **args):
+    from ._amg import amg
+    return amg(*self.export('csr'), **args)
 
   def __repr__(self):
     return '{}<{}x{}>'.format(type(self).__qualname__, *self.shape)
@@ -0,0 +1,205 @@
+# Copyright (c) 2014 Evalf
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from ._base import Matrix, MatrixError
+from ._numpy import NumpyMatrix, _matmat, _scalerows
+from .. import numeric
+import numpy, functools, operator
+
+class BlockMatrix(Matrix):
+  '''matrix composed of separately stored blocks
+
+  Block matrices arise in multi-field problems, such as the velocity and
+  pressure fields of a flow problem, with a block per pair of fields.
+  Products, linear combinations and submatrices are formed blockwise, and
+  the block structure is available to the 'blocktriangular' and 'schur'
+  preconditioners. All other solvers and preconditioners operate on the
+  blocks merged into a single matrix.
+
+  Args
+  ----
+  blocks : :class:`list` of :class:`list` of :class:`Matrix`
+      Blocks per block row. The blocks of a block row share the number of
+      rows, the blocks of a block column the number of columns.
+  '''
+
+  def __init__(self, blocks):
+    self.blocks = tuple(map(tuple, blocks))
+    if not self.blocks or len(set(map(len, self.blocks))) != 1 or not self.blocks[0]:
+      raise MatrixError('inconsistent block structure')
+    self.rowsizes = tuple(row[0].shape[0] for row in self.blocks)
+    self.colsizes = tuple(block.shape[1] for block in self.blocks[0])
+    if any(block.shape != (nrows, ncols) for row, nrows in zip(self.blocks, self.rowsizes) for block, ncols in zip(row, self.colsizes)):
+      raise MatrixError('block sizes do not match')
+    self._rowoffsets = numpy.cumsum((0,)+self.rowsizes)
+    self._coloffsets = numpy.cumsum((0,)+self.colsizes)
+    self._merged = None
+    super().__init__((int(self._rowoffsets[-1]), int(self._coloffsets[-1])))
+
+  def __reduce__(self):
+    return BlockMatrix, (self.blocks,)
+
+  def _blockwise(self, func, *others):
+    return BlockMatrix([[func(*blocks) for blocks in zip(*rows)] for rows in zip(self.blocks, *(other.blocks for other in others))])
+
+  def _merge(self):
+    '''blocks merged into a single matrix of the active backend'''
+
+    if self._merged is None:
+      from . import assemble
+      data, index = self.export('coo')
+      self._merged = assemble(data, numpy.array(index), self.shape)
+    return self._merged
+
+  def __add__(self, other):
+    if not isinstance(other, Matrix):
+      raise TypeError('cannot add {} to BlockMatrix'.format(type(other).__name__))
+    if self.shape != other.shape:
+      raise MatrixError('non-matching shapes')
+    if isinstance(other, BlockMatrix) and other.rowsizes == self.rowsizes and other.colsizes == self.colsizes:
+      return self._blockwise(operator.add, other)
+    return self._merge() + other
+
+  def __mul__(self, other):
+    if not numeric.isnumber(other):
+      raise TypeError
+    return self._blockwise(lambda block: block * other)
+
+  def __matmul__(self, other):
+    if not isinstance(other, numpy.ndarray):
+      raise TypeError
+    if other.shape[0] != self.shape[1]:
+      raise MatrixError
+    parts = numpy.split(other, self._coloffsets[1:-1])
+    return numpy.concatenate([functools.reduce(numpy.add, [block @ part for block, part in zip(row, parts)]) for row in self.blocks])
+
+  def __neg__(self):
+    return self._blockwise(operator.neg)
+
+  @property
+  def T(self):
+    return BlockMatrix([[block.T for block in col] for col in zip(*self.blocks)])
+
+  def export(self, form):
+    if form == 'dense':
+      return numpy.block([[block.export('dense') for block in row] for row in self.blocks])
+    if form == 'coo':
+      data, row, col = [], [], []
+      for blockrow, rowoffset in zip(self.blocks, self._rowoffsets):
+        for block, coloffset in zip(blockrow, self._coloffsets):
+          blockdata, (blockrow_, blockcol) = block.export('coo')
+          data.append(blockdata)
+          row.append(blockrow_ + rowoffset)
+          col.append(blockcol + coloffset)
+      data, row, col = map(numpy.concatenate, (data, row, col))
+      order = numpy.lexsort([col, row])
+      return data[order], (row[order], col[order])
+    if form == 'csr':
+      data, (row, col) = self.export('coo')
+      return data, col, row.searchsorted(numpy.arange(self.shape[0]+1))
+    raise NotImplementedError('cannot export BlockMatrix to {!r}'.format(form))
+
+  def rowsupp(self, tol=0):
+    return numpy.concatenate([numpy.any([block.rowsupp(tol) for block in row], axis=0) for row in self.blocks])
+
+  def diagonal(self):
+    if self.rowsizes != self.colsizes:
+      return self._merge().diagonal()
+    return numpy.concatenate([row[i].diagonal() for i, row in enumerate(self.blocks)])
+
+  def _submatrix(self, rows, cols):
+    rows = numpy.split(rows, self._rowoffsets[1:-1])
+    cols = numpy.split(cols, self._coloffsets[1:-1])
+    return BlockMatrix([[block.submatrix(r, c) for block, c in zip(row, cols)] for row, r in zip(self.blocks, rows)])
+
+  def _method(self, prefix, attr):
+    try:
+      return super()._method(prefix, attr)
+    except MatrixError:
+      return self._merge()._method(prefix, attr)
+
+  def _solver(self, rhs, solver, **solverargs):
+    if isinstance(solver, str) and not hasattr(self, '_solver_'+solver): # backend specific solver
+      return self._merge()._solver(rhs, solver, **solverargs)
+    return super()._solver(rhs, solver, **solverargs)
+
+  def _square_diagonal_blocks(self):
+    if self.rowsizes != self.colsizes:
+      raise MatrixError('block preconditioners require square diagonal blocks')
+
+  def _precon_blocktriangular(self, blockprecon='direct'):
+    '''upper block triangular preconditioner
+
+    The diagonal blocks are (approximately) inverted by preconditioner
+    ``blockprecon`` and the off-diagonal blocks above the diagonal are
+    retained, which is exact for block upper triangular matrices.
+    '''
+
+    self._square_diagonal_blocks()
+    return functools.partial(_backsubstitute, self.blocks, [row[i].getprecon(blockprecon) for i, row in enumerate(self.blocks)], self._rowoffsets)
+
+  def _precon_schur(self, split=1, blockprecon='direct', schurprecon='direct'):
+    '''block triangular Schur complement preconditioner
+
+    The matrix is partitioned in leading blocks ``A``, ``B`` and trailing
+    blocks ``C``, ``D`` after the first ``split`` block rows and columns,
+    for instance velocity and pressure. The preconditioner is the upper block
+    triangular matrix with diagonal blocks ``A``, inverted by preconditioner
+    ``blockprecon``, and the Schur complement ``D - C A^-1 B``, which is
+    approximated by ``D - C diag(A)^-1 B`` and inverted by preconditioner
+    ``schurprecon``.
+    '''
+
+    self._square_diagonal_blocks()
+    if not 0 < split < len(self.blocks):
+      raise MatrixError('schur preconditioner requires 0 < split < {}'.format(len(self.blocks)))
+    lead, trail = slice(None, split), slice(split, None)
+    (A, B), (C, D) = [[_join([row[cols] for row in self.blocks[rows]]) for cols in (lead, trail)] for rows in (lead, trail)]
+    diag = A.diagonal()
+    if not diag.all():
+      raise MatrixError("building 'schur' preconditioner: diagonal has zero entries")
+    S = _tonumpy(D) - _matmat(_scalerows(_tonumpy(C), numpy.reciprocal(diag)), _tonumpy(B))
+    from . import assemble
+    data, index = S.export('coo')
+    S = assemble(data, numpy.array(index), S.shape)
+    offsets = numpy.array([0, A.shape[0], self.shape[0]])
+    return functools.partial(_backsubstitute, ((A, B), (C, D)), [A.getprecon(blockprecon), S.getprecon(schurprecon)], offsets)
+
+def _join(blocks):
+  'single matrix from a nested list of blocks'
+
+  return blocks[0][0] if len(blocks) == len(blocks[0]) == 1 else BlockMatrix(blocks)
+
+def _tonumpy(mat):
+  data, colidx, rowptr = mat.export('csr')
+  return NumpyMatrix(data, rowptr, colidx, mat.shape[1])
+
+def _backsubstitute(blocks, solves, offsets, rhs):
+  'solve upper block triangular system with approximate inverses ``solves`` of the diagonal blocks'
+
+  lhs = [None] * len(blocks)
+  for i in reversed(range(len(blocks))):
+    res = rhs[offsets[i]:offsets[i+1]]
+    for j in range(i+1, len(blocks)):
+      res = res - blocks[i][j] @ lhs[j]
+    lhs[i] = solves[i](res)
+  return numpy.concatenate(lhs)
+
+# vim:sw=2:sts=2:et
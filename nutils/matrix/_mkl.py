@@ -18,12 +18,12 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from ._base import Matrix, MatrixError, BackendNotAvailable
+from ._base import Matrix, MatrixError, BackendNotAvailable, _PatternCache
 from .. import numeric, util, warnings
 from contextlib import contextmanager
 from ctypes import c_long, c_int, c_double, byref
 import treelog as log
-import os, numpy
+import os, numpy, weakref
 
 libmkl = util.loadlib(linux='libmkl_rt.so', darwin='libmkl_rt.dylib', win32='mkl_rt.dll')
 if not libmkl:
@@ -31,6 +31,9 @@ if not libmkl:
 
 os.environ.setdefault('MKL_THREADING_LAYER', 'TBB')
 
+_maxanalyses = 4 # maximum number of symbolic factorizations that are kept for reuse; numerical factorizations live only as long as their precon
+_analyses = _PatternCache(_maxanalyses)
+
 def assemble(data, index, shape):
   # In the increments below the output dtype is set to int32 not only to avoid
   # an additional allocation, but crucially also to avoid truncation in case
@@ -80,9 +83,31 @@ class Pardiso:
     self.iparm[27] = 0 # double precision data
     self.iparm[34] = 0 # one-based indexing
     self.iparm[36] = 0 # csr matrix format
-    self._phase(12) # analysis, numerical factorization
+    self._phase(11) # analysis
+    self._factorized = None
+    self.factorize(a)
     log.debug('peak memory use {:,d}k'.format(max(self.iparm[14], self.iparm[15]+self.iparm[16])))
 
+  def factorize(self, a):
+    '''numerical factorization of values ``a`` in the analysed sparsity pattern
+
+    The factorization is skipped if ``a`` is the most recently factorized
+    array, such that several solvers can share one analysis.
+    '''
+
+    if self._factorized is None or self._factorized() is not a:
+      self.a = a.ctypes
+      self._phase(22) # numerical factorization
+      self._factorized = weakref.ref(a)
+
+  def release(self, a):
+    '''release the numerical factorization of values ``a``, retaining the analysis'''
+
+    if self._factorized is not None and self._factorized() is a:
+      self._phase(0) # release memory for the factors
+      self.a = None
+      self._factorized = None
+
   def __call__(self, rhs):
     rhsflat = numpy.ascontiguousarray(rhs.reshape(rhs.shape[0], -1).T, dtype=numpy.float64)
     lhsflat = numpy.empty_like(rhsflat)
@@ -211,6 +236,8 @@ class MKLMatrix(Matrix):
     raise NotImplementedError('cannot export MKLMatrix to {!r}'.format(form))
 
   def _solver_fgmres(self, rhs, atol, maxiter=0, restart=150, precon=None, ztol=1e-12, preconargs={}, **args):
+    if rhs.ndim > 1:
+      return numpy.stack([self._solver_fgmres(rhs_, atol, maxiter, restart, precon, ztol, preconargs, **args) for rhs_ in rhs.reshape(len(rhs), -1).T], axis=1).reshape(rhs.shape)
     rci = c_int(0)
     n = c_int(len(rhs))
     b = numpy.array(rhs, dtype=numpy.float64)
@@ -267,7 +294,24 @@ class MKLMatrix(Matrix):
     log.debug('performed {} fgmres iterations, {} restarts'.format(ipar[3], ipar[3]//ipar[14]))
     return b
 
-  def _precon_direct(self, **args):
-    return Pardiso(mtype=11, a=self.data, ia=self.rowptr, ja=self.colidx, **args)
+  def _precon_direct(self, iparm={}, **args):
+    # Scaling (iparm[10]) and weighted matching (iparm[12]) are computed from
+    # the values of the analysed matrix, and would be stale for subsequent
+    # matrices that share the analysis. They are therefore disabled by
+    # default; if enabled explicitly, the analysis is keyed by the values.
+    iparm = {10: 0, 12: 0, **iparm}
+    key = _analyses.key(self.rowptr, self.colidx, sorted(iparm.items()), sorted(args.items()), self.data if iparm[10] or iparm[12] else None)
+    pardiso = _analyses.get(key)
+    if pardiso is None:
+      pardiso = _analyses[key] = Pardiso(mtype=11, a=self.data, ia=self.rowptr, ja=self.colidx, iparm=iparm, **args)
+    else:
+      log.debug('reusing symbolic factorization')
+      pardiso.factorize(self.data)
+    data = self.data
+    def precon(rhs):
+      pardiso.factorize(data) # refactorize if another matrix of the same pattern was factorized since
+      return pardiso(rhs)
+    weakref.finalize(precon, pardiso.release, data) # the cache retains only the analysis once the matrix or its precon is gone
+    return precon
 
 # vim:sw=2:sts=2:et
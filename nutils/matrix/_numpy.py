@@ -20,21 +20,54 @@
 
 from ._base import Matrix, MatrixError
 from .. import numeric
-import numpy, functools
+import numpy, functools, treelog
+
+# The direct solver factorizes a dense copy of the matrix; beyond this number
+# of rows (800MB at the limit) a warning suggests sparse alternatives.
+_maxdirect = 10000
 
 def assemble(data, index, shape):
-  array = numpy.zeros(shape, dtype=data.dtype)
-  if len(data):
-    array[tuple(index)] = data
-  return NumpyMatrix(array)
+  return NumpyMatrix(data, rowptr=index[0].searchsorted(numpy.arange(shape[0]+1)), colidx=index[1], ncols=shape[1])
+
+def _scalerows(A, scale):
+  return NumpyMatrix(A.data * scale[A._rowidx], A.rowptr, A.colidx, A.shape[1])
+
+def _matmat(A, B):
+  'product of two csr matrices'
+
+  counts = numpy.diff(B.rowptr)[A.colidx] # number of products per entry of A
+  offsets = numpy.arange(counts.sum()) - (counts.cumsum() - counts).repeat(counts)
+  index = B.rowptr[A.colidx].repeat(counts) + offsets
+  return NumpyMatrix._fromcoo(A.data.repeat(counts) * B.data[index], A._rowidx.repeat(counts), B.colidx[index], (A.shape[0], B.shape[1]))
 
 class NumpyMatrix(Matrix):
-  '''matrix based on numpy array'''
+  '''matrix based on compressed sparse row (csr) arrays'''
+
+  def __init__(self, data, rowptr, colidx, ncols):
+    assert len(data) == len(colidx) == rowptr[-1]
+    self.data = numpy.ascontiguousarray(data)
+    self.rowptr = numpy.ascontiguousarray(rowptr, dtype=numpy.intp)
+    self.colidx = numpy.ascontiguousarray(colidx, dtype=numpy.intp)
+    super().__init__((len(rowptr)-1, ncols))
+
+  @classmethod
+  def _fromcoo(cls, data, row, col, shape):
+    '''create matrix from unsorted coo data, summing duplicate entries'''
+
+    order = numpy.lexsort([col, row])
+    row = row[order]
+    col = col[order]
+    first = numpy.empty(len(order), dtype=bool)
+    first[:1] = True
+    numpy.not_equal(row[1:], row[:-1], out=first[1:])
+    first[1:] |= col[1:] != col[:-1]
+    first, = first.nonzero()
+    data = numpy.add.reduceat(data[order], first) if len(first) else data[:0]
+    return cls(data, row[first].searchsorted(numpy.arange(shape[0]+1)), col[first], shape[1])
 
-  def __init__(self, core):
-    assert numeric.isarray(core)
-    self.core = core
-    super().__init__(core.shape)
+  @property
+  def _rowidx(self):
+    return numpy.arange(self.shape[0]).repeat(numpy.diff(self.rowptr))
 
   def convert(self, mat):
     if not isinstance(mat, Matrix):
@@ -43,51 +76,79 @@ class NumpyMatrix(Matrix):
       raise MatrixError('non-matching shapes')
     if isinstance(mat, NumpyMatrix):
       return mat
-    return NumpyMatrix(mat.export('dense'))
+    data, colidx, rowptr = mat.export('csr')
+    return NumpyMatrix(data, rowptr, colidx, self.shape[1])
 
   def __add__(self, other):
-    return NumpyMatrix(self.core + self.convert(other).core)
-
-  def __sub__(self, other):
-    return NumpyMatrix(self.core - self.convert(other).core)
+    other = self.convert(other)
+    return self._fromcoo(numpy.concatenate([self.data, other.data]), numpy.concatenate([self._rowidx, other._rowidx]), numpy.concatenate([self.colidx, other.colidx]), self.shape)
 
   def __mul__(self, other):
     if not numeric.isnumber(other):
       raise TypeError
-    return NumpyMatrix(self.core * other)
+    return NumpyMatrix(self.data * other, self.rowptr, self.colidx, self.shape[1])
 
   def __matmul__(self, other):
     if not isinstance(other, numpy.ndarray):
       raise TypeError
     if other.shape[0] != self.shape[1]:
       raise MatrixError
-    return numpy.einsum('ij,j...->i...', self.core, other)
+    result = numpy.zeros(self.shape[:1]+other.shape[1:], dtype=numpy.result_type(self.data, other))
+    # Rows are summed by reduceat over the start offsets of all nonempty rows:
+    # since empty rows hold no entries, every interval then covers exactly the
+    # entries of a single row.
+    nonempty = self.rowptr[1:] > self.rowptr[:-1]
+    if nonempty.any():
+      products = self.data.reshape(self.data.shape+(1,)*(other.ndim-1)) * other[self.colidx]
+      result[nonempty] = numpy.add.reduceat(products, self.rowptr[:-1][nonempty], axis=0)
+    return result
 
   def __neg__(self):
-    return NumpyMatrix(-self.core)
+    return NumpyMatrix(-self.data, self.rowptr, self.colidx, self.shape[1])
 
   @property
   def T(self):
-    return NumpyMatrix(self.core.T)
+    order = numpy.argsort(self.colidx, kind='stable') # stable sort retains the order of rows per column
+    return NumpyMatrix(self.data[order], self.colidx[order].searchsorted(numpy.arange(self.shape[1]+1)), self._rowidx[order], self.shape[0])
 
   def export(self, form):
     if form == 'dense':
-      return self.core
-    if form == 'coo':
-      ij = self.core.nonzero()
-      return self.core[ij], ij
+      dense = numpy.zeros(self.shape, dtype=self.data.dtype)
+      dense[self._rowidx, self.colidx] = self.data
+      return dense
     if form == 'csr':
-      rows, cols = self.core.nonzero()
-      return self.core[rows, cols], cols, rows.searchsorted(numpy.arange(self.shape[0]+1))
+      return self.data, self.colidx, self.rowptr
+    if form == 'coo':
+      return self.data, (self._rowidx, self.colidx)
     raise NotImplementedError('cannot export NumpyMatrix to {!r}'.format(form))
 
   def rowsupp(self, tol=0):
-    return numpy.greater(abs(self.core), tol).any(axis=1)
+    supp = numpy.zeros(self.shape[0], dtype=bool)
+    supp[self._rowidx[abs(self.data) > tol]] = True
+    return supp
+
+  def diagonal(self):
+    if self.shape[0] != self.shape[1]:
+      raise MatrixError('failed to extract diagonal: matrix is not square')
+    rowidx = self._rowidx
+    isdiag = rowidx == self.colidx
+    diag = numpy.zeros(self.shape[0], dtype=self.data.dtype)
+    diag[rowidx[isdiag]] = self.data[isdiag]
+    return diag
 
   def _precon_direct(self):
-    return functools.partial(numpy.linalg.solve, self.core)
+    if self.shape[0] > _maxdirect:
+      treelog.warning('the direct solver of the numpy backend requires a dense {0}x{0} matrix, which may exhaust memory; '
+        "consider an iterative solver with a sparse preconditioner, e.g. solver='cg' or solver='gmres' with precon='blockjacobi', "
+        'or the scipy or mkl backend'.format(self.shape[0]))
+    else:
+      treelog.debug('direct solver requires a dense {}x{} matrix'.format(*self.shape))
+    return functools.partial(numpy.linalg.solve, self.export('dense'))
 
   def _submatrix(self, rows, cols):
-    return NumpyMatrix(self.core[numpy.ix_(rows, cols)])
+    keep = rows[self._rowidx] & cols[self.colidx]
+    rowidx = (rows.cumsum()-1)[self._rowidx[keep]]
+    colidx = (cols.cumsum()-1)[self.colidx[keep]]
+    return NumpyMatrix(self.data[keep], rowidx.searchsorted(numpy.arange(rows.sum()+1)), colidx, cols.sum())
 
 # vim:sw=2:sts=2:et
@@ -0,0 +1,121 @@
+# Copyright (c) 2014 Evalf
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from ._base import Matrix, MatrixError
+from .. import numeric
+import numpy, functools
+
+class Operator(Matrix):
+  '''matrix-free linear operator
+
+  The operator is defined by a callable that returns the product of the
+  matrix with a vector, such as a jacobian-vector product that is integrated
+  without assembling the jacobian. Since the matrix entries are unavailable,
+  the operator supports only products, linear combinations and submatrices,
+  and can be solved only with iterative solvers. Diagonal preconditioning is
+  supported if the diagonal is provided. Alternatively, all preconditioners
+  are formed from an assembled approximation of the matrix if one is provided.
+
+  Args
+  ----
+  matvec : callable
+      Function that maps a vector of length ``shape[1]`` to the product of
+      the matrix and the vector, of length ``shape[0]``.
+  shape : :class:`tuple` of two :class:`int`
+      Matrix shape.
+  diagonal : :class:`numpy.ndarray` or :any:`None`
+      Diagonal of the matrix, if available.
+  preconditioner : :class:`Matrix` or :any:`None`
+      Assembled approximation of the matrix, such as a lagged or low order
+      jacobian, that defines the preconditioners of the operator.
+  '''
+
+  def __init__(self, matvec, shape, diagonal=None, preconditioner=None):
+    if preconditioner is not None and preconditioner.shape != tuple(shape):
+      raise MatrixError('preconditioner shape does not match operator shape')
+    self._matvec = matvec
+    self._diagonal = diagonal
+    self._preconditioner = preconditioner
+    super().__init__(tuple(shape))
+
+  def _diagonal_or_none(self, other):
+    try:
+      return other.diagonal()
+    except (MatrixError, NotImplementedError):
+      return None
+
+  def __add__(self, other):
+    if not isinstance(other, Matrix):
+      raise TypeError('cannot add {} to Operator'.format(type(other).__name__))
+    if self.shape != other.shape:
+      raise MatrixError('non-matching shapes')
+    diag = self._diagonal_or_none(other) if self._diagonal is not None else None
+    return Operator(lambda x: self._matvec(x) + other @ x, self.shape, None if diag is None else self._diagonal + diag)
+
+  def __mul__(self, other):
+    if not numeric.isnumber(other):
+      raise TypeError
+    return Operator(lambda x: self._matvec(x) * other, self.shape, None if self._diagonal is None else self._diagonal * other, None if self._preconditioner is None else self._preconditioner * other)
+
+  def __matmul__(self, other):
+    if not isinstance(other, numpy.ndarray):
+      raise TypeError
+    if other.shape[0] != self.shape[1]:
+      raise MatrixError
+    if other.ndim == 1:
+      return self._matvec(other)
+    return numpy.stack([self._matvec(x) for x in other.reshape(len(other), -1).T], axis=1).reshape(self.shape[:1]+other.shape[1:])
+
+  def __neg__(self):
+    return self * -1
+
+  @property
+  def T(self):
+    raise NotImplementedError('cannot transpose matrix-free Operator')
+
+  def rowsupp(self, tol=0):
+    raise NotImplementedError('cannot determine row support of matrix-free Operator')
+
+  def diagonal(self):
+    if self.shape[0] != self.shape[1]:
+      raise MatrixError('failed to extract diagonal: matrix is not square')
+    if self._diagonal is None:
+      raise MatrixError('diagonal of Operator is unavailable')
+    return self._diagonal
+
+  def _submatrix(self, rows, cols):
+    def matvec(x):
+      y = numpy.zeros((self.shape[1],)+x.shape[1:], dtype=x.dtype)
+      y[cols] = x
+      return self._matvec(y)[rows]
+    diag = self._diagonal[rows] if self._diagonal is not None and numpy.equal(rows, cols).all() else None
+    return Operator(matvec, (rows.sum(), cols.sum()), diag, None if self._preconditioner is None else self._preconditioner.submatrix(rows, cols))
+
+  def _method(self, prefix, attr):
+    if prefix == 'precon' and self._preconditioner is not None and isinstance(attr, str):
+      # the assembled matrix caches its preconditioner, such that a lagged
+      # preconditioner is reused by all operators that share it
+      return functools.partial(self._preconditioner.getprecon, attr), attr
+    return super()._method(prefix, attr)
+
+  def _precon_direct(self):
+    raise MatrixError('direct solvers require an assembled matrix; select an iterative solver with for instance precon=\'diag\'')
+
+# vim:sw=2:sts=2:et
@@ -18,7 +18,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from ._base import Matrix, MatrixError, BackendNotAvailable
+from ._base import Matrix, MatrixError, BackendNotAvailable, _PatternCache
 from .. import numeric
 import treelog as log
 import numpy
@@ -27,6 +27,9 @@ try:
 except ImportError:
   raise BackendNotAvailable('the Scipy matrix backend requires scipy to be installed (try: pip install scipy)')
 
+_maxpermutations = 4 # maximum number of fill reducing permutations that are kept for reuse
+_permutations = _PatternCache(_maxpermutations)
+
 def assemble(data, index, shape):
   return ScipyMatrix(scipy.sparse.csr_matrix((data, index), shape))
 
@@ -89,7 +92,11 @@ class ScipyMatrix(Matrix):
     return super()._solver(rhs, solver, **kwargs)
 
   def _solver_scipy(self, rhs, method, atol, callback=None, precon=None, preconargs={}, **solverargs):
+    if rhs.ndim > 1:
+      return numpy.stack([self._solver_scipy(rhs_, method, atol, callback, precon, preconargs, **solverargs) for rhs_ in rhs.reshape(len(rhs), -1).T], axis=1).reshape(rhs.shape)
     rhsnorm = numpy.linalg.norm(rhs)
+    if rhsnorm <= atol: # e.g. a zero column of a multi-column right hand side
+      return numpy.zeros_like(rhs)
     solverfun = getattr(scipy.sparse.linalg, method)
     myrhs = rhs / rhsnorm # normalize right hand side vector for best control over scipy's stopping criterion
     mytol = atol / rhsnorm
@@ -108,7 +115,22 @@ class ScipyMatrix(Matrix):
     return mylhs * rhsnorm
 
   def _precon_direct(self):
-    return scipy.sparse.linalg.factorized(self.core.tocsc())
+    # The fill reducing column permutation of the first factorization of a
+    # sparsity pattern is reused for subsequent factorizations, which then
+    # skip the ordering stage.
+    csc = self.core.tocsc().asfptype()
+    csc.sort_indices()
+    key = _permutations.key(csc.indptr, csc.indices)
+    perm = _permutations.get(key)
+    if perm is None:
+      lu = scipy.sparse.linalg.splu(csc)
+      _permutations[key] = lu.perm_c
+      return lu.solve
+    log.debug('reusing fill reducing permutation')
+    # Factorizing the matrix with columns in the order of argsort(perm_c)
+    # reproduces the original factorization exactly, including the fill.
+    lu = scipy.sparse.linalg.splu(csc[:,numpy.argsort(perm)], permc_spec='NATURAL')
+    return lambda rhs: lu.solve(rhs)[perm]
 
   def _precon_splu(self):
     return scipy.sparse.linalg.splu(self.core.tocsc()).solve
@@ -19,16 +19,26 @@
 # THE SOFTWARE.
 
 """
-The parallel module provides tools aimed at parallel computing. At this point
-all parallel solutions use the ``fork`` system call and are supported on limited
-platforms, notably excluding Windows. On unsupported platforms parallel features
-will disable and a warning is printed.
+The parallel module provides tools aimed at parallel computing. Most parallel
+solutions use the ``fork`` system call and are supported on limited platforms,
+notably excluding Windows. On unsupported platforms parallel features will
+disable and a warning is printed. Loops that are written in terms of
+:func:`foreach` can alternatively run in threads, selected via :func:`method`
+or the ``NUTILS_PARALLEL`` environment variable, or in a :func:`pool` of
+persistent worker processes.
 """
 
-from . import numeric, warnings, util
-import os, multiprocessing, mmap, signal, contextlib, builtins, numpy, treelog
+from . import numeric, warnings, util, types
+import sys, os, multiprocessing, mmap, signal, contextlib, builtins, numpy, treelog, threading, concurrent.futures, pickle, io, weakref, traceback, inspect
+
+def _checkmethod(method):
+  if method not in ('fork', 'threads'):
+    raise ValueError('method should be either \'fork\' or \'threads\'')
+  return method
 
 _maxprocs = util.settable(int(os.environ.get('NUTILS_NPROCS') or 1))
+_method = util.settable(_checkmethod(os.environ.get('NUTILS_PARALLEL') or 'fork'))
+_pool = util.settable(None)
 
 @util.positional_only
 def maxprocs(new: int):
@@ -38,6 +48,17 @@ def maxprocs(new: int):
     raise ValueError('nprocs requires a positive integer argument')
   return _maxprocs.sets(new)
 
+def getmaxprocs():
+  '''return the number of processes or threads set by :func:`maxprocs`.'''
+
+  return _maxprocs.value
+
+@util.positional_only
+def method(new: str):
+  '''select parallelization method for :func:`foreach`: 'fork' or 'threads'.'''
+
+  return _method.sets(_checkmethod(new))
+
 @contextlib.contextmanager
 def fork(nprocs=None):
   '''continue as ``nprocs`` parallel processes by forking ``nprocs-1`` times
@@ -99,8 +120,10 @@ def shempty(shape, dtype=float):
     assert all(numeric.isint(sh) for sh in shape)
   dtype = numpy.dtype(dtype)
   size = util.product(map(int, shape), int(dtype.itemsize))
-  if size == 0 or _maxprocs.value == 1:
+  if size == 0 or _maxprocs.value == 1 or _method.value == 'threads':
     return numpy.empty(shape, dtype)
+  if _pool.value is not None:
+    return _pool.value.shempty(shape, dtype)
   # `mmap(-1,...)` will allocate *anonymous* memory.  Although linux' man page
   # mmap(2) states that anonymous memory is initialized to zero, we can't rely
   # on this to be true for all platforms (see [SO-mmap]).  [SO-mmap]:
@@ -115,30 +138,280 @@ def shzeros(shape, dtype=float):
   return array
 
 class range:
-  '''a shared range-like iterable that yields every index exactly once'''
+  '''a shared range-like iterable that yields every index exactly once
 
-  def __init__(self, stop):
+  Indices are claimed from a shared counter in chunks, such that the counter
+  is locked once per chunk rather than once per index. The ``chunksize`` is
+  either a positive integer for chunks of fixed size, or ``'guided'`` for
+  chunks that are proportional to the number of remaining indices, which
+  reduces locking to a logarithmic number of times while balancing the load
+  over processes.
+  '''
+
+  def __init__(self, stop, chunksize=1):
+    if chunksize != 'guided' and (not isinstance(chunksize, int) or chunksize < 1):
+      raise ValueError('chunksize should be a positive integer or \'guided\'')
     self._stop = stop
+    self._chunksize = chunksize
+    self._nprocs = _maxprocs.value
     self._index = multiprocessing.RawValue('i', 0)
     self._lock = multiprocessing.Lock() # lock to avoid race conditions in incrementing index
+    self._next = self._end = 0 # process-local chunk
+  def _reset(self, stop, chunksize, nprocs):
+    self._stop = stop
+    self._chunksize = chunksize
+    self._nprocs = nprocs
+    self._next = self._end = 0
   def __iter__(self):
     return self
   def __next__(self):
-    with self._lock:
-      iiter = self._index.value # claim next value
-      if iiter >= self._stop:
-        raise StopIteration
-      self._index.value = iiter + 1
+    if self._next == self._end:
+      with self._lock:
+        start = self._index.value # claim next chunk
+        if start >= self._stop:
+          raise StopIteration
+        chunksize = self._chunksize if self._chunksize != 'guided' else -(-(self._stop - start) // (2 * self._nprocs))
+        self._end = self._index.value = min(start + chunksize, self._stop)
+      self._next = start
+    iiter = self._next
+    self._next += 1
     return iiter
 
 @contextlib.contextmanager
-def ctxrange(name, nitems):
-  '''fork and yield shared range-like counter with percentage-style logging'''
+def ctxrange(name, nitems, chunksize=1):
+  '''fork and yield shared range-like counter with percentage-style logging
+
+  The ``chunksize`` argument is passed on to :class:`range`.
+  '''
 
-  rng = range(nitems) # shared range, must be created pre-fork
+  rng = range(nitems, chunksize) # shared range, must be created pre-fork
   with fork(nitems), treelog.iter.wrap(_pct(name, nitems), rng) as wrprng:
     yield wrprng
 
+def foreach(name, nitems, func, chunksize=1):
+  '''call ``func`` for every index in ``range(nitems)`` in parallel
+
+  Depending on the configured :func:`method`, the indices are distributed over
+  forked processes, as in :func:`ctxrange`, or over threads that share all
+  memory. Since the threads run concurrently only while not holding the global
+  interpreter lock, the latter is mostly suited for functions that spend their
+  time in numpy routines. In either case results should be communicated via
+  arrays created by :func:`shempty` or :func:`shzeros`, and the calls are
+  logged with percentage-style logging. In fork mode, indices are claimed in
+  chunks of ``chunksize`` as described in :class:`range`.
+  '''
+
+  nthreads = min(_maxprocs.value, nitems)
+  if _method.value != 'threads' or nthreads <= 1:
+    if nthreads > 1 and _pool.value is not None and _pool.value.run(name, nitems, func, chunksize):
+      return
+    with ctxrange(name, nitems, chunksize) as indices:
+      for i in indices:
+        func(i)
+    return
+  lock = threading.Lock() # lock to serialize iteration of the logging wrapper
+  failed = threading.Event() # event to stop all threads if one of them fails
+  def worker(indices):
+    while not failed.is_set():
+      with lock:
+        i = next(indices, None)
+      if i is None:
+        return
+      try:
+        func(i)
+      except:
+        failed.set()
+        raise
+  with treelog.iter.wrap(_pct(name, nitems), builtins.range(nitems)) as indices, \
+       maxprocs(1), \
+       concurrent.futures.ThreadPoolExecutor(nthreads) as executor:
+    futures = [executor.submit(worker, indices) for ithread in builtins.range(nthreads)]
+  for future in futures:
+    future.result() # reraise exceptions
+
+@contextlib.contextmanager
+def pool():
+  '''keep ``maxprocs-1`` worker processes alive for :func:`foreach`
+
+  Inside the context, :func:`foreach` loops in fork mode are distributed over
+  persistent worker processes rather than over processes that are forked
+  anew for every loop, saving the cost of forking as well as of the copy on
+  write faults that follow. Since the workers are forked at the start of the
+  context, they receive the loop functions by pickling. Any
+  :class:`nutils.types.Singleton`, such as samples and evaluables, is sent
+  only once to every worker and kept alive for the duration of the context,
+  while arrays created by :func:`shempty` are backed by named shared memory
+  and sent by reference. Loops over functions that cannot be pickled fall
+  back to forking, as do all loops on Python versions older than 3.8, which
+  lack named shared memory.
+  '''
+
+  if _maxprocs.value <= 1 or not hasattr(os, 'fork') or sys.version_info < (3, 8):
+    yield
+    return
+  pool = _Pool(_maxprocs.value)
+  try:
+    with _pool.sets(pool):
+      yield
+  finally:
+    pool.close()
+
+class _Pool:
+  '''persistent worker processes, see :func:`pool`'''
+
+  def __init__(self, nprocs):
+    import multiprocessing.shared_memory, multiprocessing.resource_tracker # python 3.8+, only loaded when a pool is used
+    self.nprocs = nprocs
+    self._range = range(0) # shared range, must be created pre-fork
+    self._objects = {} # singletons sent to workers by id, kept alive to keep ids unique
+    self._sent = [] # per worker set of ids of sent singletons
+    self._shared = weakref.WeakValueDictionary() # shared memory arrays by id
+    self._shmnames = {} # shared memory names by array id
+    self._conns = []
+    self._pids = []
+    multiprocessing.resource_tracker.ensure_running() # share a single tracker with the workers
+    for iproc in builtins.range(1, nprocs):
+      conn, childconn = multiprocessing.Pipe()
+      pid = os.fork()
+      if not pid: # pragma: no cover
+        conn.close()
+        signal.signal(signal.SIGINT, signal.SIG_IGN) # disable sigint (ctrl+c) handler
+        treelog.current = treelog.NullLog() # silence treelog
+        status = 1
+        try:
+          with maxprocs(1):
+            self._work(childconn)
+          status = 0
+        finally:
+          os._exit(status)
+      childconn.close()
+      self._conns.append(conn)
+      self._pids.append(pid)
+      self._sent.append(set())
+
+  def shempty(self, shape, dtype):
+    shm = multiprocessing.shared_memory.SharedMemory(create=True, size=util.product(map(int, shape), int(dtype.itemsize)))
+    array = numpy.ndarray(shape, dtype, buffer=shm.buf)
+    self._shared[id(array)] = array
+    self._shmnames[id(array)] = shm.name
+    weakref.finalize(array, self._release, shm, id(array))
+    return array
+
+  def _release(self, shm, arrayid):
+    self._shmnames.pop(arrayid, None)
+    try:
+      shm.close()
+    except BufferError: # views of the array are still alive; the mapping is released with them
+      pass
+    shm.unlink()
+
+  def run(self, name, nitems, func, chunksize):
+    '''run a :func:`foreach` loop in the pool, return False if func cannot be pickled'''
+
+    messages = []
+    for sent in self._sent:
+      newobjs = []
+      task = io.BytesIO()
+      try:
+        _Pickler(task, self, sent, newobjs).dump((nitems, chunksize, func))
+      except Exception:
+        return False
+      messages.append((newobjs, task.getvalue()))
+    for sent, (newobjs, task) in zip(self._sent, messages):
+      sent.update(objid for objid, blob in newobjs)
+    self._range._index.value = 0
+    self._range._reset(nitems, chunksize, self.nprocs)
+    for conn, message in zip(self._conns, messages):
+      conn.send(message)
+    try:
+      with treelog.iter.wrap(_pct(name, nitems), self._range) as indices, maxprocs(1):
+        for i in indices:
+          func(i)
+    except:
+      self._range._index.value = nitems # stop other processes
+      raise
+    finally:
+      errors = [conn.recv() for conn in self._conns]
+    errors = [error for error in errors if error]
+    if errors:
+      raise Exception('pool failed in {} out of {} processes:\n{}'.format(len(errors), self.nprocs, errors[0]))
+    return True
+
+  def _persistent_id(self, sent, newobjs, obj):
+    if isinstance(obj, types.Singleton):
+      objid = id(obj)
+      if objid not in sent and all(objid != i for i, blob in newobjs):
+        newobjs.append((objid, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)))
+        self._objects[objid] = obj
+      return 'object', objid
+    if isinstance(obj, numpy.ndarray) and self._shared.get(id(obj)) is obj:
+      return 'array', self._shmnames[id(obj)], obj.shape, obj.dtype
+
+  def _work(self, conn): # pragma: no cover
+    objects = {}
+    while True:
+      message = conn.recv()
+      if message is None:
+        return
+      newobjs, task = message
+      shms = []
+      try:
+        for objid, blob in newobjs:
+          objects[objid] = pickle.loads(blob)
+        self._runtask(task, objects, shms)
+      except BaseException:
+        error = traceback.format_exc()
+        self._range._index.value = self._range._stop # stop other processes
+      else:
+        error = None
+      for shm in shms:
+        try:
+          shm.close()
+        except BufferError: # the mapping is released with the last view
+          pass
+      conn.send(error)
+
+  def _runtask(self, task, objects, shms): # pragma: no cover
+    def persistent_load(pid):
+      if pid[0] == 'object':
+        return objects[pid[1]]
+      shm = multiprocessing.shared_memory.SharedMemory(pid[1]) # registers with the shared resource tracker, unregistered by the main process on unlink
+      shms.append(shm)
+      return numpy.ndarray(pid[2], pid[3], buffer=shm.buf)
+    unpickler = pickle.Unpickler(io.BytesIO(task))
+    unpickler.persistent_load = persistent_load
+    nitems, chunksize, func = unpickler.load()
+    self._range._reset(nitems, chunksize, self.nprocs)
+    for i in self._range:
+      func(i)
+
+  def close(self):
+    for conn in self._conns:
+      try:
+        conn.send(None)
+      except OSError:
+        pass
+    for pid in self._pids:
+      os.waitpid(pid, 0)
+    self._objects.clear()
+
+class _Pickler(pickle.Pickler):
+  '''pickler for pool tasks that sends singletons and shared arrays by reference'''
+
+  def __init__(self, file, pool, sent, newobjs):
+    super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+    self._pool = pool
+    self._sent = sent
+    self._newobjs = newobjs
+
+  def persistent_id(self, obj):
+    return self._pool._persistent_id(self._sent, self._newobjs, obj)
+
+  def reducer_override(self, obj):
+    if inspect.isfunction(obj) and '__reduce__' in obj.__dict__: # e.g. compiled evaluables
+      return obj.__reduce__()
+    return NotImplemented
+
 def _pct(name, n):
   '''helper function for ctxrange'''
 
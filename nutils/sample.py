@@ -45,10 +45,15 @@ efficiently combine common substructures.
 
 from . import types, points, util, function, evaluable, parallel, numeric, matrix, transformseq, sparse
 from .pointsseq import PointsSequence
-import numpy, numbers, collections.abc, os, treelog as log, abc
+import numpy, numbers, collections.abc, os, treelog as log, abc, functools, weakref
 
 graphviz = os.environ.get('NUTILS_GRAPHVIZ')
 
+_maxbatchsize = 1000 # maximum number of elements per batch of the element loops
+_batchesperproc = 4 # minimum number of batches per process, for load balancing
+_maxpointscache = 8 # maximum number of points objects for which pointwise subgraphs are memoized
+_maxintegrands = 8 # maximum number of prepared integrands that are kept for reuse
+
 def argdict(arguments):
   if len(arguments) == 1 and 'arguments' in arguments and isinstance(arguments['arguments'], collections.abc.Mapping):
     arguments = arguments['arguments']
@@ -196,24 +201,61 @@ class Sample(types.Singleton):
     if arguments is None:
       arguments = {}
 
-    # Functions may consist of several blocks, such as originating from
-    # chaining. Here we make a list of all blocks consisting of triplets of
-    # argument id, evaluable index, and evaluable values.
+    # The argument independent preparations, such as the optimization of
+    # blocks, are cached for reuse in subsequent evaluations of the same
+    # integrands, as is typical for iterative solvers.
 
-    blocks = [(ifunc, evaluable.Tuple(ind).optimized_for_numpy, f.optimized_for_numpy) for ifunc, func in enumerate(funcs) for ind, f in evaluable.blocks(func)]
-    block2func, indices, values = zip(*blocks) if blocks else ([],[],[])
+    integrands = _integrands(funcs)
+    block2func = integrands.block2func
+    indices = integrands.indices
+    trailingdims = integrands.trailingdims
 
-    log.debug('integrating {} distinct blocks'.format('+'.join(
-      str(block2func.count(ifunc)) for ifunc in range(len(funcs)))))
+    # If the sparsity pattern of the integrands does not depend on the
+    # arguments, it is cached per sample after the first evaluation, along
+    # with the offsets computed below. Subsequent evaluations then skip all
+    # index related work and evaluate values only.
+
+    pattern = integrands.patterns.get(self)
+
+    # The element loops below are distributed over batches of consecutive
+    # elements, for which the data of every block forms a contiguous interval.
+    # The evaluable graph is still evaluated once per element; batching only
+    # reduces the claims on the shared loop counter and allows the results to
+    # be scattered into the data arrays with one write per block.
+
+    batchsize = min(_maxbatchsize, -(-self.nelems // (_batchesperproc * parallel.getmaxprocs()))) or 1
+    nbatches = -(-self.nelems // batchsize)
+
+    # Element-invariant subgraphs are evaluated once, ahead of the element
+    # loop, and passed on to the element evaluations as arguments. Pointwise
+    # subgraphs are memoized per points object for the duration of the
+    # integration.
+
+    if integrands.hoisted:
+      arguments = dict(arguments, **dict(zip(integrands.hoisted, map(numpy.asarray, integrands.hoistedfunc(**arguments)))))
+    elemargs = _ElemArgs(arguments, integrands.pointwise, integrands.pointwisefunc)
+
+    # The loop bodies are module level functions, bound to their data via
+    # functools.partial, such that they can be sent to the workers of a
+    # parallel.pool.
+
+    if pattern is not None:
+      values = [parallel.shempty(n, dtype=func.dtype) for func, n in zip(funcs, pattern.nvals)]
+      with integrands.valuefunc.session(graphviz) as eval:
+        parallel.foreach('integrating', nbatches, functools.partial(_valuebatch, self, eval, elemargs, block2func, values, pattern.offsets, batchsize))
+      return pattern.assemble(values)
 
     # To allocate (shared) memory for all block data we evaluate indexfunc to
     # build an nblocks x nelems+1 offset array. In the first step the block
-    # sizes are evaluated.
+    # sizes are determined. If all blocks have a static shape the sizes follow
+    # directly; otherwise they are evaluated in a parallel loop over elements.
 
-    offsets = numpy.empty((len(blocks), self.nelems+1), dtype=numpy.uint64)
-    sizefunc = evaluable.Tuple([f.size for ifunc, ind, f in blocks]).optimized_for_numpy
-    for ielem, (*transforms, points) in enumerate(zip(*self.transforms, self.points)):
-      offsets[:,ielem+1] = sizefunc.eval(_transforms=transforms, _points=points, **arguments)
+    if integrands.sizes is not None:
+      offsets = numpy.empty((len(block2func), self.nelems+1), dtype=numpy.uint64)
+      offsets[:,1:] = integrands.sizes[:,numpy.newaxis]
+    else:
+      offsets = parallel.shempty((len(block2func), self.nelems+1), dtype=numpy.uint64)
+      parallel.foreach('sizing', nbatches, functools.partial(_sizebatch, self, integrands.sizefunc, arguments, offsets, batchsize))
 
     # In the second step the block sizes are accumulated to form offsets. Since
     # several blocks may belong to the same function, we post process the
@@ -228,26 +270,22 @@ class Sample(types.Singleton):
       assert (v[1:] >= v[:-1]).all(), 'integer overflow'
       nvals[ifunc] = v[-1]
 
-    # In a second, parallel element loop, value and index are evaluated and
-    # stored in shared memory using the offsets array for location. Each
-    # element has its own location so no locks are required.
+    # In a second, parallel loop, value and index are evaluated and stored in
+    # shared memory using the offsets array for location. Elementwise results
+    # are collected in plain (non-structured) batch buffers and scattered into
+    # the structured data arrays once per batch. Each batch has its own
+    # location so no locks are required.
 
     datas = [parallel.shempty(n, dtype=sparse.dtype(funcs[ifunc].shape, vtype=funcs[ifunc].dtype)) for ifunc, n in enumerate(nvals)]
-    trailingdims = [numpy.cumsum([0]+[ind.ndim for ind in index[:0:-1]])[::-1] for index in indices] # prepare index reshapes
 
-    with evaluable.Tuple(evaluable.Tuple([value, *index]) for value, index in zip(values, indices)).session(graphviz) as eval, \
-         parallel.ctxrange('integrating', self.nelems) as ielems:
+    with integrands.func.session(graphviz) as eval:
+      parallel.foreach('integrating', nbatches, functools.partial(_evalbatch, self, eval, elemargs, block2func, indices, trailingdims, datas, offsets, batchsize))
 
-      for ielem in ielems:
-        points = self.points[ielem]
-        for iblock, (intdata, *indices) in enumerate(eval(_transforms=tuple(t[ielem] for t in self.transforms), _points=points, **arguments)):
-          data = datas[block2func[iblock]][offsets[iblock,ielem]:offsets[iblock,ielem+1]].reshape(intdata.shape)
-          data['value'] = intdata
-          td = trailingdims[iblock]
-          for idim, ii in enumerate(indices):
-            data['index']['i'+str(idim)] = ii.reshape(ii.shape+(1,)*td[idim]) # note: this could be implemented using newaxis, but reshape appears to be faster
+    if not integrands.staticpattern:
+      return datas
 
-    return datas
+    pattern = integrands.patterns[self] = _Pattern(datas, offsets, nvals)
+    return pattern.assemble([data['value'] for data in datas])
 
   def integral(self, func):
     '''Create Integral object for postponed integration.
@@ -497,6 +535,55 @@ class Integral(types.Singleton):
     seen = {}
     return Integral({di: evaluable.derivative(integrand, var=target, seen=seen) for di, integrand in self._integrands.items()}, shape=self.shape+target.shape)
 
+  def linearize(self, target, direction):
+    '''Linearize integral in a given direction.
+
+    Return an Integral of the same shape in which all integrands are replaced
+    by their directional derivatives with respect to a target, in the
+    direction of a new argument. This allows the action of a jacobian on a
+    vector to be evaluated without assembling the jacobian, as used for
+    matrix-free solves: ``self.linearize('lhs', 'dlhs').eval(lhs=lhs,
+    dlhs=v)`` equals ``self.derivative('lhs').eval(lhs=lhs) @ v``.
+
+    Args
+    ----
+    target : :class:`str`
+        Name of the derivative target.
+    direction : :class:`str`
+        Name of the direction argument, which has the shape of the target.
+
+    Returns
+    -------
+    linearized : :class:`Integral`
+    '''
+
+    if isinstance(target, function.Argument):
+      target = target.prepare_eval()
+    elif not isinstance(target, evaluable.Argument):
+      target = evaluable.Argument(target, self.argshapes[target])
+    direction = evaluable.prependaxes(evaluable.Argument(direction, target.shape), self.shape)
+    axes = tuple(range(self.ndim, self.ndim + target.ndim))
+    seen = {}
+    return Integral({di: evaluable.dot(evaluable.derivative(integrand, var=target, seen=seen), direction, axes) for di, integrand in self._integrands.items()}, shape=self.shape)
+
+  def diagonal(self):
+    '''Return the integral of the diagonal of a square integral.
+
+    The integral should have a shape of the form ``shape + shape``, such as
+    the derivative of a residual to its target, for which the diagonal has
+    shape ``shape``.
+    '''
+
+    n = self.ndim // 2
+    if self.shape[:n] != self.shape[n:] or self.ndim != 2 * n:
+      raise Exception('diagonal requires a square integral')
+    integrands = {}
+    for di, integrand in self._integrands.items():
+      for i in range(n):
+        integrand = evaluable.takediag(integrand, i, n)
+      integrands[di] = integrand
+    return Integral(integrands, shape=self.shape[:n])
+
   def replace(self, arguments):
     '''Return copy with arguments applied.
 
@@ -635,6 +722,180 @@ def eval_integrals_sparse(*integrals: types.tuple[strictintegral], **arguments:
 
   return [sparse.add(retval) for retval in retvals]
 
+class _Integrands:
+  '''Argument independent preparation of integrands for evaluation.
+
+  The integrands are split into blocks that are optimized for evaluation, and
+  subgraphs that are invariant over elements or points are isolated. Objects
+  are created via :func:`_integrands`, which keeps a number of them for reuse
+  in subsequent evaluations with different arguments.
+
+  Args
+  ----
+  funcs : :class:`tuple` of :class:`nutils.evaluable.Array` objects
+      The integrands.
+  '''
+
+  def __init__(self, funcs):
+
+    # Functions may consist of several blocks, such as originating from
+    # chaining. Here we make a list of all blocks consisting of triplets of
+    # argument id, evaluable index, and evaluable values.
+
+    blocks = [(ifunc, evaluable.Tuple(ind).optimized_for_numpy, f.optimized_for_numpy) for ifunc, func in enumerate(funcs) for ind, f in evaluable.blocks(func)]
+    block2func, indices, values = zip(*blocks) if blocks else ([],[],[])
+
+    log.debug('integrating {} distinct blocks'.format('+'.join(
+      str(block2func.count(ifunc)) for ifunc in range(len(funcs)))))
+
+    self.block2func = tuple(block2func)
+    self.indices = tuple(indices)
+    self.sizefunc = evaluable.Tuple([f.size for f in values]).optimized_for_numpy.compile()
+    self.sizes = numpy.array([util.product(f.shape, 1) for f in values], dtype=numpy.uint64) if all(numeric.isint(n) for f in values for n in f.shape) else None
+    self.trailingdims = [numpy.cumsum([0]+[ind.ndim for ind in index[:0:-1]])[::-1] for index in indices] # prepare index reshapes
+
+    # Subgraphs that depend on neither transforms nor points, such as material
+    # parameters or reshaped coefficient vectors, evaluate to the same value
+    # in every element. These are isolated for evaluation ahead of the element
+    # loop.
+
+    func, hoisted = evaluable.isolate(evaluable.Tuple(evaluable.Tuple([value, *index]) for value, index in zip(values, indices)), exclude=('_transforms', '_points'), prefix='_hoisted')
+    if hoisted:
+      log.debug('hoisting {} element-invariant subgraphs'.format(len(hoisted)))
+    self.hoisted = tuple(hoisted)
+    self.hoistedfunc = evaluable.Tuple(tuple(hoisted.values())).compile()
+
+    # Of the remaining subgraphs, those that do not depend on the transforms,
+    # such as basis functions and quadrature weights, evaluate to the same
+    # value in all elements that share a points object. These are isolated
+    # for evaluation per points object.
+
+    func, pointwise = evaluable.isolate(func, exclude=('_transforms',), prefix='_pointwise')
+    if pointwise:
+      log.debug('memoizing {} pointwise subgraphs'.format(len(pointwise)))
+    self.pointwise = tuple(pointwise)
+    self.pointwisefunc = evaluable.Tuple(tuple(pointwise.values())).compile()
+
+    self.func = func
+    self.valuefunc = evaluable.Tuple(tuple(value for value, *index in func))
+
+    # The sparsity pattern is static if neither the indices nor the sizes of
+    # the blocks depend on arguments, in which case it can be reused for
+    # evaluations with different arguments on the same sample.
+
+    elemkeys = {'_transforms', '_points'}
+    self.staticpattern = all(index.evalargkeys is not None and index.evalargkeys <= elemkeys for index in indices) \
+      and (self.sizes is not None or all(f.size.evalargkeys is not None and f.size.evalargkeys <= elemkeys for f in values if isinstance(f.size, evaluable.Array)))
+    self.patterns = weakref.WeakKeyDictionary()
+
+class _Pattern:
+  '''Sparsity pattern of integrands on a sample.
+
+  The pattern holds the block offsets of an evaluation, and for every
+  integrand the sorted, unique indices along with a scatter map from the
+  evaluated entries to these indices. This allows values of subsequent
+  evaluations to be accumulated directly into deduplicated sparse data,
+  skipping index evaluation as well as sorting.
+
+  Args
+  ----
+  datas : :class:`list` of sparse data arrays
+      The evaluated integrands.
+  offsets : :class:`numpy.ndarray`
+      The nblocks x nelems+1 offset array of the evaluation.
+  nvals : :class:`numpy.ndarray`
+      The number of evaluated entries per integrand.
+  '''
+
+  def __init__(self, datas, offsets, nvals):
+    self.offsets = offsets
+    self.nvals = nvals
+    self.indices = []
+    self.scatters = []
+    for data in datas:
+      index = numpy.ascontiguousarray(data['index'])
+      if not sparse.ndim(data):
+        unique = index[:1]
+        scatter = numpy.zeros(len(index), dtype=int)
+      else:
+        unique, scatter = numpy.unique(index.view(numpy.dtype((numpy.void, index.dtype.itemsize))), return_inverse=True)
+        unique = unique.view(index.dtype)
+      self.indices.append(unique)
+      self.scatters.append(scatter)
+
+  def assemble(self, values):
+    '''Return deduplicated sparse data for the evaluated ``values``.'''
+
+    datas = []
+    for value, index, scatter in zip(values, self.indices, self.scatters):
+      data = numpy.empty(len(index), dtype=sparse._dtype(index.dtype, value.dtype))
+      data['index'] = index
+      if value.dtype.kind == 'f':
+        data['value'] = numpy.bincount(scatter, value, minlength=len(index))
+      elif value.dtype.kind == 'c':
+        data['value'].real = numpy.bincount(scatter, value.real, minlength=len(index))
+        data['value'].imag = numpy.bincount(scatter, value.imag, minlength=len(index))
+      else:
+        data['value'] = 0
+        numpy.add.at(data['value'], scatter, value)
+      datas.append(data)
+    return datas
+
+@functools.lru_cache(_maxintegrands)
+def _integrands(funcs):
+  return _Integrands(funcs)
+
+class _ElemArgs:
+  '''element arguments per points, including memoized pointwise subgraphs'''
+
+  def __init__(self, arguments, pointwise, pointwisefunc):
+    self.arguments = arguments
+    self.pointwise = pointwise
+    self.pointwisefunc = pointwisefunc
+    self._cache = functools.lru_cache(_maxpointscache)(self._elemargs)
+
+  def _elemargs(self, points):
+    elemargs = dict(self.arguments, _points=points)
+    if self.pointwise:
+      elemargs.update(zip(self.pointwise, self.pointwisefunc(**elemargs)))
+    return elemargs
+
+  def __call__(self, points):
+    return self._cache(points)
+
+  def __reduce__(self):
+    return _ElemArgs, (self.arguments, self.pointwise, self.pointwisefunc)
+
+def _sizebatch(sample, sizefunc, arguments, offsets, batchsize, ibatch):
+  for ielem in range(ibatch * batchsize, min((ibatch+1) * batchsize, sample.nelems)):
+    offsets[:,ielem+1] = sizefunc(_transforms=tuple(t[ielem] for t in sample.transforms), _points=sample.points[ielem], **arguments)
+
+def _valuebatch(sample, eval, elemargs, block2func, values, offsets, batchsize, ibatch):
+  for ielem in range(ibatch * batchsize, min((ibatch+1) * batchsize, sample.nelems)):
+    for iblock, intdata in enumerate(eval(_transforms=tuple(t[ielem] for t in sample.transforms), **elemargs(sample.points[ielem]))):
+      values[block2func[iblock]][offsets[iblock,ielem]:offsets[iblock,ielem+1]].reshape(intdata.shape)[...] = intdata
+
+def _evalbatch(sample, eval, elemargs, block2func, indices, trailingdims, datas, offsets, batchsize, ibatch):
+  ielem0 = ibatch * batchsize
+  ielem1 = min(ielem0 + batchsize, sample.nelems)
+  batch = []
+  for iblock, ifunc in enumerate(block2func):
+    n = int(offsets[iblock,ielem1] - offsets[iblock,ielem0])
+    dtype = datas[ifunc].dtype
+    batch.append((numpy.empty(n, dtype=dtype['value']), *[numpy.empty(n, dtype=dtype['index'][i]) for i in range(len(indices[iblock]))]))
+  for ielem in range(ielem0, ielem1):
+    for iblock, ((intdata, *indices_), (bvalue, *bindices)) in enumerate(zip(eval(_transforms=tuple(t[ielem] for t in sample.transforms), **elemargs(sample.points[ielem])), batch)):
+      s = slice(int(offsets[iblock,ielem] - offsets[iblock,ielem0]), int(offsets[iblock,ielem+1] - offsets[iblock,ielem0]))
+      bvalue[s].reshape(intdata.shape)[...] = intdata
+      td = trailingdims[iblock]
+      for idim, (ii, bindex) in enumerate(zip(indices_, bindices)):
+        bindex[s].reshape(intdata.shape)[...] = ii.reshape(ii.shape+(1,)*td[idim]) # note: this could be implemented using newaxis, but reshape appears to be faster
+  for iblock, (bvalue, *bindices) in enumerate(batch):
+    data = datas[block2func[iblock]][offsets[iblock,ielem0]:offsets[iblock,ielem1]]
+    data['value'] = bvalue
+    for idim, bindex in enumerate(bindices):
+      data['index']['i'+str(idim)] = bindex
+
 def _convert(data, inplace=False):
   '''Convert a two-dimensional sparse object to an appropriate object.
 
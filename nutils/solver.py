@@ -51,7 +51,7 @@ time dependent problems.
 """
 
 from . import function, evaluable, cache, numeric, sample, types, util, matrix, warnings, sparse
-import abc, numpy, itertools, functools, numbers, collections, math, treelog as log
+import abc, numpy, itertools, functools, numbers, collections, math, time, treelog as log
 
 
 ## TYPE COERCION
@@ -77,6 +77,9 @@ def optionalintegraltuple(arg):
 def arrayordict(arg):
   return types.frozenarray(arg) if numeric.isarray(arg) else argdict(arg)
 
+def argdictortuple(arg):
+  return tuple(map(argdict, arg)) if isinstance(arg, (list, tuple)) else argdict(arg)
+
 
 ## DECORATORS
 
@@ -87,7 +90,9 @@ def single_or_multiple(f):
   def wrapper(target, *args, **kwargs):
     single = isinstance(target, str)
     retval = f(tuple([target] if single else target), *args, **kwargs)
-    return retval[target] if single else retval
+    if not single:
+      return retval
+    return [item[target] for item in retval] if isinstance(retval, list) else retval[target]
   return wrapper
 
 class iterable:
@@ -109,12 +114,15 @@ class iterable:
   def __iter__(self):
     return (retval[self._target] for retval in self._wrapped) if self._single else iter(self._wrapped)
 
-class withsolve(iterable):
-  '''add a .solve method to (lhs,resnorm) iterators'''
+class withinfo(iterable):
+  '''iterable equivalent of single_or_multiple for (lhs,info) iterators'''
 
   def __iter__(self):
     return ((retval[self._target], info) for retval, info in self._wrapped) if self._single else iter(self._wrapped)
 
+class withsolve(withinfo):
+  '''add a .solve method to (lhs,resnorm) iterators'''
+
   def solve(self, tol=0., maxiter=float('inf')):
     '''execute nonlinear solver, return lhs
   
@@ -315,7 +323,7 @@ class MedianBased(LineSearch, version=1):
 @single_or_multiple
 @types.apply_annotations
 @cache.function
-def solve_linear(target, residual:integraltuple, *, constrain:arrayordict=None, lhs0:types.frozenarray[types.strictfloat]=None, arguments:argdict={}, **kwargs):
+def solve_linear(target, residual:integraltuple, *, constrain:arrayordict=None, lhs0:types.frozenarray[types.strictfloat]=None, arguments:argdictortuple={}, **kwargs):
   '''solve linear problem
 
   Parameters
@@ -326,28 +334,48 @@ def solve_linear(target, residual:integraltuple, *, constrain:arrayordict=None,
       Residual integral, depends on ``target``
   constrain : :class:`numpy.ndarray` with dtype :class:`float`
       Defines the fixed entries of the coefficient vector
-  arguments : :class:`collections.abc.Mapping`
+  arguments : :class:`collections.abc.Mapping` or :class:`list` of mappings
       Defines the values for :class:`nutils.function.Argument` objects in
       `residual`.  The ``target`` should not be present in ``arguments``.
-      Optional.
+      Optional. If a list of mappings is given, the problem is solved for
+      every argument set, using a single factorization for all sets if the
+      jacobian is independent of the arguments that vary between them.
 
   Returns
   -------
   :class:`numpy.ndarray`
-      Array of ``target`` values for which ``residual == 0``'''
+      Array of ``target`` values for which ``residual == 0``, or a list of
+      these if ``arguments`` is a list.'''
 
   solveargs = _strip(kwargs, 'lin')
   if kwargs:
     raise TypeError('unexpected keyword arguments: {}'.format(', '.join(kwargs)))
-  lhs0, constrain = _parse_lhs_cons(lhs0, constrain, target, _argshapes(residual), arguments)
   jacobian = _derivative(residual, target)
   if any(jac.contains(t) for t in target for jac in jacobian):
     raise SolverError('problem is not linear')
-  lhs, vlhs = _redict(lhs0, target)
-  mask, vmask = _invert(constrain, target)
-  res, jac = _integrate_blocks(residual, jacobian, arguments=lhs, mask=mask)
-  vlhs[vmask] -= jac.solve(res, **solveargs)
-  return lhs
+  single = not isinstance(arguments, tuple)
+  if single:
+    arguments = arguments,
+  elif not arguments:
+    return []
+  argshapes = _argshapes(residual)
+  parsed = [_parse_lhs_cons(lhs0, constrain, target, argshapes, args) for args in arguments]
+  lhss, vlhss = zip(*[_redict(lhs, target) for lhs, cons in parsed])
+  mask, vmask = _invert(parsed[0][1], target)
+  varying = {name for args in arguments[1:] for name in set(args).union(arguments[0]) if name not in args or name not in arguments[0] or not numpy.array_equal(args[name], arguments[0][name])}
+  if len(arguments) > 1 and not any(jac.contains(name) for jac in jacobian for name in varying):
+    # all argument sets share the jacobian: factorize once and solve for all residuals together
+    res, jac = _integrate_blocks(residual, jacobian, arguments=lhss[0], mask=mask, blockwise=_blockwise(solveargs))
+    allres = [res] + [_integrate_residuals(residual, arguments=lhs, mask=mask) for lhs in lhss[1:]]
+    for vlhs, dlhs in zip(vlhss, jac.solve_many(allres, **solveargs)):
+      vlhs[vmask] -= dlhs
+  else:
+    if len(arguments) > 1:
+      log.info('jacobian depends on varying arguments; solving argument sets separately')
+    for lhs, vlhs in zip(lhss, vlhss):
+      res, jac = _integrate_blocks(residual, jacobian, arguments=lhs, mask=mask, blockwise=_blockwise(solveargs))
+      vlhs[vmask] -= jac.solve(res, **solveargs)
+  return lhss[0] if single else list(lhss)
 
 
 @withsolve.single_or_multiple
@@ -384,6 +412,24 @@ class newton(cache.Recursion, length=1):
       Callable that defines relaxation logic.
   failrelax : :class:`float`
       Fail with exception if relaxation reaches this lower limit.
+  matrixfree : :class:`bool`
+      Solve the linear systems without assembling the jacobian, using an
+      iterative solver on jacobian-vector products that are obtained by
+      integrating the linearized residual. Defaults to the ``gmres`` solver
+      with ``diag`` preconditioner, which can be changed via the ``linsolver``
+      and ``linprecon`` arguments.
+  modified : :class:`bool`
+      Reuse the jacobian and its factorization for as long as the residual
+      norm contracts by at least ``maxrate`` per iteration (modified Newton).
+      Line searches evaluate only the residual, and the number of jacobian
+      reassemblies is reported as ``refreshes`` in the iteration info.
+  maxrate : :class:`float`
+      Residual contraction rate above which modified Newton reassembles the
+      jacobian. Default: 0.25.
+  linrecycle : :class:`int`
+      Number of search directions that the ``arnoldi`` linear solver carries
+      over from one Newton iteration to the next, to deflate the subsequent
+      solve. Optional.
   arguments : :class:`collections.abc.Mapping`
       Defines the values for :class:`nutils.function.Argument` objects in
       `residual`.  The ``target`` should not be present in ``arguments``.
@@ -396,25 +442,44 @@ class newton(cache.Recursion, length=1):
   '''
 
   @types.apply_annotations
-  def __init__(self, target, residual:integraltuple, jacobian:integraltuple=None, lhs0:types.frozenarray[types.strictfloat]=None, relax0:float=1., constrain:arrayordict=None, linesearch=None, failrelax:types.strictfloat=1e-6, arguments:argdict={}, **kwargs):
+  def __init__(self, target, residual:integraltuple, jacobian:integraltuple=None, lhs0:types.frozenarray[types.strictfloat]=None, relax0:float=1., constrain:arrayordict=None, linesearch=None, failrelax:types.strictfloat=1e-6, matrixfree:bool=False, modified:bool=False, maxrate:types.strictfloat=.25, arguments:argdict={}, **kwargs):
     super().__init__()
     self.target = target
     self.residual = residual
-    self.jacobian = _derivative(residual, target, jacobian)
+    if matrixfree:
+      if jacobian is not None:
+        raise ValueError('jacobian cannot be used in combination with matrixfree')
+      if modified:
+        raise ValueError('modified cannot be used in combination with matrixfree')
+      self.jacobian = None
+      self.linearized = _linearize(residual, target)
+    else:
+      self.jacobian = _derivative(residual, target, jacobian)
     self.lhs0, self.constrain = _parse_lhs_cons(lhs0, constrain, target, _argshapes(residual), arguments)
     self.relax0 = relax0
     self.linesearch = linesearch or NormBased.legacy(kwargs)
     self.failrelax = failrelax
+    self.modified = modified
+    self.maxrate = maxrate
     self.solveargs = _strip(kwargs, 'lin')
     if kwargs:
       raise TypeError('unexpected keyword arguments: {}'.format(', '.join(kwargs)))
     self.solveargs.setdefault('rtol', 1e-3)
+    if matrixfree:
+      self.solveargs.setdefault('solver', 'gmres')
+      self.solveargs.setdefault('precon', 'diag')
 
   def _eval(self, lhs, mask):
-    return _integrate_blocks(self.residual, self.jacobian, arguments=lhs, mask=mask)
+    if self.jacobian is None:
+      return _integrate_operator(self.residual, *self.linearized, arguments=lhs, mask=mask)
+    return _integrate_blocks(self.residual, self.jacobian, arguments=lhs, mask=mask, blockwise=_blockwise(self.solveargs))
 
   def resume(self, history):
     mask, vmask = _invert(self.constrain, self.target)
+    solveargs = _recycling(self.solveargs)
+    if self.modified:
+      yield from self._resume_modified(history, mask, vmask, solveargs)
+      return
     if history:
       lhs, info = history[-1]
       lhs, vlhs = _redict(lhs, self.target)
@@ -427,7 +492,7 @@ class newton(cache.Recursion, length=1):
       relax = self.relax0
       yield lhs, types.attributes(resnorm=numpy.linalg.norm(res), relax=relax)
     while True:
-      dlhs = -jac.solve_leniently(res, **self.solveargs) # compute new search vector
+      dlhs = -jac.solve_leniently(res, **solveargs) # compute new search vector
       res0 = res
       dres = jac@dlhs # == -res if dlhs was solved to infinite precision
       vlhs[vmask] += relax * dlhs
@@ -446,6 +511,211 @@ class newton(cache.Recursion, length=1):
       relax = min(relax * scale, 1)
       yield lhs, types.attributes(resnorm=numpy.linalg.norm(res), relax=relax)
 
+  def _tangent(self, lhs, vlhs, mask, vmask, res, dlhs):
+    # finite difference approximation of jac@dlhs in the current point, which
+    # requires one residual evaluation rather than a jacobian assembly
+    vlhs0 = vlhs.copy()
+    h = numpy.sqrt(numpy.finfo(float).eps) * (1 + numpy.linalg.norm(vlhs)) / numpy.linalg.norm(dlhs)
+    vlhs[vmask] += h * dlhs
+    dres = (_integrate_residuals(self.residual, arguments=lhs, mask=mask) - res) / h
+    vlhs[...] = vlhs0
+    return dres
+
+  def _resume_modified(self, history, mask, vmask, solveargs):
+    # All yielded residuals are integrated separately from the jacobian, which
+    # is assembled at the point stored as ``jaclhs`` such that a resumed
+    # iteration continues with the exact same jacobian.
+    if history:
+      lhs, info = history[-1]
+      lhs, vlhs = _redict(lhs, self.target)
+      res = _integrate_residuals(self.residual, arguments=lhs, mask=mask)
+      assert numpy.linalg.norm(res) == info.resnorm
+      jaclhs, jacvlhs = _redict(lhs, self.target)
+      jacvlhs[...] = info.jaclhs
+      jac = self._eval(jaclhs, mask)[1]
+      relax = info.relax
+      refreshes = info.refreshes
+      fresh = numpy.equal(jacvlhs, vlhs).all()
+    else:
+      lhs, vlhs = _redict(self.lhs0, self.target)
+      res = _integrate_residuals(self.residual, arguments=lhs, mask=mask)
+      jac = self._eval(lhs, mask)[1]
+      relax = self.relax0
+      refreshes = 0
+      fresh = True
+      jacvlhs = vlhs.copy()
+      yield lhs, types.attributes(resnorm=numpy.linalg.norm(res), relax=relax, refreshes=refreshes, jaclhs=jacvlhs)
+    while True:
+      dlhs = -jac.solve_leniently(res, **solveargs) # reuses the factorization of an unchanged jacobian
+      res0 = res
+      vlhs0 = vlhs.copy()
+      dres = jac@dlhs # == -res if dlhs was solved to infinite precision
+      vlhs[vmask] += relax * dlhs
+      res = _integrate_residuals(self.residual, arguments=lhs, mask=mask)
+      if relax == 1 and numpy.linalg.norm(res) <= self.maxrate * numpy.linalg.norm(res0):
+        scale, accept = 1., True # sufficient contraction of a full update needs no line search
+      else:
+        scale, accept = self.linesearch(res0, relax*dres, res, relax*self._tangent(lhs, vlhs, mask, vmask, res, dlhs))
+      if not accept and not fresh: # retry with a jacobian in the current point
+        log.info('update rejected; refreshing jacobian')
+        vlhs[...] = vlhs0
+        res = res0
+        jac = self._eval(lhs, mask)[1]
+        jacvlhs = vlhs.copy()
+        refreshes += 1
+        fresh = True
+        continue
+      while not accept: # line search
+        assert scale < 1
+        oldrelax = relax
+        relax *= scale
+        if relax <= self.failrelax:
+          raise SolverError('stuck in local minimum')
+        vlhs[vmask] += (relax - oldrelax) * dlhs
+        res = _integrate_residuals(self.residual, arguments=lhs, mask=mask)
+        scale, accept = self.linesearch(res0, relax*dres, res, relax*self._tangent(lhs, vlhs, mask, vmask, res, dlhs))
+      log.info('update accepted at relaxation', round(relax, 5))
+      relax = min(relax * scale, 1)
+      fresh = False
+      rate = numpy.linalg.norm(res) / numpy.linalg.norm(res0)
+      if rate > self.maxrate:
+        log.info('residual contracted by {:.2f}; refreshing jacobian'.format(rate))
+        jac = self._eval(lhs, mask)[1]
+        jacvlhs = vlhs.copy()
+        refreshes += 1
+        fresh = True
+      yield lhs, types.attributes(resnorm=numpy.linalg.norm(res), relax=relax, refreshes=refreshes, jaclhs=jacvlhs)
+
+
+@withsolve.single_or_multiple
+class newtonkrylov(cache.Recursion, length=1):
+  '''iteratively solve nonlinear problem by jacobian-free Newton-Krylov
+
+  Generates targets such that residual approaches 0 using the Newton procedure
+  and line search of :class:`newton`, with linear systems that are solved
+  by an iterative solver on jacobian-vector products. The products are
+  obtained by integrating the directional derivative of the residual, such
+  that the jacobian of ``residual`` is never assembled. Instead, the
+  linear solver is preconditioned by an assembled approximation of the
+  jacobian, such as the jacobian of a low order residual, which is
+  reassembled every ``lag`` iterations.
+
+  Parameters
+  ----------
+  target : :class:`str`
+      Name of the target: a :class:`nutils.function.Argument` in ``residual``.
+  residual : :class:`nutils.sample.Integral`
+  jacobian : :class:`nutils.sample.Integral`
+      Approximate jacobian that is assembled for preconditioning. Defaults to
+      the derivative of ``residual``.
+  lag : :class:`int`
+      Number of iterations for which the assembled jacobian is reused.
+      Default: 5.
+  lhs0 : :class:`numpy.ndarray`
+      Coefficient vector, starting point of the iterative procedure.
+  relax0 : :class:`float`
+      Initial relaxation value.
+  constrain : :class:`numpy.ndarray` with dtype :class:`bool` or :class:`float`
+      Equal length to ``lhs0``, masks the free vector entries as ``False``
+      (boolean) or NaN (float). In the remaining positions the values of
+      ``lhs0`` are returned unchanged (boolean) or overruled by the values in
+      `constrain` (float).
+  linesearch : :class:`nutils.solver.LineSearch`
+      Callable that defines relaxation logic.
+  failrelax : :class:`float`
+      Fail with exception if relaxation reaches this lower limit.
+  arguments : :class:`collections.abc.Mapping`
+      Defines the values for :class:`nutils.function.Argument` objects in
+      `residual`.  The ``target`` should not be present in ``arguments``.
+      Optional.
+
+  The linear systems are solved by default with the ``gmres`` solver and the
+  ``direct`` preconditioner of the assembled jacobian, which can be changed
+  via the ``linsolver`` and ``linprecon`` arguments.
+
+  Yields
+  ------
+  :class:`numpy.ndarray`
+      Coefficient vector that approximates residual==0 with increasing accuracy
+  '''
+
+  @types.apply_annotations
+  def __init__(self, target, residual:integraltuple, jacobian:integraltuple=None, lag:types.strictint=5, lhs0:types.frozenarray[types.strictfloat]=None, relax0:float=1., constrain:arrayordict=None, linesearch=None, failrelax:types.strictfloat=1e-6, arguments:argdict={}, **kwargs):
+    super().__init__()
+    if lag < 1:
+      raise ValueError('lag should be a positive integer')
+    self.target = target
+    self.residual = residual
+    self.jacobian = _derivative(residual, target, jacobian)
+    self.lag = lag
+    actions, diagonals, directions = _linearize(residual, target)
+    self.linearized = actions, (), directions # diagonal preconditioning uses the assembled jacobian
+    self.lhs0, self.constrain = _parse_lhs_cons(lhs0, constrain, target, _argshapes(residual), arguments)
+    self.relax0 = relax0
+    self.linesearch = linesearch or NormBased.legacy(kwargs)
+    self.failrelax = failrelax
+    self.solveargs = _strip(kwargs, 'lin')
+    if kwargs:
+      raise TypeError('unexpected keyword arguments: {}'.format(', '.join(kwargs)))
+    self.solveargs.setdefault('rtol', 1e-3)
+    self.solveargs.setdefault('solver', 'gmres')
+    self.solveargs.setdefault('precon', 'direct')
+
+  def _eval(self, lhs, mask, precon):
+    return _integrate_operator(self.residual, *self.linearized, arguments=lhs, mask=mask, preconditioner=precon)
+
+  def _assemble(self, lhs, mask):
+    return _integrate_blocks(self.residual, self.jacobian, arguments=lhs, mask=mask, blockwise=_blockwise(self.solveargs))[1]
+
+  def resume(self, history):
+    # The preconditioner is assembled in the point stored as ``jaclhs`` such
+    # that a resumed iteration continues with the exact same preconditioner.
+    mask, vmask = _invert(self.constrain, self.target)
+    solveargs = _recycling(self.solveargs)
+    if history:
+      lhs, info = history[-1]
+      lhs, vlhs = _redict(lhs, self.target)
+      jaclhs, jacvlhs = _redict(lhs, self.target)
+      jacvlhs[...] = info.jaclhs
+      precon = self._assemble(jaclhs, mask)
+      res, jac = self._eval(lhs, mask, precon)
+      assert numpy.linalg.norm(res) == info.resnorm
+      relax = info.relax
+      age = info.jacage
+    else:
+      lhs, vlhs = _redict(self.lhs0, self.target)
+      precon = self._assemble(lhs, mask)
+      res, jac = self._eval(lhs, mask, precon)
+      relax = self.relax0
+      age = 0
+      jacvlhs = vlhs.copy()
+      yield lhs, types.attributes(resnorm=numpy.linalg.norm(res), relax=relax, jaclhs=jacvlhs, jacage=age)
+    while True:
+      dlhs = -jac.solve_leniently(res, **solveargs) # compute new search vector
+      res0 = res
+      dres = jac@dlhs # == -res if dlhs was solved to infinite precision
+      vlhs[vmask] += relax * dlhs
+      res, jac = self._eval(lhs, mask, precon)
+      scale, accept = self.linesearch(res0, relax*dres, res, relax*(jac@dlhs))
+      while not accept: # line search
+        assert scale < 1
+        oldrelax = relax
+        relax *= scale
+        if relax <= self.failrelax:
+          raise SolverError('stuck in local minimum')
+        vlhs[vmask] += (relax - oldrelax) * dlhs
+        res, jac = self._eval(lhs, mask, precon)
+        scale, accept = self.linesearch(res0, relax*dres, res, relax*(jac@dlhs))
+      log.info('update accepted at relaxation', round(relax, 5))
+      relax = min(relax * scale, 1)
+      age += 1
+      if age >= self.lag: # reassemble the preconditioner, reusing the residual and jacobian-vector product of lhs
+        precon = self._assemble(lhs, mask)
+        jac = matrix.Operator(jac.__matmul__, jac.shape, preconditioner=precon)
+        jacvlhs = vlhs.copy()
+        age = 0
+      yield lhs, types.attributes(resnorm=numpy.linalg.norm(res), relax=relax, jaclhs=jacvlhs, jacage=age)
+
 
 @withsolve.single_or_multiple
 class minimize(cache.Recursion, length=1, version=3):
@@ -509,10 +779,11 @@ class minimize(cache.Recursion, length=1, version=3):
       raise TypeError('unexpected keyword arguments: {}'.format(', '.join(kwargs)))
 
   def _eval(self, lhs, mask):
-      return _integrate_blocks(self.energy, self.residual, self.jacobian, arguments=lhs, mask=mask)
+      return _integrate_blocks(self.energy, self.residual, self.jacobian, arguments=lhs, mask=mask, blockwise=_blockwise(self.solveargs))
 
   def resume(self, history):
     mask, vmask = _invert(self.constrain, self.target)
+    solveargs = _recycling(self.solveargs)
     if history:
       lhs, info = history[-1]
       lhs, vlhs = _redict(lhs, self.target)
@@ -528,7 +799,7 @@ class minimize(cache.Recursion, length=1, version=3):
 
     while True:
       nrg0 = nrg
-      dlhs = -jac.solve_leniently(res, **self.solveargs)
+      dlhs = -jac.solve_leniently(res, **solveargs)
       vlhs[vmask] += dlhs # baseline: vanilla Newton
 
       # compute first two ritz values to determine approximate path of steepest descent
@@ -589,6 +860,9 @@ class pseudotime(cache.Recursion, length=1):
       (boolean) or NaN (float). In the remaining positions the values of
       ``lhs0`` are returned unchanged (boolean) or overruled by the values in
       `constrain` (float).
+  linrecycle : :class:`int`
+      Number of search directions that the ``arnoldi`` linear solver carries
+      over between pseudo timesteps. Optional.
   arguments : :class:`collections.abc.Mapping`
       Defines the values for :class:`nutils.function.Argument` objects in
       `residual`.  The ``target`` should not be present in ``arguments``.
@@ -624,10 +898,11 @@ class pseudotime(cache.Recursion, length=1):
     self.solveargs.setdefault('rtol', 1e-3)
 
   def _eval(self, lhs, mask, timestep):
-    return _integrate_blocks(self.residuals, self.jacobians, arguments=dict({self.timesteptarget: timestep}, **lhs), mask=mask)
+    return _integrate_blocks(self.residuals, self.jacobians, arguments=dict({self.timesteptarget: timestep}, **lhs), mask=mask, blockwise=_blockwise(self.solveargs))
 
   def resume(self, history):
     mask, vmask = _invert(self.constrain, self.target)
+    solveargs = _recycling(self.solveargs)
     if history:
       lhs, info = history[-1]
       lhs, vlhs = _redict(lhs, self.target)
@@ -644,7 +919,7 @@ class pseudotime(cache.Recursion, length=1):
       yield lhs, types.attributes(resnorm=resnorm, timestep=timestep, resnorm0=resnorm0)
 
     while True:
-      vlhs[vmask] -= jac.solve_leniently(res, **self.solveargs)
+      vlhs[vmask] -= jac.solve_leniently(res, **solveargs)
       timestep = self.timestep * (resnorm0/resnorm)
       log.info('timestep: {:.0e}'.format(timestep))
       res, jac = self._eval(lhs, mask, timestep)
@@ -677,6 +952,10 @@ class thetamethod(cache.Recursion, length=1, version=1):
       `constrain` (float).
   newtontol : :class:`float`
       Residual tolerance of individual timesteps
+  newtonargs : :class:`dict`
+      Additional arguments for the :class:`newton` solver of every timestep.
+      With ``linrecycle`` the recycled search directions of the ``arnoldi``
+      linear solver are shared between timesteps.
   arguments : :class:`collections.abc.Mapping`
       Defines the values for :class:`nutils.function.Argument` objects in
       `residual`.  The ``target`` should not be present in ``arguments``.
@@ -721,32 +1000,139 @@ class thetamethod(cache.Recursion, length=1, version=1):
     self.residuals = [sample.Integral({smp: func * theta + evaluable.replace_arguments(func, subs0) * (1-theta) for smp, func in res._integrands.items()}, shape=res.shape)
                     + sample.Integral({smp: (func - evaluable.replace_arguments(func, subs0)) / dt for smp, func in inert._integrands.items()} if inert else {}, shape=res.shape)
                          for res, inert in zip(residual, inertia)]
-    self.jacobians = _derivative(self.residuals, target)
+    self.jacobians = _derivative(self.residuals, target) if not self.newtonargs.get('matrixfree') else None
 
-  def _step(self, lhs0, dt):
+  def _step(self, lhs0, dt, newtonargs):
     arguments = lhs0.copy()
     arguments.update((old, lhs0[new]) for old, new in self.old_new)
     arguments[self.timetarget] = lhs0[self.timetarget] + dt
     try:
-      return newton(self.target, residual=self.residuals, jacobian=self.jacobians, constrain=self.constrain, arguments=arguments, **self.newtonargs).solve(tol=self.newtontol)
+      return newton(self.target, residual=self.residuals, jacobian=self.jacobians, constrain=self.constrain, arguments=arguments, **newtonargs).solve(tol=self.newtontol)
     except (SolverError, matrix.MatrixError) as e:
       log.error('error: {}; retrying with timestep {}'.format(e, dt/2))
-      return self._step(self._step(lhs0, dt/2), dt/2)
+      return self._step(self._step(lhs0, dt/2, newtonargs), dt/2, newtonargs)
 
   def resume(self, history):
+    # share the recycled search directions between the newton solves of all timesteps
+    newtonargs = _recycling(self.newtonargs, prefix='lin')
     if history:
       lhs, = history
     else:
       lhs = self.lhs0
       yield lhs
     while True:
-      lhs = self._step(lhs, self.timestep)
+      lhs = self._step(lhs, self.timestep, newtonargs)
       yield lhs
 
 impliciteuler = functools.partial(thetamethod, theta=1)
 cranknicolson = functools.partial(thetamethod, theta=0.5)
 
 
+@withinfo.single_or_multiple
+class adaptivethetamethod(thetamethod.__wrapped__, length=1):
+  '''solve time dependent problem using the theta method with adaptive timestep
+
+  Like :class:`thetamethod`, but with a timestep that is controlled by an
+  estimate of the local truncation error. Every step is computed once with
+  the full timestep and once with two half steps; the difference between the
+  two, scaled by :math:`1/(2^p-1)` with order :math:`p` equal to 2 for
+  Crank-Nicolson and 1 otherwise, estimates the error of the latter, which is
+  accepted if the error is within tolerance. The timestep is subsequently
+  scaled by a factor :math:`0.9 (1/e)^{1/(p+1)}` between 0.2 and 5, where
+  :math:`e` is the error relative to the tolerance. The half step solution of
+  a rejected step is reused if the timestep is reduced by half or more.
+
+  Parameters
+  ----------
+  target : :class:`str`
+      Name of the target: a :class:`nutils.function.Argument` in ``residual``.
+  residual : :class:`nutils.sample.Integral`
+  inertia : :class:`nutils.sample.Integral`
+  timestep : :class:`float`
+      Initial time step.
+  theta : :class:`float`
+      Theta value (theta=1 for implicit Euler, theta=0.5 for Crank-Nicolson)
+  timetol : :class:`float`
+      Absolute tolerance for the local truncation error of the target entries.
+  timertol : :class:`float`
+      Relative tolerance for the local truncation error of the target entries.
+      Default: 0.
+  mintimestep : :class:`float`
+      Fail with exception if the timestep falls below this lower limit.
+      Default: 0.
+  maxtimestep : :class:`float`
+      Upper limit for the timestep. Optional.
+
+  The remaining arguments are those of :class:`thetamethod`.
+
+  Yields
+  ------
+  :class:`numpy.ndarray`
+      Coefficient vector for all accepted timesteps after the initial
+      condition.
+  info
+      Information about the step: the accepted ``timestep``, the proposed
+      ``nexttimestep``, the relative ``error``, the number of ``rejected``
+      attempts and the wall clock time ``steptime`` in seconds.
+  '''
+
+  @types.apply_annotations
+  def __init__(self, target, residual:integraltuple, inertia:optionalintegraltuple, timestep:types.strictfloat, theta:types.strictfloat, timetol:types.strictfloat, timertol:types.strictfloat=0., mintimestep:types.strictfloat=0., maxtimestep:types.strictfloat=float('inf'), lhs0:types.frozenarray[types.strictfloat]=None, target0:types.strictstr=None, constrain:arrayordict=None, newtontol:types.strictfloat=1e-10, arguments:argdict={}, newtonargs:types.frozendict={}, timetarget:types.strictstr='_thetamethod_time', time0:types.strictfloat=0., historysuffix:types.strictstr='0'):
+    if timetol <= 0 and timertol <= 0:
+      raise ValueError('timetol or timertol should be positive')
+    super().__init__(target, residual, inertia, timestep, theta, lhs0, target0, constrain, newtontol, arguments, newtonargs, timetarget, time0, historysuffix)
+    self.order = 2 if theta == .5 else 1
+    self.timetol = timetol
+    self.timertol = timertol
+    self.mintimestep = mintimestep
+    self.maxtimestep = maxtimestep
+
+  def _error(self, lhsfull, lhshalf):
+    # maximum error relative to the tolerance of the free entries, estimated
+    # by Richardson's extrapolation of the full and half step solutions
+    mask, vmask = _invert(self.constrain, self.target)
+    full = numpy.concatenate([lhsfull[t].ravel() for t in self.target])[vmask]
+    half = numpy.concatenate([lhshalf[t].ravel() for t in self.target])[vmask]
+    err = numpy.abs(half - full) / (2**self.order - 1) / (self.timetol + self.timertol * numpy.abs(half))
+    return err.max() if len(err) else 0.
+
+  def resume(self, history):
+    newtonargs = _recycling(self.newtonargs, prefix='lin')
+    if history:
+      (lhs, info), = history
+      dt = info.nexttimestep
+    else:
+      lhs = self.lhs0
+      dt = min(self.timestep, self.maxtimestep)
+      yield lhs, types.attributes(timestep=0., nexttimestep=dt, error=0., rejected=0, steptime=0.)
+    while True:
+      t0 = time.perf_counter()
+      rejected = 0
+      lhsfull = self._step(lhs, dt, newtonargs)
+      while True:
+        lhsmid = self._step(lhs, dt/2, newtonargs)
+        lhshalf = self._step(lhsmid, dt/2, newtonargs)
+        error = self._error(lhsfull, lhshalf)
+        scale = min(max(.9 * (1/error)**(1/(self.order+1)) if error else 5., .2), 5.)
+        if error <= 1:
+          break
+        rejected += 1
+        log.info('rejecting timestep {:.2e} with error {:.1e}'.format(dt, error))
+        if scale <= .5: # reuse the half step solution as full step
+          dt /= 2
+          lhsfull = lhsmid
+        else:
+          dt *= scale
+          lhsfull = self._step(lhs, dt, newtonargs)
+        if dt < self.mintimestep:
+          raise SolverError('timestep {:.2e} dropped below minimum'.format(dt))
+      log.info('accepted timestep {:.2e} with error {:.1e}'.format(dt, error))
+      lhs = lhshalf
+      info = types.attributes(timestep=dt, nexttimestep=min(dt * scale, self.maxtimestep), error=error, rejected=rejected, steptime=time.perf_counter()-t0)
+      yield lhs, info
+      dt = info.nexttimestep
+
+
 @log.withcontext
 @single_or_multiple
 @types.apply_annotations
@@ -802,7 +1188,7 @@ def optimize(target, functional:sample.strictintegral, *, tol:types.strictfloat=
   lhs0, constrain = _parse_lhs_cons(lhs0, constrain, target, functional.argshapes, arguments)
   mask, vmask = _invert(constrain, target)
   lhs, vlhs = _redict(lhs0, target)
-  val, res, jac = _integrate_blocks(functional, residual, jacobian, arguments=lhs, mask=mask)
+  val, res, jac = _integrate_blocks(functional, residual, jacobian, arguments=lhs, mask=mask, blockwise=_blockwise(solveargs))
   if droptol is not None:
     supp = jac.rowsupp(droptol)
     res = res[supp]
@@ -816,6 +1202,7 @@ def optimize(target, functional:sample.strictintegral, *, tol:types.strictfloat=
     if tol <= 0:
       raise ValueError('nonlinear optimization problem requires a nonzero "tol" argument')
     solveargs.setdefault('rtol', 1e-3)
+    solveargs = _recycling(solveargs)
     firstresnorm = resnorm
     relax = relax0
     accept = True
@@ -829,7 +1216,7 @@ def optimize(target, functional:sample.strictintegral, *, tol:types.strictfloat=
           relax0 = 0
         vlhs[vmask] += (relax - relax0) * dlhs
         relax0 = relax # currently applied relaxation
-        val, res, jac = _integrate_blocks(functional, residual, jacobian, arguments=lhs, mask=mask)
+        val, res, jac = _integrate_blocks(functional, residual, jacobian, arguments=lhs, mask=mask, blockwise=_blockwise(solveargs))
         resnorm = numpy.linalg.norm(res)
         scale, accept = linesearch(res0, relax*dres, res, relax*(jac@dlhs))
         relax = min(relax * scale, 1)
@@ -853,6 +1240,27 @@ def optimize(target, functional:sample.strictintegral, *, tol:types.strictfloat=
 def _strip(kwargs, prefix):
   return {key[len(prefix):]: kwargs.pop(key) for key in list(kwargs) if key.startswith(prefix)}
 
+class _RecycleSpace(collections.deque):
+  # Search directions that the arnoldi solver carries over between subsequent
+  # linear solves. Recycling affects the solution only within the linear
+  # tolerance, so the space hashes by its capacity to leave caching unaffected.
+
+  __eq__ = object.__eq__
+  __hash__ = object.__hash__
+
+  @property
+  def __nutils_hash__(self):
+    return types.nutils_hash(('recycle', self.maxlen))
+
+def _recycling(solveargs, prefix=''):
+  recycle = solveargs.get(prefix+'recycle')
+  if recycle is None or isinstance(recycle, collections.deque):
+    return solveargs
+  linsolver = solveargs.get(prefix+'solver', 'arnoldi')
+  if linsolver != 'arnoldi':
+    raise SolverError('{}recycle requires the arnoldi linear solver, got {!r}'.format(prefix or 'lin', linsolver))
+  return dict(solveargs, **{prefix+'recycle': _RecycleSpace(maxlen=recycle)})
+
 def _parse_lhs_cons(lhs0, constrain, targets, argshapes, arguments):
   arguments = arguments.copy()
   if lhs0 is not None:
@@ -895,6 +1303,19 @@ def _derivative(residual, target, jacobian=None):
     raise ValueError('jacobian has incorrect shape')
   return jacobian
 
+def _linearize(residual, target):
+  '''directional derivatives and jacobian diagonals for matrix-free solves'''
+
+  argshapes = _argshapes(residual)
+  targets = [evaluable.Argument(t, argshapes[t]) for t in target]
+  directions = tuple('_direction_' + t for t in target)
+  actions = tuple(util.sum(res.linearize(t, d) for t, d in zip(targets, directions)) for res in residual)
+  if len(residual) == len(target) and all(res.shape == t.shape for res, t in zip(residual, targets)):
+    diagonals = tuple(res.derivative(t).diagonal() for res, t in zip(residual, targets))
+  else:
+    diagonals = ()
+  return actions, diagonals, directions
+
 def _progress(name, tol):
   '''helper function for iter.wrap'''
 
@@ -934,8 +1355,16 @@ def _invert(cons, targets):
   assert offset == len(vmask)
   return tuple(mask), vmask
 
-def _integrate_blocks(*blocks, arguments, mask):
-  '''helper function for blockwise integration'''
+def _blockwise(solveargs):
+  '''whether the linear solver uses the block structure of a multi-target jacobian'''
+
+  return solveargs.get('precon') in ('blocktriangular', 'schur')
+
+def _integrate_blocks(*blocks, arguments, mask, blockwise=False):
+  '''helper function for blockwise integration
+
+  The jacobian of multiple targets is returned as a :class:`nutils.matrix.BlockMatrix`
+  if ``blockwise`` is true, and merged into a single matrix otherwise.'''
 
   *scalars, residuals, jacobians = blocks
   assert len(residuals) == len(mask)
@@ -945,7 +1374,37 @@ def _integrate_blocks(*blocks, arguments, mask):
   res = [sparse.take(next(data), [m]) for m in mask]
   jac = [[sparse.take(next(data), [mi, mj]) for mj in mask] for mi in mask]
   assert not list(data)
-  return nrg + [sparse.toarray(sparse.block(res)), matrix.fromsparse(sparse.block(jac), inplace=True)]
+  if blockwise and len(mask) > 1:
+    jac = matrix.BlockMatrix([[matrix.fromsparse(block, inplace=True) for block in row] for row in jac])
+  else:
+    jac = matrix.fromsparse(sparse.block(jac), inplace=True)
+  return nrg + [sparse.toarray(sparse.block(res)), jac]
+
+def _integrate_residuals(residuals, *, arguments, mask):
+  '''helper function for blockwise integration of residuals only'''
+
+  data = sample.eval_integrals_sparse(*residuals, **arguments)
+  return sparse.toarray(sparse.block([sparse.take(d, [m]) for d, m in zip(data, mask)]))
+
+def _integrate_operator(residuals, actions, diagonals, directions, *, arguments, mask, preconditioner=None):
+  '''helper function for blockwise integration of residual and matrix-free jacobian'''
+
+  assert len(residuals) == len(actions) == len(mask)
+  arguments = {name: numpy.array(value) for name, value in arguments.items()} # copy to decouple from subsequent updates
+  data = iter(sample.eval_integrals_sparse(*(list(residuals) + list(diagonals)), **arguments))
+  res = sparse.toarray(sparse.block([sparse.take(next(data), [m]) for m in mask]))
+  diag = sparse.toarray(sparse.block([sparse.take(next(data), [m]) for m in mask])) if diagonals else None
+  assert not list(data)
+  def matvec(v):
+    offset = 0
+    for name, m in zip(directions, mask):
+      direction = arguments[name] = numpy.zeros(m.shape)
+      n = m.sum()
+      direction[m] = v[offset:offset+n]
+      offset += n
+    assert offset == len(v)
+    return sparse.toarray(sparse.block([sparse.take(data, [m]) for data, m in zip(sample.eval_integrals_sparse(*actions, **arguments), mask)]))
+  return res, matrix.Operator(matvec, shape=(len(res), len(res)), diagonal=diag, preconditioner=preconditioner)
 
 def _argshapes(integrals):
   '''merge argshapes of multiple integrals'''
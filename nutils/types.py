@@ -22,9 +22,43 @@
 Module with general purpose types.
 """
 
-import inspect, functools, hashlib, builtins, numbers, collections.abc, itertools, abc, sys, weakref, re, io, types
+import inspect, functools, hashlib, builtins, numbers, collections.abc, itertools, abc, sys, weakref, re, io, types, os
 import numpy
 
+# The digest of `nutils_hash` is selected once per process by the
+# `NUTILS_HASH` environment variable, as hashes are memoized on immutable
+# objects.  Both digests are 20 bytes long, but differ in value, hence the
+# entries of a cache written with one digest are not found with the other.
+_digests = dict(sha1=hashlib.sha1)
+_blake2b = getattr(hashlib, 'blake2b', None) # python 3.6+
+if _blake2b:
+  _digests['blake2b'] = functools.partial(_blake2b, digest_size=20)
+_hashname = os.environ.get('NUTILS_HASH') or 'sha1'
+if _hashname == 'blake2b' and not _blake2b:
+  raise ValueError('NUTILS_HASH=blake2b requires Python 3.6 or newer')
+try:
+  _digest = _digests[_hashname]
+except KeyError:
+  raise ValueError('invalid NUTILS_HASH {!r}; choose from sha1, blake2b'.format(_hashname)) from None
+
+def newhash(data=b''):
+  '''
+  Return a new hash object of the digest that underlies :func:`nutils_hash`.
+  The digest is SHA1 by default, or BLAKE2b truncated to the same size if
+  the environment variable ``NUTILS_HASH`` is set to ``blake2b``.
+
+  Parameters
+  ----------
+  data : :class:`bytes`
+      Optional initial data.
+
+  Returns
+  -------
+  :class:`hashlib.sha1` or :class:`hashlib.blake2b`
+  '''
+
+  return _digest(data)
+
 def aspreprocessor(apply):
   '''
   Convert ``apply`` into a preprocessor decorator.  When applied to a function,
@@ -274,25 +308,37 @@ def nutils_hash(data):
       The hash of ``data``.
   '''
 
+  # Fast paths for the exact builtin types that are hashed most frequently,
+  # which yield the same digest as the generic implementation below.
+  t = type(data)
+  if t is builtins.tuple:
+    h = _digest(b'tuple\0')
+    for item in data:
+      h.update(nutils_hash(item))
+    return h.digest()
+  if t is int or t is float or t is bool or t is complex:
+    return _digest(t.__name__.encode() + b'\0' + _digest(repr(data).encode()).digest()).digest()
+  if t is str:
+    return _digest(b'str\0' + _digest(data.encode()).digest()).digest()
+
   try:
     return data.__nutils_hash__
   except AttributeError:
     pass
 
-  t = type(data)
-  h = hashlib.sha1(t.__name__.encode()+b'\0')
+  h = newhash(t.__name__.encode()+b'\0')
   if data is Ellipsis:
     pass
   elif data is None:
     pass
   elif any(data is dtype for dtype in (bool, int, float, complex, str, bytes, builtins.tuple, frozenset, type(Ellipsis), type(None))):
-    h.update(hashlib.sha1(data.__name__.encode()).digest())
+    h.update(newhash(data.__name__.encode()).digest())
   elif any(t is dtype for dtype in (bool, int, float, complex)):
-    h.update(hashlib.sha1(repr(data).encode()).digest())
+    h.update(newhash(repr(data).encode()).digest())
   elif t is str:
-    h.update(hashlib.sha1(data.encode()).digest())
+    h.update(newhash(data.encode()).digest())
   elif t is bytes:
-    h.update(hashlib.sha1(data).digest())
+    h.update(newhash(data).digest())
   elif t is builtins.tuple:
     for item in data:
       h.update(nutils_hash(item))
@@ -639,7 +685,7 @@ class Immutable(metaclass=ImmutableMeta):
 
   @property
   def __nutils_hash__(self):
-    h = hashlib.sha1('{}.{}:{}\0'.format(type(self).__module__, type(self).__qualname__, type(self)._version).encode())
+    h = newhash('{}.{}:{}\0'.format(type(self).__module__, type(self).__qualname__, type(self)._version).encode())
     for arg in self._args:
       h.update(nutils_hash(arg))
     for name in sorted(self._kwargs):
@@ -950,7 +996,7 @@ class frozendict(collections.abc.Mapping, metaclass=_frozendictmeta):
 
   @property
   def __nutils_hash__(self):
-    h = hashlib.sha1('{}.{}\0'.format(type(self).__module__, type(self).__qualname__).encode())
+    h = newhash('{}.{}\0'.format(type(self).__module__, type(self).__qualname__).encode())
     for item in sorted(nutils_hash(k)+nutils_hash(v) for k, v in self.items()):
       h.update(item)
     return h.digest()
@@ -1040,7 +1086,7 @@ class frozenmultiset(collections.abc.Container, metaclass=_frozenmultisetmeta):
 
   @property
   def __nutils_hash__(self):
-    h = hashlib.sha1('{}.{}\0'.format(type(self).__module__, type(self).__qualname__).encode())
+    h = newhash('{}.{}\0'.format(type(self).__module__, type(self).__qualname__).encode())
     for item in sorted('{:04d}'.format(count).encode()+nutils_hash(item) for item, count in self.__key):
       h.update(item)
     return h.digest()
@@ -1179,8 +1225,15 @@ class frozenarray(collections.abc.Sequence, metaclass=_frozenarraymeta):
 
   @property
   def __nutils_hash__(self):
-    h = hashlib.sha1('{}.{}\0{} {}'.format(type(self).__module__, type(self).__qualname__, self.__base.shape, self.__base.dtype.str).encode())
-    h.update(self.__base.tobytes())
+    h = newhash('{}.{}\0{} {}'.format(type(self).__module__, type(self).__qualname__, self.__base.shape, self.__base.dtype.str).encode())
+    # Hash the array data in place if it is C-contiguous, which yields the
+    # same bytes as `tobytes` without a copy. Dtypes that do not support the
+    # buffer protocol, such as datetime64, are hashed via `tobytes`.
+    data = numpy.ascontiguousarray(self.__base)
+    try:
+      h.update(data.data)
+    except ValueError:
+      h.update(data.tobytes())
     return h.digest()
 
   @property
@@ -1316,7 +1369,10 @@ class frozenarray(collections.abc.Sequence, metaclass=_frozenarraymeta):
         value = cls(func(*args), copy=False)
         cache[args] = value
       else:
-        cache.move_to_end(args)
+        try:
+          cache.move_to_end(args)
+        except KeyError: # evicted by a concurrent thread
+          pass
       return value
     return wrapped
 
@@ -1,6 +1,6 @@
 from nutils import *
 from nutils.testing import *
-import sys, contextlib, tempfile, pathlib, threading
+import sys, contextlib, tempfile, pathlib, threading, unittest.mock, pickle, numpy
 
 @contextlib.contextmanager
 def tmpcache():
@@ -327,7 +327,7 @@ class Recursion(TestCase):
         yield from range(0 if not history else history[-1]+1, 10)
 
     for icorrupted in range(3):
-      for corruption in '', 'bogus':
+      for corruption in 'truncated', 'bogus':
         with self.subTest(corruption=corruption, icorrupted=icorrupted), tmpcache() as cachedir:
 
           received_history = untouched
@@ -337,14 +337,39 @@ class Recursion(TestCase):
           cache_files = tuple(cachedir.iterdir())
           self.assertEqual(len(cache_files), 1)
           cache_file, = cache_files
-          self.assertTrue((cache_file/'{:04d}'.format(icorrupted)).exists())
-          with (cache_file/'{:04d}'.format(icorrupted)).open('wb') as f:
-            f.write(corruption.encode())
+          with (cache_file/'log').open('r+b') as f:
+            offset, iteration, length = list(cache._RecursionLog(f)._headers())[icorrupted]
+            self.assertEqual(iteration, icorrupted)
+            if corruption == 'truncated': # interrupted write
+              f.truncate(offset + length // 2)
+            else:
+              f.seek(offset + cache._RecursionLog._record.size + length // 2)
+              f.write(corruption.encode())
 
           received_history = untouched
           self.assertEqual(read(R(), 6), tuple(range(6)))
           self.assertEqual(received_history, (icorrupted-1,) if icorrupted else ())
 
+  def test_checkpoint(self):
+
+    read = lambda iterable, n: tuple(item for i, item in zip(range(n), iterable))
+
+    class R(cache.Recursion, length=2):
+      def resume(R_self, history):
+        received_histories.append(tuple(history))
+        yield from range(0 if not history else history[-1]+1, 20)
+
+    with tempfile.TemporaryDirectory() as cachedir, cache.enable(cachedir, checkpoint=5):
+      received_histories = []
+      self.assertEqual(read(R(), 13), tuple(range(13)))
+      self.assertEqual(received_histories, [()])
+      cache_file, = pathlib.Path(cachedir).iterdir()
+      with (cache_file/'log').open('rb') as f:
+        self.assertEqual([i for offset, i, length in cache._RecursionLog(f)._headers()], [3, 4, 8, 9, 10, 11, 12])
+      received_histories = []
+      self.assertEqual(read(R(), 15), tuple(range(15)))
+      self.assertEqual(received_histories, [(), (3, 4), (11, 12)])
+
   @unittest.skipIf(cache._lock_file is cache._lock_file_fallback, 'platform does not support file locks')
   def test_concurrent_access(self):
 
@@ -362,41 +387,163 @@ class Recursion(TestCase):
       assert read(R(), n) == tuple(range(n))
       nsuccess += 1
 
-    for ilock in range(3):
-      with self.subTest(ilock=ilock), tmpcache() as cachedir:
+    with tmpcache() as cachedir:
 
-        nsuccess = 0
+      nsuccess = 0
 
-        # Call `wrapper`.  Since the cache is clean `R.resume` should be called with empty history.
+      # Call `wrapper`.  Since the cache is clean `R.resume` should be called with empty history.
+      received_history = untouched
+      wrapper(4)
+      self.assertEqual(received_history, ())
+      self.assertEqual(nsuccess, 1)
+
+      # Find the log, obtain a lock and call `wrapper` in a thread.
+      # `wrapper` should block on acquiring the file lock in
+      # `function.Recursion`.
+      cache_files = tuple(cachedir.iterdir())
+      self.assertEqual(len(cache_files), 1)
+      cache_file = cache_files[0]/'log'
+      assert cache_file.exists()
+      with cache_file.open('r+b') as f:
+        cache._lock_file(f)
+
+        # We use `daemon=True` to make sure this thread won't keep the
+        # interpreter alive when something goes wrong with the thread.
         received_history = untouched
-        wrapper(4)
-        self.assertEqual(received_history, ())
+        t = threading.Thread(target=lambda: wrapper(5), daemon=True)
+        t.start()
+        # Give the thread some time to start.
+        t.join(timeout=1)
+        # Assert the thread is still running, but `R.resume` is not called.
+        self.assertEqual(received_history, untouched)
         self.assertEqual(nsuccess, 1)
 
-        # Find the cache file of iteration `ilock`, obtain a lock and call
-        # `wrapper` in a thread.  `wrapper` should block on acquiring the file
-        # lock in `function.Recursion`.
-        cache_files = tuple(cachedir.iterdir())
-        self.assertEqual(len(cache_files), 1)
-        cache_file = cache_files[0]/'{:04d}'.format(ilock)
-        assert cache_file.exists()
-        with cache_file.open('r+b') as f:
-          cache._lock_file(f)
+      # The lock has been released by closing the file.  The thread should
+      # continue with loading the cache and ultimately calling `R.resume
+      t.join(timeout=5)
+      self.assertFalse(t.is_alive())
+      self.assertEqual(received_history, (3,))
+      self.assertEqual(nsuccess, 2)
 
-          # We use `daemon=True` to make sure this thread won't keep the
-          # interpreter alive when something goes wrong with the thread.
-          received_history = untouched
-          t = threading.Thread(target=lambda: wrapper(5), daemon=True)
-          t.start()
-          # Give the thread some time to start.
-          t.join(timeout=1)
-          # Assert the thread is still running, but `R.resume` is not called.
-          self.assertEqual(received_history, untouched)
-          self.assertEqual(nsuccess, 1)
-
-        # The lock has been released by closing the file.  The thread should
-        # continue with loading the cache and ultimately calling `R.resume
-        t.join(timeout=5)
-        self.assertFalse(t.is_alive())
-        self.assertEqual(received_history, (3,))
-        self.assertEqual(nsuccess, 2)
+
+class store(TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.cachedir = pathlib.Path(self.enter_context(tempfile.TemporaryDirectory()))
+    self.ncalls = 0
+
+    @cache.function
+    def func(n):
+      self.ncalls += 1
+      return 'x' * n
+
+    self.func = func
+
+  def test_compress(self):
+    compressions = ['zlib']
+    if cache.zstandard is not None:
+      compressions.append('zstd')
+    for compress, magic in zip(compressions, [b'\x78', b'\x28\xb5\x2f\xfd']):
+      with self.subTest(compress=compress), tempfile.TemporaryDirectory() as tmpdir:
+        with cache.enable(tmpdir, compress=compress):
+          self.assertEqual(self.func(10000), 'x' * 10000)
+        cache_file, = pathlib.Path(tmpdir).iterdir()
+        self.assertEqual(cache_file.read_bytes()[:len(magic)], magic)
+        self.assertLess(cache_file.stat().st_size, 1000)
+        with cache.enable(tmpdir): # read compressed entries without compression enabled
+          self.assertEqual(self.func(10000), 'x' * 10000)
+        self.assertEqual(self.ncalls, 1)
+        self.ncalls = 0
+
+  def test_invalid_compress(self):
+    with self.assertRaises(ValueError):
+      with cache.enable(self.cachedir, compress='bogus'):
+        pass
+
+  def test_memory(self):
+    with cache.enable(self.cachedir, memory=1000):
+      self.assertEqual(self.func(10), 'x' * 10)
+      self.assertEqual(self.func(2000), 'x' * 2000) # exceeds the memory tier
+      for path in self.cachedir.iterdir():
+        path.unlink()
+      self.assertEqual(self.func(10), 'x' * 10)
+      self.assertEqual(self.ncalls, 2)
+      self.assertEqual(self.func(2000), 'x' * 2000)
+      self.assertEqual(self.ncalls, 3)
+
+  def test_maxsize(self):
+    with cache.enable(self.cachedir, maxsize=3500):
+      for n in 1000, 1001, 1002:
+        self.func(n)
+      self.func(1000) # mark as recently used
+      self.func(1003) # evicts 1001
+      self.assertEqual(self.ncalls, 4)
+      self.assertEqual(len([path for path in self.cachedir.iterdir() if len(path.name) == 40]), 3)
+      self.func(1000)
+      self.func(1002)
+      self.func(1003)
+      self.assertEqual(self.ncalls, 4)
+      self.func(1001)
+      self.assertEqual(self.ncalls, 5)
+    self.assertFalse([path for path in self.cachedir.iterdir() if path.name.endswith('.tmp')])
+
+  def test_prune(self):
+    with cache.enable(self.cachedir):
+      for n in 1000, 1001, 1002:
+        self.func(n)
+    store = cache._Store(self.cachedir)
+    entries = store.entries()
+    self.assertEqual(len(entries), 3)
+    self.assertEqual(store.prune(maxage=3600), (0, 0))
+    n, size = store.prune(maxsize=1500)
+    self.assertEqual(n, 2)
+    self.assertEqual(len(store.entries()), 1)
+    n, size = store.prune(maxage=0)
+    self.assertEqual(n, 1)
+    self.assertEqual(store.entries(), {})
+
+  def test_main(self):
+    with cache.enable(self.cachedir):
+      self.func(1000)
+    with unittest.mock.patch('builtins.print') as print:
+      cache._main('stats', str(self.cachedir))
+    self.assertIn('1 entries (1 function, 0 recursion)', print.call_args_list[0][0][0])
+    with unittest.mock.patch('builtins.print') as print:
+      cache._main('prune', '--maxsize', '0', str(self.cachedir))
+    self.assertTrue(print.call_args[0][0].startswith('removed 1 entries'))
+    self.assertEqual(cache._Store(self.cachedir).entries(), {})
+
+  @unittest.skipIf(pickle.HIGHEST_PROTOCOL < 5, 'pickle protocol 5 is not available')
+  def test_mmap(self):
+
+    @cache.function
+    def func(n):
+      self.ncalls += 1
+      return numpy.arange(n, dtype=float), types.frozenarray(numpy.arange(n)), numpy.arange(10)
+
+    for compress in None, 'zlib':
+      with self.subTest(compress=compress), tempfile.TemporaryDirectory() as tmpdir:
+        with cache.enable(tmpdir, mmap=1000, compress=compress):
+          self.ncalls = 0
+          a, b, c = func(1000)
+          self.assertTrue(a.flags.writeable)
+          self.assertEqual(sorted(path.name[40:] for path in pathlib.Path(tmpdir).iterdir()), ['', '-0.npy', '-1.npy'])
+        with cache.enable(tmpdir, mmap=1000):
+          a, b, c = func(1000)
+          self.assertEqual(self.ncalls, 1)
+          self.assertAllEqual(a, numpy.arange(1000.))
+          self.assertFalse(a.flags.writeable)
+          base = a
+          while not isinstance(base, (numpy.memmap, type(None))):
+            base = base.base
+          self.assertIsInstance(base, numpy.memmap)
+          self.assertIsInstance(b, types.frozenarray)
+          self.assertAllEqual(b, numpy.arange(1000))
+          self.assertTrue(c.flags.writeable) # small arrays are stored in-band
+        store = cache._Store(pathlib.Path(tmpdir))
+        (size, atime), = store.entries().values()
+        self.assertGreater(size, 16000)
+        self.assertEqual(store.prune(maxsize=0)[0], 1)
+        self.assertEqual(store.entries(), {})
+        self.assertEqual(list(pathlib.Path(tmpdir).glob('*.npy')), [])
@@ -59,6 +59,8 @@ class check(TestCase):
       self.assertArrayAlmostEqual(actual.simplified.eval(**evalargs), desired, decimal)
     with self.subTest('optimized'):
       self.assertArrayAlmostEqual(actual.optimized_for_numpy.eval(**evalargs), desired, decimal)
+    with self.subTest('compiled'):
+      self.assertArrayAlmostEqual(actual.optimized_for_numpy.compile()(**evalargs), desired, decimal)
     with self.subTest('sample'):
       self.assertArrayAlmostEqual(self.sample_eval(actual), desired, decimal)
 
@@ -464,6 +466,13 @@ class blocks(TestCase):
     self.assertAllEqual(i.eval(), [1])
     self.assertAllEqual(f.eval(), [3])
 
+  def test_takediag_inflate_multidimensional_dofmap(self):
+    func = numpy.arange(5*2*3, dtype=float).reshape(5, 2, 3)
+    dofmap = numpy.array([[0,2,4],[1,3,0]])
+    dense = numpy.zeros((5, 5))
+    numpy.add.at(dense, (slice(None), dofmap), func)
+    inflated = evaluable.Inflate(evaluable.Constant(func), evaluable.Constant(dofmap), 5)
+    self.assertAllEqual(inflated._takediag(0, 1).eval(), numpy.diagonal(dense))
 
 class commutativity(TestCase):
 
@@ -676,6 +685,76 @@ class asciitree(TestCase):
                      '    └ %3 = Argument(a2)\n'
                      '      └ %0 = Evaluable')
 
+class compile(TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.arg = evaluable.Argument('arg', (2,))
+    self.f = evaluable.Sin(self.arg)**evaluable.Diagonalize(self.arg)
+
+  def test_eval(self):
+    arg = numpy.array([.5, 1.5])
+    self.assertAllEqual(self.f.compile()(arg=arg), self.f.eval(arg=arg))
+
+  def test_cached(self):
+    self.assertIs(self.f.compile(), self.f.compile())
+
+  def test_error(self):
+    with self.assertRaises(evaluable.EvaluationError):
+      self.f.compile()()
+
+  def test_liveness(self):
+    released = [i for dead in self.f.liveness for i in dead]
+    self.assertEqual(sorted(released), list(range(1, len(self.f.ordereddeps))))
+    for i, dead in enumerate(self.f.liveness):
+      for j in dead:
+        self.assertIn(j, self.f.dependencytree[i])
+        self.assertFalse(any(j in indices for indices in self.f.dependencytree[i+1:]))
+
+  def test_stats(self):
+    arg = numpy.array([.5, 1.5])
+    retval, times, (peak, total) = self.f.eval_withstats(arg=arg)
+    self.assertAllEqual(retval, self.f.eval(arg=arg))
+    self.assertEqual(len(times), len(self.f.dependencies))
+    self.assertLessEqual(peak, total)
+
+class isolate(TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.arg = evaluable.Argument('arg', (2,))
+    self.points = evaluable.Points(evaluable.NPoints(), 2)
+    self.f = evaluable.Sin(self.arg)[_] * self.points
+
+  def test_evalargkeys(self):
+    self.assertEqual(self.arg.evalargkeys, {'arg'})
+    self.assertEqual(self.points.evalargkeys, {'_points'})
+    self.assertEqual(self.f.evalargkeys, {'arg', '_points'})
+    self.assertIsNone(evaluable.Tuple([self.f, evaluable.RevolutionAngle()]).evalargkeys)
+
+  def test_isolate(self):
+    f, isolated = evaluable.isolate(self.f, exclude=('_points',), prefix='_isolated')
+    self.assertEqual(list(isolated), ['_isolated0'])
+    self.assertNotIn(self.arg, f.dependencies)
+    self.assertEqual(f.evalargkeys, {'_isolated0', '_points'})
+    arg = numpy.array([.5, 1.5])
+    pnts = points.CoordsPoints(numpy.array([[0., 1.], [2., 3.]]))
+    self.assertAllEqual(f.eval(_points=pnts, _isolated0=isolated['_isolated0'].eval(arg=arg)), self.f.eval(_points=pnts, arg=arg))
+
+  def test_pointwise(self):
+    f, isolated = evaluable.isolate(self.f, exclude=('arg',), prefix='_isolated')
+    self.assertEqual(list(isolated), ['_isolated0'])
+    self.assertEqual(f.shape, self.f.shape)
+    self.assertEqual(f.evalargkeys, {'_isolated0', '_points', 'arg'})
+    arg = numpy.array([.5, 1.5])
+    pnts = points.CoordsPoints(numpy.array([[0., 1.], [2., 3.], [4., 5.]]))
+    self.assertAllEqual(f.eval(_points=pnts, arg=arg, _isolated0=isolated['_isolated0'].eval(_points=pnts)), self.f.eval(_points=pnts, arg=arg))
+
+  def test_noop(self):
+    f, isolated = evaluable.isolate(self.points, exclude=('_points',), prefix='_isolated')
+    self.assertIs(f, self.points)
+    self.assertEqual(isolated, {})
+
 class simplify(TestCase):
 
   def test_multiply_transpose(self):
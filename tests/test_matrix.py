@@ -1,4 +1,4 @@
-import numpy, pickle
+import numpy, pickle, collections, unittest.mock, logging
 from nutils import matrix, sparse, testing, warnings
 
 class Solver(testing.TestCase):
@@ -138,6 +138,18 @@ class Solver(testing.TestCase):
         res = numpy.linalg.norm(self.matrix @ lhs - rhs, axis=0)
         self.assertLess(numpy.max(res), 1e-9)
 
+  def test_solve_many(self):
+    rhs = [numpy.arange(self.n, dtype=float), numpy.ones(self.n), numpy.zeros(self.n)]
+    for args in self.args:
+      with self.subTest(args.get('solver', 'direct')):
+        lhs = self.matrix.solve_many(rhs, **args)
+        self.assertEqual(len(lhs), len(rhs))
+        for lhs_, rhs_ in zip(lhs, rhs):
+          self.assertLess(numpy.linalg.norm(self.matrix @ lhs_ - rhs_), args.get('atol', 1e-10))
+    self.assertEqual(self.matrix.solve_many([]), [])
+    with self.assertRaises(matrix.MatrixError):
+      self.matrix.solve_many([numpy.ones(self.n+1)])
+
   def test_singular(self):
     singularmatrix = matrix.assemble(numpy.arange(self.n)-self.n//2, numpy.arange(self.n)[numpy.newaxis].repeat(2,0), shape=(self.n, self.n))
     rhs = numpy.ones(self.n)
@@ -154,6 +166,24 @@ class Solver(testing.TestCase):
           res = numpy.linalg.norm(self.matrix @ lhs - rhs)
           self.assertLess(res, args.get('atol', 1e-10))
 
+  def test_recycle(self):
+    rhs = numpy.arange(self.n, dtype=float)
+    mat = self.matrix + matrix.eye(self.n)
+    recycle = collections.deque(maxlen=5)
+    niter = []
+    for i in range(3):
+      solve = mat.getprecon('diag')
+      def counted(rhs):
+        niter[-1] += 1
+        return solve(rhs)
+      niter.append(0)
+      lhs = mat.solve(rhs, solver='arnoldi', precon=lambda mat: counted, atol=1e-8, recycle=recycle)
+      self.assertLess(numpy.linalg.norm(mat @ lhs - rhs), 1e-8)
+      self.assertLessEqual(len(recycle), 5)
+      mat = mat + matrix.eye(self.n) * .01
+    self.assertLess(niter[1], niter[0])
+    self.assertLess(niter[2], niter[0])
+
   def test_constraints(self):
     cons = numpy.empty(self.matrix.shape[0])
     cons[:] = numpy.nan
@@ -196,12 +226,28 @@ class Solver(testing.TestCase):
   def test_diagonal(self):
     self.assertAllEqual(self.matrix.diagonal(), numpy.diag(self.exact))
 
+  def test_precon_samepattern(self):
+    rhs = numpy.arange(self.n, dtype=float)
+    mat1 = self.matrix
+    mat2 = self.matrix * 2 + matrix.eye(self.n)
+    solve1 = mat1.getprecon('direct')
+    solve2 = mat2.getprecon('direct')
+    for mat, solve in (mat1, solve1), (mat2, solve2), (mat1, solve1):
+      self.assertAllAlmostEqual(mat @ solve(rhs), rhs, places=10)
+
 class Numpy(Solver):
   def setUp(self):
     self.backend = 'numpy'
     self.args = [{},
       dict(solver='direct', atol=1e-8),
-      dict(atol=1e-5, precon='diag', truncate=5)]
+      dict(atol=1e-5, precon='diag', truncate=5),
+      dict(atol=1e-5, precon='amg', preconargs=dict(maxcoarse=10)),
+      dict(solver='cg', atol=1e-5),
+      dict(solver='cg', atol=1e-5, precon='diag'),
+      dict(solver='cg', atol=1e-5, precon='blockjacobi', preconargs=dict(blocksize=7)),
+      dict(solver='gmres', atol=1e-5),
+      dict(solver='gmres', atol=1e-5, restart=10, precon='blockjacobi', preconargs=dict(blocksize=7)),
+      dict(solver='cg', atol=1e-5, precon='amg', preconargs=dict(maxcoarse=10))]
     super().setUp()
 
   def test_deprecated_context(self):
@@ -209,6 +255,49 @@ class Numpy(Solver):
       with matrix.Numpy():
         pass
 
+  def test_sparse(self):
+    n = 10**6 # dense storage would require 8TB
+    mat = matrix.eye(n) + matrix.diag(numpy.arange(n, dtype=float))
+    self.assertEqual(len(mat.export('csr')[0]), n)
+    self.assertAllEqual(mat @ numpy.ones(n), numpy.arange(1, n+1))
+    self.assertAllEqual(mat.diagonal(), numpy.arange(1, n+1))
+
+  def test_cg_maxiter(self):
+    rhs = numpy.ones(self.n)
+    with self.assertRaises(matrix.ToleranceNotReached):
+      self.matrix.solve(rhs, solver='cg', maxiter=0, atol=1e-5)
+
+  def test_large_direct(self):
+    from nutils.matrix import _numpy
+    rhs = numpy.ones(self.n)
+    with unittest.mock.patch.object(_numpy, '_maxdirect', self.n - 1), self.assertLogs('nutils', logging.WARNING) as cm:
+      lhs = self.matrix.solve(rhs)
+    self.assertIn('may exhaust memory', cm.output[0])
+    self.assertAllAlmostEqual(self.exact @ lhs, rhs, places=10)
+
+  def test_large_iterative(self):
+    n = 20000 # dense storage would require 3.2GB
+    i = numpy.arange(n)
+    index = numpy.concatenate([[i, i], [i[1:], i[:-1]], [i[:-1], i[1:]]], axis=1)
+    index = index[:,numpy.lexsort(index[::-1])]
+    mat = matrix.assemble(numpy.where(index[0] == index[1], 3., -1.), index, shape=(n, n))
+    rhs = numpy.ones(n)
+    for args in dict(solver='cg', precon='blockjacobi'), dict(solver='gmres', precon='diag'):
+      with self.subTest(**args):
+        lhs = mat.solve(rhs, atol=1e-10, **args)
+        self.assertLess(numpy.linalg.norm(mat @ lhs - rhs), 1e-10)
+
+  def test_rectangular(self):
+    mat = matrix.assemble(numpy.array([1.,2,3]), numpy.array([[0,0,2],[1,3,0]]), shape=(4,5))
+    dense = numpy.zeros((4,5))
+    dense[[0,0,2],[1,3,0]] = 1, 2, 3
+    self.assertAllEqual(mat.export('dense'), dense)
+    self.assertAllEqual(mat.T.export('dense'), dense.T)
+    self.assertAllEqual(mat @ numpy.arange(5.), dense @ numpy.arange(5.))
+    self.assertAllEqual(mat.T @ numpy.arange(8.).reshape(4,2), dense.T @ numpy.arange(8.).reshape(4,2))
+    self.assertAllEqual((mat + mat.submatrix([0,1,2,3],[0,1,2,3,4])).export('dense'), 2 * dense)
+    self.assertAllEqual(mat.rowsupp(), [True, False, True, False])
+
 class Scipy(Solver):
   def setUp(self):
     self.backend = 'scipy'
@@ -217,7 +306,8 @@ class Scipy(Solver):
       dict(atol=1e-5, precon='diag', truncate=5),
       dict(solver='gmres', atol=1e-5, restart=100, precon='spilu'),
       dict(solver='gmres', atol=1e-5, precon='splu'),
-      dict(solver='cg', atol=1e-5, precon='diag')] + [
+      dict(solver='cg', atol=1e-5, precon='diag'),
+      dict(solver='cg', atol=1e-5, precon='amg', preconargs=dict(maxcoarse=10))] + [
       dict(solver=s, atol=1e-5) for s in ('bicg', 'bicgstab', 'cg', 'cgs', 'lgmres', 'minres')]
     super().setUp()
 
@@ -226,6 +316,15 @@ class Scipy(Solver):
       with matrix.Scipy():
         pass
 
+  def test_permutation_reuse(self):
+    from nutils.matrix import _scipy
+    _scipy._permutations.clear()
+    rhs = numpy.arange(self.n, dtype=float)
+    for scale in 1, 2, 3:
+      lhs = (self.matrix * scale).solve(rhs)
+      self.assertAllAlmostEqual(self.matrix @ lhs * scale, rhs, places=10)
+    self.assertEqual(len(_scipy._permutations), 1)
+
 class MKL(Solver):
   def setUp(self):
     self.backend = 'mkl'
@@ -233,7 +332,8 @@ class MKL(Solver):
       dict(solver='direct', atol=1e-8),
       dict(atol=1e-5, precon='diag', truncate=5),
       dict(solver='fgmres', atol=1e-8),
-      dict(solver='fgmres', atol=1e-8, precon='diag')]
+      dict(solver='fgmres', atol=1e-8, precon='diag'),
+      dict(solver='fgmres', atol=1e-8, precon='amg', preconargs=dict(maxcoarse=10))]
     super().setUp()
 
   def test_deprecated_context(self):
@@ -241,4 +341,232 @@ class MKL(Solver):
       with matrix.MKL():
         pass
 
+  def test_analysis_reuse(self):
+    from nutils.matrix import _mkl
+    _mkl._analyses.clear()
+    rhs = numpy.arange(self.n, dtype=float)
+    for scale in 1, 2, 3:
+      lhs = (self.matrix * scale).solve(rhs)
+      self.assertAllAlmostEqual(self.matrix @ lhs * scale, rhs, places=10)
+    self.assertEqual(len(_mkl._analyses), 1)
+
+  def test_analysis_reuse_values(self):
+    from nutils.matrix import _mkl
+    rhs = numpy.arange(self.n, dtype=float)
+    scale = numpy.linspace(1, 100, self.n)
+    data, colidx, rowptr = self.matrix.export('csr')
+    other = matrix.assemble(data * scale[numpy.arange(self.n).repeat(numpy.diff(rowptr))], numpy.array([numpy.arange(self.n).repeat(numpy.diff(rowptr)), colidx]), shape=(self.n, self.n))
+    _mkl._analyses.clear()
+    self.matrix.solve(rhs)
+    reused = other.solve(rhs)
+    self.assertEqual(len(_mkl._analyses), 1)
+    _mkl._analyses.clear()
+    fresh = other.solve(rhs)
+    self.assertAllAlmostEqual(reused, fresh, places=10)
+    for iparm in {10: 1}, {12: 1}: # value dependent analyses are not shared
+      with self.subTest(iparm=iparm):
+        _mkl._analyses.clear()
+        self.matrix.solve(rhs, preconargs=dict(iparm=iparm))
+        self.assertAllAlmostEqual(other.solve(rhs, preconargs=dict(iparm=iparm)), fresh, places=10)
+        self.assertEqual(len(_mkl._analyses), 2)
+
+  def test_factorization_release(self):
+    from nutils.matrix import _mkl
+    _mkl._analyses.clear()
+    rhs = numpy.arange(self.n, dtype=float)
+    mat = self.matrix * 2
+    lhs = mat.solve(rhs)
+    pardiso, = _mkl._analyses._items.values()
+    self.assertIsNotNone(pardiso._factorized)
+    del mat
+    self.assertIsNone(pardiso._factorized)
+    lhs = (self.matrix * 3).solve(rhs)
+    self.assertAllAlmostEqual(self.matrix @ lhs * 3, rhs, places=10)
+
 del Solver
+
+class operator(testing.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.n = 20
+    self.exact = 2 * numpy.eye(self.n) - numpy.eye(self.n, self.n, -1) - numpy.eye(self.n, self.n, +1)
+    self.op = matrix.Operator(self.exact.__matmul__, self.exact.shape, diagonal=self.exact.diagonal())
+
+  def test_matmul(self):
+    x = numpy.arange(self.n*2.).reshape(self.n, 2)
+    self.assertAllAlmostEqual(self.op @ x[:,0], self.exact @ x[:,0])
+    self.assertAllAlmostEqual(self.op @ x, self.exact @ x)
+
+  def test_linear(self):
+    x = numpy.arange(self.n, dtype=float)
+    self.assertAllAlmostEqual((2 * self.op - self.op) @ x, self.exact @ x)
+    self.assertAllAlmostEqual((-self.op).diagonal(), -self.exact.diagonal())
+    self.assertAllAlmostEqual((self.op + matrix.eye(self.n)).diagonal(), self.exact.diagonal() + 1)
+
+  def test_submatrix(self):
+    sub = self.op.submatrix(numpy.arange(1, self.n), numpy.arange(1, self.n))
+    x = numpy.arange(self.n-1, dtype=float)
+    self.assertAllAlmostEqual(sub @ x, self.exact[1:,1:] @ x)
+    self.assertAllAlmostEqual(sub.diagonal(), self.exact.diagonal()[1:])
+
+  def test_solve(self):
+    rhs = numpy.arange(self.n, dtype=float)
+    for args in dict(solver='gmres', precon='diag'), dict(solver='cg'), dict(precon='diag'):
+      with self.subTest(**args):
+        lhs = self.op.solve(rhs, atol=1e-10, **args)
+        self.assertLess(numpy.linalg.norm(self.exact @ lhs - rhs), 1e-10)
+
+  def test_direct(self):
+    with self.assertRaises(matrix.MatrixError):
+      self.op.solve(numpy.ones(self.n))
+
+  def test_preconditioner(self):
+    precon = matrix.fromsparse(sparse.prune(sparse.fromarray(self.exact), inplace=True), inplace=True)
+    op = matrix.Operator(self.exact.__matmul__, self.exact.shape, preconditioner=precon)
+    rhs = numpy.arange(self.n, dtype=float)
+    for scale in 1, 2:
+      with self.subTest(scale=scale):
+        lhs = (op * scale).solve(rhs, solver='gmres', precon='direct', atol=1e-10)
+        self.assertLess(numpy.linalg.norm(self.exact @ lhs * scale - rhs), 1e-10)
+    sub = op.submatrix(numpy.arange(1, self.n), numpy.arange(1, self.n))
+    lhs = sub.solve(rhs[1:], precon='direct', atol=1e-10)
+    self.assertLess(numpy.linalg.norm(self.exact[1:,1:] @ lhs - rhs[1:]), 1e-10)
+
+  def test_preconditioner_shape(self):
+    with self.assertRaises(matrix.MatrixError):
+      matrix.Operator(self.exact.__matmul__, self.exact.shape, preconditioner=matrix.eye(self.n+1))
+
+class amg(testing.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.enter_context(matrix.backend('numpy'))
+    n = 40 # poisson problem on a n x n grid
+    laplace = 2 * numpy.eye(n) - numpy.eye(n, n, -1) - numpy.eye(n, n, +1)
+    self.exact = numpy.kron(laplace, numpy.eye(n)) + numpy.kron(numpy.eye(n), laplace)
+    self.matrix = matrix.fromsparse(sparse.prune(sparse.fromarray(self.exact), inplace=True), inplace=True)
+
+  def test_vcycle(self):
+    precon = self.matrix.getprecon('amg', maxcoarse=50)
+    rhs = numpy.ones(len(self.exact))
+    lhs = numpy.zeros_like(rhs)
+    for i in range(50): # stationary multigrid iteration, contracts by about 3/4 per cycle
+      lhs += precon(rhs - self.exact @ lhs)
+    self.assertLess(numpy.linalg.norm(rhs - self.exact @ lhs), 1e-4 * numpy.linalg.norm(rhs))
+
+  def test_multirhs(self):
+    precon = self.matrix.getprecon('amg', maxcoarse=50)
+    rhs = numpy.arange(len(self.exact)*2.).reshape(-1, 2)
+    self.assertAllAlmostEqual(precon(rhs), numpy.stack([precon(rhs[:,0]), precon(rhs[:,1])], axis=1))
+
+  def test_nullspace(self):
+    x = numpy.arange(len(self.exact)) % 40
+    rhs = numpy.ones(len(self.exact))
+    lhs = self.matrix.solve(rhs, solver='cg', atol=1e-8, precon='amg', preconargs=dict(maxcoarse=50, nullspace=numpy.stack([numpy.ones_like(x), x], axis=1)))
+    self.assertLess(numpy.linalg.norm(rhs - self.exact @ lhs), 1e-8)
+
+  def test_nodes(self):
+    exact = numpy.kron(self.exact, [[2,1],[1,2]]) # two interleaved components per node
+    mat = matrix.fromsparse(sparse.prune(sparse.fromarray(exact), inplace=True), inplace=True)
+    rhs = numpy.ones(len(exact))
+    lhs = mat.solve(rhs, solver='cg', atol=1e-8, precon='amg', preconargs=dict(maxcoarse=50, nodes=numpy.arange(len(exact))//2))
+    self.assertLess(numpy.linalg.norm(rhs - exact @ lhs), 1e-8)
+
+  def test_stalled(self):
+    n = 1000 # without connections between dofs every dof forms its own aggregate
+    mat = matrix.diag(numpy.linspace(1, 2, n))
+    rhs = numpy.ones(n)
+    with unittest.mock.patch('numpy.linalg.pinv', side_effect=AssertionError('coarse operator should not be densified')):
+      lhs = mat.solve(rhs, solver='cg', atol=1e-10, precon='amg', preconargs=dict(maxcoarse=10))
+    self.assertLess(numpy.linalg.norm(mat @ lhs - rhs), 1e-10)
+
+  def test_empty(self):
+    precon = matrix.empty((3, 3)).getprecon('amg')
+    self.assertAllEqual(precon(numpy.ones(3)), numpy.zeros(3))
+
+class block(testing.TestCase):
+
+  def setUp(self):
+    super().setUp()
+    self.enter_context(matrix.backend('numpy'))
+    n, m = 20, 5
+    A = 2 * numpy.eye(n) - numpy.eye(n, n, -1) - numpy.eye(n, n, +1)
+    B = numpy.zeros((m, n))
+    B[numpy.arange(m), numpy.arange(0, n, n//m)] = 1
+    B[numpy.arange(m), numpy.arange(1, n, n//m)] = -1
+    self.exact = numpy.block([[A, B.T], [B, numpy.zeros((m, m))]]) # saddle point system
+    self.matrix = matrix.BlockMatrix([[self._asmatrix(A), self._asmatrix(B.T)], [self._asmatrix(B), matrix.empty((m, m))]])
+
+  def _asmatrix(self, array):
+    return matrix.fromsparse(sparse.prune(sparse.fromarray(array), inplace=True), inplace=True)
+
+  def test_shape(self):
+    self.assertEqual(self.matrix.shape, self.exact.shape)
+    self.assertEqual(self.matrix.rowsizes, (20, 5))
+    self.assertEqual(self.matrix.colsizes, (20, 5))
+
+  def test_inconsistent(self):
+    with self.assertRaises(matrix.MatrixError):
+      matrix.BlockMatrix([[matrix.eye(2), matrix.eye(3)]])
+
+  def test_matmul(self):
+    x = numpy.arange(50.).reshape(25, 2)
+    self.assertAllAlmostEqual(self.matrix @ x[:,0], self.exact @ x[:,0])
+    self.assertAllAlmostEqual(self.matrix @ x, self.exact @ x)
+
+  def test_export(self):
+    self.assertAllEqual(self.matrix.export('dense'), self.exact)
+    data, (row, col) = self.matrix.export('coo')
+    self.assertAllEqual(self.exact[row, col], data)
+    self.assertEqual(len(data), numpy.count_nonzero(self.exact))
+    data, colidx, rowptr = self.matrix.export('csr')
+    self.assertAllEqual(numpy.diff(rowptr), numpy.count_nonzero(self.exact, axis=1))
+
+  def test_linear(self):
+    self.assertAllAlmostEqual((2 * self.matrix - self.matrix).export('dense'), self.exact)
+    self.assertIsInstance(self.matrix + self.matrix, matrix.BlockMatrix)
+    self.assertAllAlmostEqual((self.matrix + matrix.eye(25)).export('dense'), self.exact + numpy.eye(25))
+    self.assertAllAlmostEqual(self.matrix.T.export('dense'), self.exact.T)
+
+  def test_submatrix(self):
+    rows = numpy.arange(1, 24)
+    sub = self.matrix.submatrix(rows, rows)
+    self.assertIsInstance(sub, matrix.BlockMatrix)
+    self.assertEqual(sub.rowsizes, (19, 4))
+    self.assertAllEqual(sub.export('dense'), self.exact[1:24,1:24])
+
+  def test_rowsupp(self):
+    self.assertAllEqual(self.matrix.rowsupp(), numpy.ones(25, dtype=bool))
+    self.assertAllEqual(self.matrix.diagonal(), self.exact.diagonal())
+
+  def test_pickle(self):
+    s = pickle.dumps(self.matrix)
+    mat = pickle.loads(s)
+    self.assertIsInstance(mat, matrix.BlockMatrix)
+    self.assertAllEqual(mat.export('dense'), self.exact)
+
+  def test_solve(self):
+    rhs = numpy.arange(25.)
+    for args in dict(), dict(solver='direct'), dict(solver='gmres', precon='schur'), dict(solver='gmres', precon='schur', preconargs=dict(blockprecon='diag')):
+      with self.subTest(**args):
+        lhs = self.matrix.solve(rhs, atol=1e-10, **args)
+        self.assertLess(numpy.linalg.norm(self.exact @ lhs - rhs), 1e-10)
+
+  def test_blocktriangular(self):
+    mat = self.matrix - matrix.BlockMatrix([[matrix.empty((20, 20)), matrix.empty((20, 5))], [matrix.empty((5, 20)), matrix.eye(5)]]) # invertible trailing block
+    rhs = numpy.arange(25.)
+    upper = mat.export('dense')
+    upper[20:,:20] = 0
+    self.assertAllAlmostEqual(mat.getprecon('blocktriangular')(rhs), numpy.linalg.solve(upper, rhs))
+    lhs = mat.solve(rhs, solver='gmres', precon='blocktriangular', atol=1e-10)
+    self.assertLess(numpy.linalg.norm(mat @ lhs - rhs), 1e-10)
+
+  def test_schur_exact(self):
+    # for a diagonal leading block the schur complement is exact, such that
+    # the preconditioner inverts the block upper triangular part
+    diagmat = matrix.BlockMatrix([[matrix.diag(numpy.full(20, 2.)), self.matrix.blocks[0][1]], self.matrix.blocks[1]])
+    dense = diagmat.export('dense')
+    S = -dense[20:,:20] @ dense[:20,20:] / 2
+    upper = numpy.block([[dense[:20,:20], dense[:20,20:]], [numpy.zeros((5, 20)), S]])
+    self.assertAllAlmostEqual(diagmat.getprecon('schur')(numpy.arange(25.)), numpy.linalg.solve(upper, numpy.arange(25.)))
@@ -1,8 +1,16 @@
-import unittest, os, multiprocessing, time, sys, warnings as _builtin_warnings
+import unittest, unittest.mock, os, functools, multiprocessing, time, sys, threading, subprocess, warnings as _builtin_warnings
 from nutils import parallel, testing, warnings
 
 canfork = hasattr(os, 'fork')
 
+def _setpid(a, i):
+  a[i] = os.getpid()
+  time.sleep(.01)
+
+def _failat(n, i):
+  if i == n:
+    1/0
+
 @unittest.skipIf(sys.platform == 'darwin', 'fork is unreliable (in combination with matplotlib)')
 class Test(testing.TestCase):
 
@@ -51,6 +59,31 @@ class Test(testing.TestCase):
     self.assertEqual(min(a), 0)
     self.assertEqual(max(a), 2 if canfork else 0)
 
+  def test_range_chunks(self):
+    for chunksize in 1, 5, 'guided':
+      with self.subTest(chunksize=chunksize):
+        a = parallel.shzeros([32], dtype=int)
+        r = parallel.range(len(a), chunksize)
+        with parallel.fork() as procid:
+          for i in r:
+            a[i] += 1
+            time.sleep(.01)
+        self.assertEqual(a.tolist(), [1]*len(a))
+
+  def test_range_guided(self):
+    with parallel.maxprocs(2):
+      r = parallel.range(40, 'guided')
+    ends = []
+    for i in r:
+      if not ends or ends[-1] != r._end:
+        ends.append(r._end)
+    self.assertEqual(ends, [10, 18, 24, 28, 31, 34, 36, 37, 38, 39, 40])
+
+  def test_range_invalid(self):
+    for chunksize in 0, 1.5, 'static':
+      with self.subTest(chunksize=chunksize), self.assertRaises(ValueError):
+        parallel.range(10, chunksize)
+
   def test_ctxrange(self):
     a = parallel.shzeros([32], dtype=int)
     with parallel.ctxrange('test', len(a)) as r:
@@ -58,3 +91,81 @@ class Test(testing.TestCase):
         a[i] = 1
         time.sleep(.01)
     self.assertEqual(a.tolist(), [1]*len(a))
+
+  def test_getmaxprocs(self):
+    with parallel.maxprocs(2):
+      self.assertEqual(parallel.getmaxprocs(), 2)
+    self.assertEqual(parallel.getmaxprocs(), parallel._maxprocs.value)
+
+  def test_method(self):
+    with parallel.method('threads'):
+      self.assertEqual(parallel._method.value, 'threads')
+    self.assertEqual(parallel._method.value, 'fork')
+    with self.assertRaises(ValueError):
+      parallel.method('spawn')
+
+  def test_method_environ(self):
+    env = dict(os.environ, NUTILS_PARALLEL='spawn')
+    result = subprocess.run([sys.executable, '-c', 'import nutils.parallel'], env=env, stderr=subprocess.PIPE, universal_newlines=True)
+    self.assertNotEqual(result.returncode, 0)
+    self.assertIn("ValueError: method should be either 'fork' or 'threads'", result.stderr)
+
+  def test_foreach_fork(self):
+    a = parallel.shzeros([32], dtype=int)
+    def func(i):
+      a[i] = os.getpid()
+      time.sleep(.01)
+    parallel.foreach('test', len(a), func)
+    self.assertEqual(len(set(a)), 3 if canfork else 1)
+
+  def test_foreach_threads(self):
+    a = parallel.shzeros([32], dtype=int)
+    def func(i):
+      a[i] = threading.get_ident()
+      time.sleep(.01)
+    with parallel.method('threads'):
+      parallel.foreach('test', len(a), func)
+    self.assertEqual(len(set(a)), 3)
+
+  def test_foreach_threads_fail(self):
+    def func(i):
+      if i == 5:
+        1/0
+    with self.assertRaises(ZeroDivisionError), parallel.method('threads'):
+      parallel.foreach('test', 32, func)
+
+  @unittest.skipIf(sys.version_info < (3, 8), 'pool requires python 3.8 or newer')
+  def test_pool(self):
+    with parallel.pool():
+      pids = set()
+      for i in range(2):
+        a = parallel.shzeros([32], dtype=int)
+        parallel.foreach('test', len(a), functools.partial(_setpid, a))
+        self.assertEqual(len(set(a)), 3 if canfork else 1)
+        pids.update(a)
+    self.assertEqual(len(pids), 3 if canfork else 1) # workers persist
+
+  def test_pool_fallback(self):
+    a = parallel.shzeros([32], dtype=int)
+    def func(i): # local functions cannot be pickled
+      a[i] = os.getpid()
+      time.sleep(.01)
+    with parallel.pool():
+      parallel.foreach('test', len(a), func)
+    self.assertEqual(len(set(a)), 3 if canfork else 1)
+
+  def test_pool_python37(self):
+    with unittest.mock.patch.object(parallel.sys, 'version_info', (3, 7, 0)), parallel.pool():
+      self.assertIsNone(parallel._pool.value)
+      a = parallel.shzeros([32], dtype=int)
+      parallel.foreach('test', len(a), functools.partial(_setpid, a))
+    self.assertEqual(len(set(a)), 3 if canfork else 1)
+
+  def test_pool_fail(self):
+    with parallel.pool():
+      for n in 0, 31:
+        with self.assertRaises(Exception):
+          parallel.foreach('test', 32, functools.partial(_failat, n))
+      a = parallel.shzeros([32], dtype=int)
+      parallel.foreach('test', len(a), functools.partial(_setpid, a))
+      self.assertTrue(a.all())
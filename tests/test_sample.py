@@ -1,5 +1,5 @@
 from nutils import *
-import random, itertools, functools
+import random, itertools, functools, unittest.mock
 from nutils.testing import *
 
 class rectilinear(TestCase):
@@ -76,6 +76,23 @@ class integral(TestCase):
       self.topo.integral('v^2 d:x' @ self.ns, degree=2).derivative('lhs').eval(lhs=self.lhs),
       places=15)
 
+  def test_linearize(self):
+    v = numpy.cos(numpy.arange(len(self.ns.basis)))
+    self.assertAllAlmostEqual(
+      self.topo.integral('basis_n v^2 d:x' @ self.ns, degree=2).derivative('lhs').eval(lhs=self.lhs).export('dense') @ v,
+      self.topo.integral('basis_n v^2 d:x' @ self.ns, degree=2).linearize('lhs', 'dlhs').eval(lhs=self.lhs, dlhs=v),
+      places=15)
+
+  def test_diagonal(self):
+    w = numpy.arange(len(self.ns.basis)*2.).reshape(-1, 2)
+    u = (self.ns.basis[:,numpy.newaxis] * function.Argument('w', w.shape)).sum(0)
+    integral = self.topo.integral(self.ns.basis[:,numpy.newaxis] * u * (u**2).sum() * function.J(self.ns.x), degree=4)
+    jac = integral.derivative('w')
+    self.assertAllAlmostEqual(
+      numpy.einsum('ijij->ij', sparse.toarray(jac.eval(w=w))),
+      jac.diagonal().eval(w=w).export('dense'),
+      places=12)
+
   def test_transpose(self):
     with self.assertWarns(evaluable.ExpensiveEvaluationWarning):
       self.assertAllAlmostEqual(
@@ -83,6 +100,60 @@ class integral(TestCase):
         self.topo.integral(self.ns.eval_nm('basis_n (basis_m + 1_m) d:x'), degree=2).T.eval().export('dense'),
         places=15)
 
+  def test_batches(self):
+    args = dict(lhs=self.lhs)
+    desired = self.topo.integrate('basis_n v d:x' @ self.ns, degree=2, arguments=args)
+    for maxbatchsize in 1, 2, 3:
+      with self.subTest(maxbatchsize=maxbatchsize), unittest.mock.patch.object(sample, '_maxbatchsize', maxbatchsize):
+        self.assertAllAlmostEqual(self.topo.integrate('basis_n v d:x' @ self.ns, degree=2, arguments=args), desired, places=15)
+
+  def test_threads(self):
+    args = dict(lhs=self.lhs)
+    desired = self.topo.integrate('basis_n v d:x' @ self.ns, degree=2, arguments=args)
+    sample._integrands.cache_clear()
+    with parallel.maxprocs(3), parallel.method('threads'), unittest.mock.patch.object(sample, '_maxbatchsize', 1):
+      self.assertAllAlmostEqual(self.topo.integrate('basis_n v d:x' @ self.ns, degree=2, arguments=args), desired, places=15)
+
+  def test_pool(self):
+    args = dict(lhs=self.lhs)
+    desired = self.topo.integrate(self.ns.eval_nm('basis_n basis_m v d:x'), degree=2, arguments=args).export('dense')
+    sample._integrands.cache_clear()
+    with parallel.maxprocs(3), parallel.pool(), unittest.mock.patch.object(sample, '_maxbatchsize', 1):
+      for i in range(2): # evaluate sparsity pattern, reuse pattern
+        self.assertAllAlmostEqual(self.topo.integrate(self.ns.eval_nm('basis_n basis_m v d:x'), degree=2, arguments=args).export('dense'), desired, places=15)
+      func = function.take(self.ns.basis, function.Argument('i', (2,), dtype=int), axis=0)
+      self.assertAllAlmostEqual(self.topo.integral(func, degree=2).eval(i=numpy.array([0,5])), [.5,.5], places=15)
+
+  def test_reuse(self):
+    integral = self.topo.integral('basis_n v d:x' @ self.ns, degree=2)
+    desired = [self.topo.integrate('basis_n v d:x' @ self.ns, degree=2, arguments=dict(lhs=lhs)) for lhs in (self.lhs, 2*self.lhs)]
+    sample._integrands.cache_clear()
+    with unittest.mock.patch.object(sample, '_Integrands', wraps=sample._Integrands) as integrands:
+      self.assertAllAlmostEqual(integral.eval(lhs=self.lhs), desired[0], places=15)
+      self.assertAllAlmostEqual(integral.eval(lhs=2*self.lhs), desired[1], places=15)
+    self.assertEqual(integrands.call_count, 1)
+
+  def test_pattern(self):
+    integral = self.topo.integral(self.ns.eval_nm('basis_n basis_m v d:x'), degree=2)
+    desired = [integral.eval(lhs=lhs).export('dense') for lhs in (self.lhs, 2*self.lhs)]
+    sample._integrands.cache_clear()
+    with unittest.mock.patch.object(sample, '_Pattern', wraps=sample._Pattern) as pattern:
+      for lhs, desired_ in zip((self.lhs, 2*self.lhs), desired):
+        self.assertAllAlmostEqual(integral.eval(lhs=lhs).export('dense'), desired_, places=15)
+    self.assertEqual(pattern.call_count, 1)
+
+  def test_dynamic_pattern(self):
+    func = function.take(self.ns.basis, function.Argument('i', (2,), dtype=int), axis=0)
+    self.assertFalse(sample._integrands(tuple(self.topo.sample('gauss', 2)._prepare_funcs_integrate([func]))).staticpattern)
+    integral = self.topo.integral(func, degree=2)
+    self.assertAllAlmostEqual(integral.eval(i=numpy.array([1,2])), [1,1], places=15)
+    self.assertAllAlmostEqual(integral.eval(i=numpy.array([0,5])), [.5,.5], places=15)
+
+  def test_sizes(self):
+    smpl = self.topo.sample('gauss', 2)
+    self.assertEqual(sample._integrands(tuple(smpl._prepare_funcs_integrate(['basis_n d:x' @ self.ns]))).sizes.tolist(), [2])
+    self.assertIsNone(sample._integrands(tuple(smpl._prepare_funcs_eval(['basis_n' @ self.ns]))).sizes)
+
   def test_empty(self):
     shape = 2, 3
     empty = sample.Integral({}, shape=shape)
@@ -1,6 +1,6 @@
-from nutils import solver, mesh, function, cache, types, numeric, warnings, sample, sparse
+from nutils import solver, mesh, function, cache, types, numeric, warnings, sample, sparse, matrix
 from nutils.testing import *
-import numpy, contextlib, tempfile, itertools, logging
+import numpy, contextlib, tempfile, itertools, logging, unittest.mock
 
 @contextlib.contextmanager
 def tmpcache():
@@ -42,6 +42,52 @@ class laplace(TestCase):
         self.assertLess(resnorm, 1e-13)
 
 
+class batched(TestCase):
+
+  def setUp(self):
+    super().setUp()
+    domain, geom = mesh.rectilinear([8,8])
+    basis = domain.basis('std', degree=1)
+    self.cons = domain.boundary['left'].project(0, onto=basis, geometry=geom, ischeme='gauss2')
+    dofs = function.Argument('dofs', [len(basis)])
+    self.k = function.Argument('k', [])
+    self.f = function.Argument('f', [2])
+    u = basis.dot(dofs)
+    self.residual = domain.integral(self.k * (basis.grad(geom) * u.grad(geom)).sum(-1)*function.J(geom), degree=2) \
+                  + domain.boundary['top'].integral(basis*(self.f*geom).sum(-1)*function.J(geom), degree=2)
+
+  def check(self, arguments, nsolves):
+    solve = matrix.Matrix.solve
+    counts = []
+    def countedsolve(*args, **kwargs):
+      counts.append(None)
+      return solve(*args, **kwargs)
+    with unittest.mock.patch.object(matrix.Matrix, 'solve', countedsolve):
+      lhss = solver.solve_linear('dofs', residual=self.residual, constrain=self.cons, arguments=arguments)
+    self.assertEqual(len(counts), nsolves)
+    self.assertEqual(len(lhss), len(arguments))
+    for i, (args, lhs) in enumerate(zip(arguments, lhss)):
+      with self.subTest(i=i):
+        self.assertAllAlmostEqual(lhs, solver.solve_linear('dofs', residual=self.residual, constrain=self.cons, arguments=args), places=12)
+
+  def test_sharedjacobian(self):
+    self.check([dict(k=1., f=[1.,0.]), dict(k=1., f=[0.,1.]), dict(k=1., f=[2.,-1.])], nsolves=1)
+
+  def test_varyingjacobian(self):
+    self.check([dict(k=1., f=[1.,0.]), dict(k=2., f=[1.,0.])], nsolves=2)
+
+  def test_single(self):
+    self.check([dict(k=1., f=[1.,0.])], nsolves=1)
+
+  def test_empty(self):
+    self.assertEqual(solver.solve_linear('dofs', residual=self.residual, constrain=self.cons, arguments=[]), [])
+
+  def test_multipletargets(self):
+    lhss = solver.solve_linear(['dofs'], residual=[self.residual], constrain=dict(dofs=self.cons), arguments=[dict(k=1., f=[1.,0.]), dict(k=1., f=[0.,1.])])
+    self.assertEqual(len(lhss), 2)
+    self.assertAllAlmostEqual(lhss[1]['dofs'], solver.solve_linear('dofs', residual=self.residual, constrain=self.cons, arguments=dict(k=1., f=[0.,1.])), places=12)
+
+
 @parametrize
 class navierstokes(TestCase):
 
@@ -102,6 +148,27 @@ class navierstokes(TestCase):
   def test_newton_relax0(self):
     self.assert_resnorm(solver.newton(self.dofs, residual=self.residual, arguments=self.arguments, constrain=self.cons, relax0=.1).solve(tol=self.tol, maxiter=5))
 
+  def test_newton_modified(self):
+    self.assert_resnorm(solver.newton(self.dofs, residual=self.residual, arguments=self.arguments, constrain=self.cons, modified=True).solve(tol=self.tol, maxiter=10))
+
+  def test_newton_schur(self):
+    if self.single:
+      self.skipTest('block preconditioners require multiple targets')
+    self.assert_resnorm(solver.newton(self.dofs, residual=self.residual, arguments=self.arguments, constrain=self.cons, linsolver='gmres', linprecon='schur').solve(tol=self.tol, maxiter=5))
+
+  def test_newton_recycle(self):
+    self.assert_resnorm(solver.newton(self.dofs, residual=self.residual, arguments=self.arguments, constrain=self.cons, linsolver='arnoldi', linrecycle=5).solve(tol=self.tol, maxiter=5))
+
+  def test_newton_recycle_gmres(self):
+    with self.assertRaisesRegex(solver.SolverError, 'linrecycle requires the arnoldi linear solver'):
+      solver.newton(self.dofs, residual=self.residual, arguments=self.arguments, constrain=self.cons, linsolver='gmres', linrecycle=5).solve(tol=self.tol, maxiter=5)
+
+  def test_newton_blockmatrix(self):
+    for args, blockwise in [({}, False)] + [(dict(linsolver='gmres', linprecon='schur'), True)] * (not self.single):
+      with self.subTest(**args), unittest.mock.patch.object(matrix, 'BlockMatrix', wraps=matrix.BlockMatrix) as BlockMatrix:
+        self.assert_resnorm(solver.newton(self.dofs, residual=self.residual, arguments=self.arguments, constrain=self.cons, **args).solve(tol=self.tol, maxiter=5))
+        self.assertEqual(BlockMatrix.called, blockwise)
+
   def test_newton_tolnotreached(self):
     with self.assertLogs('nutils', logging.WARNING) as cm:
       self.assert_resnorm(solver.newton(self.dofs, residual=self.residual, arguments=self.arguments, constrain=self.cons, linrtol=1e-99).solve(tol=self.tol, maxiter=2))
@@ -114,6 +181,9 @@ class navierstokes(TestCase):
   def test_pseudotime(self):
     self.assert_resnorm(solver.pseudotime(self.dofs, residual=self.residual, arguments=self.arguments, constrain=self.cons, inertia=self.inertia, timestep=1).solve(tol=self.tol, maxiter=12))
 
+  def test_pseudotime_recycle(self):
+    self.assert_resnorm(solver.pseudotime(self.dofs, residual=self.residual, arguments=self.arguments, constrain=self.cons, inertia=self.inertia, timestep=1, linsolver='arnoldi', linrecycle=5).solve(tol=self.tol, maxiter=12))
+
   def test_pseudotime_iter(self):
     _test_recursion_cache(self, lambda: ((self.frozen(lhs), info.resnorm) for lhs, info in solver.pseudotime(self.dofs, residual=self.residual, arguments=self.arguments, constrain=self.cons, inertia=self.inertia, timestep=1)))
 
@@ -158,6 +228,14 @@ class finitestrain(TestCase):
   def test_newton_iter(self):
     _test_recursion_cache(self, lambda: ((types.frozenarray(lhs), info.resnorm) for lhs, info in solver.newton('dofs', residual=self.residual, constrain=self.cons)))
 
+  def test_newton_modified(self):
+    lhs, info = solver.newton('dofs', residual=self.residual, constrain=self.cons, modified=True).solve_withinfo(tol=self.tol, maxiter=20)
+    self.assert_resnorm(lhs)
+    self.assertGreater(info.refreshes, 0)
+
+  def test_newton_modified_iter(self):
+    _test_recursion_cache(self, lambda: ((types.frozenarray(lhs), info.resnorm, info.refreshes) for lhs, info in solver.newton('dofs', residual=self.residual, constrain=self.cons, modified=True)))
+
   def test_minimize(self):
     self.assert_resnorm(solver.minimize('dofs', energy=self.energy, constrain=self.cons).solve(tol=self.tol, maxiter=12))
 
@@ -171,6 +249,61 @@ finitestrain(vector=False)
 finitestrain(vector=True)
 
 
+class matrixfree(TestCase):
+
+  def setUp(self):
+    super().setUp()
+    ns = function.Namespace()
+    domain, ns.x = mesh.rectilinear([numpy.linspace(0,1,5)]*2)
+    ns.basis = domain.basis('std', degree=2)
+    ns.u = 'basis_n ?dofs_n'
+    self.residual = domain.integral('(basis_n,i u_,i + basis_n (u^3 - 10)) d:x' @ ns, degree=6)
+    self.laplace = domain.integral('basis_n,i u_,i d:x' @ ns, degree=4)
+    self.cons = solver.optimize('dofs', domain.boundary['left'].integral('u^2 d:x' @ ns, degree=4), droptol=1e-15)
+
+  def test_newton(self):
+    desired = solver.newton('dofs', residual=self.residual, constrain=self.cons).solve(tol=1e-10)
+    actual = solver.newton('dofs', residual=self.residual, constrain=self.cons, matrixfree=True).solve(tol=1e-10)
+    self.assertAllAlmostEqual(actual, desired, places=8)
+
+  def test_jacobian(self):
+    with self.assertRaises(ValueError):
+      solver.newton('dofs', residual=self.residual, jacobian=[self.residual.derivative('dofs')], matrixfree=True)
+
+  def test_newtonkrylov(self):
+    desired = solver.newton('dofs', residual=self.residual, constrain=self.cons).solve(tol=1e-10)
+    actual = solver.newtonkrylov('dofs', residual=self.residual, constrain=self.cons).solve(tol=1e-10)
+    self.assertAllAlmostEqual(actual, desired, places=8)
+
+  def test_newtonkrylov_lag(self):
+    desired = solver.newton('dofs', residual=self.residual, constrain=self.cons).solve(tol=1e-10)
+    actual = solver.newtonkrylov('dofs', residual=self.residual, constrain=self.cons, lag=3).solve(tol=1e-10)
+    self.assertAllAlmostEqual(actual, desired, places=8)
+
+  def test_newtonkrylov_loworder(self):
+    desired = solver.newton('dofs', residual=self.residual, constrain=self.cons).solve(tol=1e-10)
+    actual = solver.newtonkrylov('dofs', residual=self.residual, jacobian=[self.laplace.derivative('dofs')], constrain=self.cons).solve(tol=1e-10)
+    self.assertAllAlmostEqual(actual, desired, places=8)
+
+  def test_newtonkrylov_iter(self):
+    _test_recursion_cache(self, lambda: ((types.frozenarray(lhs), info.resnorm) for lhs, info in solver.newtonkrylov('dofs', residual=self.residual, constrain=self.cons, lag=2)))
+
+  def test_newtonkrylov_evaluations(self):
+    cls = solver.newtonkrylov.__wrapped__
+    for lag, nassemble in (1, 4), (None, 1):
+      with self.subTest(lag=lag), \
+           unittest.mock.patch.object(cls, '_eval', autospec=True, side_effect=cls._eval) as _eval, \
+           unittest.mock.patch.object(cls, '_assemble', autospec=True, side_effect=cls._assemble) as _assemble:
+        accept = lambda res0, dres0, res1, dres1: (1, True) # no line search, for one residual evaluation per iteration
+        iterations = list(itertools.islice(solver.newtonkrylov('dofs', residual=self.residual, constrain=self.cons, linesearch=accept, **{} if lag is None else dict(lag=lag)), 4))
+        self.assertEqual(_eval.call_count, len(iterations)) # also when reassembling
+        self.assertEqual(_assemble.call_count, nassemble)
+
+  def test_newtonkrylov_lag_invalid(self):
+    with self.assertRaises(ValueError):
+      solver.newtonkrylov('dofs', residual=self.residual, lag=0)
+
+
 class optimize(TestCase):
 
   def setUp(self):
@@ -237,6 +370,13 @@ class burgers(TestCase):
   def test_resume_withscaling(self):
     _test_recursion_cache(self, lambda: map(types.frozenarray, solver.impliciteuler('dofs', residual=self.residual, inertia=self.inertia, lhs0=self.lhs0, timestep=100)))
 
+  def test_recycle(self):
+    reference = solver.impliciteuler('dofs', residual=self.residual, inertia=self.inertia, lhs0=self.lhs0, timestep=1)
+    recycled = solver.impliciteuler('dofs', residual=self.residual, inertia=self.inertia, lhs0=self.lhs0, timestep=1, newtonargs=dict(linsolver='arnoldi', linprecon='diag', linrecycle=5))
+    for i, lhs, reflhs in zip(range(5), recycled, reference):
+      with self.subTest(step=i):
+        self.assertAllAlmostEqual(lhs, reflhs, places=8)
+
 
 class theta_time(TestCase):
 
@@ -260,3 +400,43 @@ class theta_time(TestCase):
 
   def test_cranknicolson(self):
     self.check(solver.cranknicolson, theta=0.5)
+
+
+@parametrize
+class adaptive_time(TestCase):
+
+  def setUp(self):
+    super().setUp()
+    ns = function.Namespace()
+    topo, ns.x = mesh.rectilinear([1])
+    ns.u_n = '?u_n + <0>_n'
+    self.inertia = topo.integral('u_n d:x' @ ns, degree=0)
+    self.residual = topo.integral('u_n d:x' @ ns, degree=0) # du/dt = -u
+    self.lhs0 = numpy.array([1.])
+
+  def solver(self, **kwargs):
+    kwargs.setdefault('target', 'u')
+    return solver.adaptivethetamethod(residual=self.residual, inertia=self.inertia, lhs0=self.lhs0, timetarget='t', theta=self.theta, timetol=1e-4, **kwargs)
+
+  def test_accuracy(self):
+    for args, info in itertools.islice(self.solver(target=('u',), timestep=.01), 20):
+      self.assertLess(abs(args['u'][0] - numpy.exp(-args['t'])), 20 * 1e-4)
+    self.assertGreater(info.timestep, .01)
+
+  def test_reject(self):
+    timesteps = [info.timestep for u, info in itertools.islice(self.solver(timestep=1.), 3)]
+    self.assertLess(timesteps[1], 1.)
+
+  def test_maxtimestep(self):
+    for u, info in itertools.islice(self.solver(timestep=.01, maxtimestep=.02), 10):
+      self.assertLessEqual(info.timestep, .02)
+
+  def test_iter(self):
+    _test_recursion_cache(self, lambda: ((types.frozenarray(u), info.timestep, info.nexttimestep, info.rejected) for u, info in self.solver(timestep=.1)))
+
+  def test_invalid(self):
+    with self.assertRaises(ValueError):
+      solver.adaptivethetamethod(target='u', residual=self.residual, inertia=self.inertia, lhs0=self.lhs0, theta=self.theta, timestep=.1, timetol=0.)
+
+adaptive_time(theta=1.)
+adaptive_time(theta=.5)
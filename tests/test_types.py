@@ -1,6 +1,6 @@
 from nutils.testing import *
 import nutils.types
-import inspect, pickle, itertools, ctypes, stringly, tempfile, io, os
+import inspect, pickle, itertools, ctypes, stringly, tempfile, io, os, sys, subprocess, hashlib, unittest
 import numpy
 
 class apply_annotations(TestCase):
@@ -189,6 +189,40 @@ class nutils_hash(TestCase):
     with self.assertRaises(TypeError):
       nutils.types.nutils_hash([])
 
+  def test_memoized(self):
+    for obj in nutils.types.frozenarray(numpy.arange(10.)), nutils.types.frozendict({'a': 1}), nutils.types.frozenmultiset([1, 1]):
+      with self.subTest(type=type(obj).__name__):
+        self.assertIs(nutils.types.nutils_hash(obj), nutils.types.nutils_hash(obj))
+
+  def test_frozenarray_layout(self):
+    a = numpy.arange(6.).reshape(2, 3)
+    self.assertEqual(nutils.types.nutils_hash(nutils.types.frozenarray(a.T)), nutils.types.nutils_hash(nutils.types.frozenarray(a.T.copy(order='C'))))
+
+  def test_frozenarray_datetime(self):
+    a = numpy.array(['2020-01-01', '2020-01-02'], dtype='datetime64[D]')
+    self.assertEqual(nutils.types.nutils_hash(nutils.types.frozenarray(a)), nutils.types.nutils_hash(nutils.types.frozenarray(a.copy())))
+    self.assertNotEqual(nutils.types.nutils_hash(nutils.types.frozenarray(a)), nutils.types.nutils_hash(nutils.types.frozenarray(a[::-1])))
+    self.assertNotEqual(nutils.types.nutils_hash(nutils.types.frozenarray(a)), nutils.types.nutils_hash(nutils.types.frozenarray(a.view(numpy.int64))))
+
+  @unittest.skipIf(not hasattr(hashlib, 'blake2b'), 'blake2b requires python 3.6 or newer')
+  def test_blake2b(self):
+    code = 'import nutils.types; print(nutils.types.nutils_hash("spam").hex())'
+    env = dict(os.environ, NUTILS_HASH='blake2b')
+    digest = subprocess.run([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout.strip()
+    self.assertEqual(len(digest), 40)
+    self.assertNotEqual(digest, nutils.types.nutils_hash('spam').hex())
+
+  def test_without_blake2b(self):
+    code = 'import hashlib; del hashlib.blake2b; import nutils.types; print(nutils.types.nutils_hash("spam").hex())'
+    env = dict(os.environ)
+    env.pop('NUTILS_HASH', None)
+    digest = subprocess.run([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout.strip()
+    self.assertEqual(digest, hashlib.sha1(b'str\0' + hashlib.sha1(b'spam').digest()).hexdigest())
+    env['NUTILS_HASH'] = 'blake2b'
+    result = subprocess.run([sys.executable, '-c', code], env=env, stderr=subprocess.PIPE, universal_newlines=True)
+    self.assertNotEqual(result.returncode, 0)
+    self.assertIn('NUTILS_HASH=blake2b requires Python 3.6 or newer', result.stderr)
+
 class CacheMeta(TestCase):
 
   def test_property(self):